@@ -1,31 +1,111 @@
-import boto3
 import json
 import os
+import threading
 
 from boto3.dynamodb.conditions import Key, Attr
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal
+from utils.client_helper import get_resource, new_resource
+from utils.dynamodb_helper import QueryCache, add_index_keys, index_key_name, iter_query
+from utils.action_group_helper import ActionGroup
+from utils.log_helper import logger
 
-dynamodb_resource = boto3.resource('dynamodb')
 dynamodb_table = os.getenv('dynamodb_table')
 dynamodb_pk = os.getenv('dynamodb_pk')
 dynamodb_sk = os.getenv('dynamodb_sk')
+# Query results kept across invocations of a warm container, dropped on writes
+query_cache = QueryCache(max_entries=int(os.getenv('query_cache_size', 256)),
+                         ttl_seconds=float(os.getenv('query_cache_ttl', 30)))
+# Secondary indexes the table was created with, see AgentsForAmazonBedrock.create_dynamodb
+dynamodb_indexes = os.getenv('dynamodb_indexes', '').split(',')
+# Transactions of one type for a customer, ordered by day
+type_day_index = {'name': 'customer-type-day-index', 'partition_key': dynamodb_pk, 'sort_key': ['type', 'day']}
+# Attributes returned to the agent for transaction listings
+transaction_fields = ['day', 'transactionAmount', 'transactionType']
+# Monthly aggregate rows live in the customer partition under this sort key prefix
+aggregate_prefix = 'aggregate#'
+# Forecasting methods supported by generate_projections
+projection_methods = ('moving_average', 'exponential_smoothing', 'linear_trend')
+# Histories whose last actual month is more than this many months before the current month are not projected:
+# the fit would be extrapolated across the gap before reaching the first month it can write
+projection_max_gap_months = int(os.getenv('projection_max_gap_months', 3))
+# Bounded fan-out for the multi-customer tools
+batch_max_workers = int(os.getenv('batch_max_workers', 8))
+batch_worker_state = threading.local()
 truncated_month = datetime.today().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+# Functions exposed to the agent, registered with @action_group.action()
+action_group = ActionGroup()
 
 
-def get_named_parameter(event, name):
-    return next(item for item in event['parameters'] if item['name'] == name)['value']
-    
-def populate_function_response(event, response_body):
-    return {'response': {'actionGroup': event['actionGroup'], 'function': event['function'],
-                'functionResponse': {'responseBody': {'TEXT': {'body': str(response_body)}}}}}
-
 def trunc_datetime(month,year):
     return datetime.today().replace(year =int(year), month=int(month), day=1, hour=0, minute=0, second=0, microsecond=0)
 
+def get_dynamodb():
+    # boto3 resources are not thread safe, batch workers each get their own
+    if threading.current_thread() is threading.main_thread():
+        return get_resource('dynamodb')
+    if not hasattr(batch_worker_state, 'resource'):
+        batch_worker_state.resource = new_resource('dynamodb')
+    return batch_worker_state.resource
+
+def get_table(table_name):
+    return get_dynamodb().Table(table_name)
+
+def parse_customer_ids(customer_ids):
+    # Accepts a JSON array or a comma separated list
+    if isinstance(customer_ids, str):
+        try:
+            customer_ids = json.loads(customer_ids)
+        except json.JSONDecodeError:
+            customer_ids = customer_ids.split(',')
+    if not isinstance(customer_ids, list):
+        customer_ids = [customer_ids]
+    return list(dict.fromkeys(str(customer_id).strip() for customer_id in customer_ids if str(customer_id).strip()))
+
 def put_dynamodb(table_name, item):
-    table = dynamodb_resource.Table(table_name)
-    resp = table.put_item(Item=item)
+    table = get_table(table_name)
+    # The replaced item is needed to keep the monthly aggregates in sync
+    resp = table.put_item(Item=item, ReturnValues='ALL_OLD')
+    query_cache.invalidate(table_name, item[dynamodb_pk])
+    return resp
+
+def aggregate_day(day):
+    # e.g. 2025/03/01 -> aggregate#2025/03
+    return f"{aggregate_prefix}{day[:7]}"
+
+def aggregate_changes(item, sign=1):
+    # Totals and counts per type and transactionType, e.g. actual_deposit_total,
+    # plus delta = actual net cash flow - projected net cash flow
+    transaction_type = item.get('transactionType', 'deposit')
+    amount = Decimal(str(item['transactionAmount'])) * sign
+    flow = amount if transaction_type == 'deposit' else -amount
+    return {
+        f"{item['type']}_{transaction_type}_total": amount,
+        f"{item['type']}_{transaction_type}_count": Decimal(sign),
+        'delta': flow if item['type'] == 'actual' else -flow
+    }
+
+def update_monthly_aggregates(table_name, pk_field, sk_field, new_item=None, old_item=None):
+    # Applies a transaction write (new_item replacing old_item) to the month's
+    # aggregate row with a single atomic ADD update
+    changes = {}
+    for item, sign in ((new_item, 1), (old_item, -1)):
+        if item and item.get('type') in ('actual', 'projected'):
+            for attr, value in aggregate_changes(item, sign).items():
+                changes[attr] = changes.get(attr, Decimal(0)) + value
+    if not changes:
+        return None
+
+    item = new_item or old_item
+    table = get_table(table_name)
+    resp = table.update_item(
+        Key={pk_field: item[pk_field], sk_field: aggregate_day(item[sk_field])},
+        UpdateExpression='ADD ' + ', '.join(f"#a{i} :v{i}" for i in range(len(changes))),
+        ExpressionAttributeNames={f"#a{i}": attr for i, attr in enumerate(changes)},
+        ExpressionAttributeValues={f":v{i}": value for i, value in enumerate(changes.values())}
+    )
+    query_cache.invalidate(table_name, item[pk_field])
     return resp
 
 def read_dynamodb(
@@ -35,91 +115,348 @@ def read_dynamodb(
     sk_field: str=None, 
     sk_value: str=None,
     attr_key: str=None,
-    attr_val: str=None
+    attr_val: str=None,
+    projection: list=None,
+    page_size: int=None,
+    max_items: int=None,
+    index_name: str=None,
+    sk_prefix: bool=False
 ):
+    cache_key = (table_name, pk_value, sk_field, sk_value, attr_key, attr_val,
+                 tuple(projection or ()), max_items, index_name, sk_prefix)
+    items = query_cache.get(cache_key)
+    if items is not None:
+        return items
     try:
+        items = list(iter_dynamodb(table_name, pk_field, pk_value, sk_field, sk_value,
+                                   attr_key, attr_val, projection, page_size, max_items,
+                                   index_name, sk_prefix))
+    except Exception as e:
+        logger.error('query failed', table=table_name, error=repr(e))
+        return None
+    query_cache.put(cache_key, items)
+    return items
 
-        table = dynamodb_resource.Table(table_name)
-        # Create expression
-        if sk_field:
-            key_expression = Key(pk_field).eq(pk_value) & Key(sk_field).eq(sk_value)
-        else:
-            key_expression = Key(pk_field).eq(pk_value)
-
-        if attr_key:
-            attr_expression = Attr(attr_key).eq(attr_val)
-            query_data = table.query(
-                KeyConditionExpression=key_expression,
-                FilterExpression=attr_expression
-            )
-        else:
-            query_data = table.query(
-                KeyConditionExpression=key_expression
-            )
-        
-        return query_data['Items']
-    except Exception:
-        print(f'Error querying table: {table_name}.')
+def batch_read_dynamodb(table_name, keys):
+    # BatchGetItem takes up to 100 keys per request, unprocessed keys are retried
+    items = []
+    for start in range(0, len(keys), 100):
+        request = {table_name: {'Keys': keys[start:start + 100]}}
+        while request:
+            resp = get_dynamodb().batch_get_item(RequestItems=request)
+            items += resp.get('Responses', {}).get(table_name, [])
+            request = resp.get('UnprocessedKeys')
+    return items
 
-def get_projected_transactions(customer_id):
+def iter_dynamodb(
+    table_name: str, 
+    pk_field: str,
+    pk_value: str,
+    sk_field: str=None, 
+    sk_value: str=None,
+    attr_key: str=None,
+    attr_val: str=None,
+    projection: list=None,
+    page_size: int=None,
+    max_items: int=None,
+    index_name: str=None,
+    sk_prefix: bool=False
+):
+    table = get_table(table_name)
+    # Create expression
+    if sk_field and sk_prefix:
+        key_expression = Key(pk_field).eq(pk_value) & Key(sk_field).begins_with(sk_value)
+    elif sk_field:
+        key_expression = Key(pk_field).eq(pk_value) & Key(sk_field).eq(sk_value)
+    else:
+        key_expression = Key(pk_field).eq(pk_value)
+
+    attr_expression = Attr(attr_key).eq(attr_val) if attr_key else None
+
+    # Items are yielded page by page, following LastEvaluatedKey only when needed
+    return iter_query(table, key_expression, attr_expression,
+                      projection=projection, page_size=page_size, max_items=max_items,
+                      index_name=index_name)
+
+def read_transactions_by_type(customer_id, type_val):
+    if type_day_index['name'] in dynamodb_indexes:
+        # Only the items of the requested type are read from the index
+        return read_dynamodb(dynamodb_table,
+                             dynamodb_pk,
+                             customer_id,
+                             index_key_name(type_day_index['sort_key']),
+                             f"{type_val}#",
+                             projection=transaction_fields,
+                             index_name=type_day_index['name'],
+                             sk_prefix=True)
     return read_dynamodb(dynamodb_table, 
                          dynamodb_pk, 
                          customer_id, 
-                         attr_key="type", attr_val="projected")
+                         attr_key="type", attr_val=type_val,
+                         projection=transaction_fields)
+
+@action_group.action()
+def get_projected_transactions(customer_id):
+    return read_transactions_by_type(customer_id, "projected")
 
+@action_group.action()
 def get_historical_transactions(customer_id):
-    return read_dynamodb(dynamodb_table, 
-                         dynamodb_pk, 
-                         customer_id, 
-                         attr_key="type", attr_val="actual")
+    return read_transactions_by_type(customer_id, "actual")
 
-def get_transaction_statistics(customer_id):
+@action_group.action()
+def get_transaction_statistics(customer_id, month=None, year=None):
+    current_date = trunc_datetime(month, year) if month and year else truncated_month
+    # Single aggregate row for the month, whatever the length of the history
+    statistics = read_dynamodb(dynamodb_table, 
+                               dynamodb_pk, 
+                               customer_id, 
+                               dynamodb_sk, 
+                               aggregate_day(current_date.strftime('%Y/%m/%d')))
+    if statistics:
+        return statistics
+    # Tables loaded without aggregates only have the raw item of the month
     return read_dynamodb(dynamodb_table, 
                          dynamodb_pk, 
                          customer_id, 
                          dynamodb_sk, 
-                         truncated_month.strftime('%Y/%m/%d'))
+                         current_date.strftime('%Y/%m/%d'))
 
+@action_group.action()
 def update_projections(customer_id, month, year, amount, transaction_type='deposit'):
     current_date = trunc_datetime(month, year)
     if current_date >= truncated_month:
         item = {
             'customer_id': customer_id,
             'day': current_date.strftime('%Y/%m/%d'),
-            'transactionAmount': Decimal(amount),
+            'transactionAmount': Decimal(str(amount)),
             'type': 'projected',
             'transactionType': transaction_type
         }
-        put_dynamodb(dynamodb_table, item)
+        resp = put_dynamodb(dynamodb_table, add_index_keys(item, [type_day_index]))
+        update_monthly_aggregates(dynamodb_table, dynamodb_pk, dynamodb_sk, item, resp.get('Attributes'))
         return "Projection for day: {} updated for customer: {}".format(current_date.strftime('%Y/%m/%d'), customer_id)
     else:
         return "You're trying to change a past date: {} for customer: {}, which is not allowed".format(current_date.strftime('%Y/%m/%d'), customer_id)
 
-def lambda_handler(event, context):
-    print(event)
-    
-    # name of the function that should be invoked
-    function = event.get('function', '')
-
-    # parameters to invoke function with
-    parameters = event.get('parameters', [])
-    customer_id = get_named_parameter(event, "customer_id")
-
-    if function == 'get_projected_transactions':
-        result = get_projected_transactions(customer_id)
-    elif function == 'get_historical_transactions':
-        result = get_historical_transactions(customer_id)
-    elif function == 'get_transaction_statistics':
-        result = get_transaction_statistics(customer_id)
-    elif function == 'update_projections':
-        month = get_named_parameter(event, "month")
-        year = get_named_parameter(event, "year")
-        amount = get_named_parameter(event, "amount")
-        transaction_type = get_named_parameter(event, "transaction_type") if any(param.get('name') == 'transaction_type' for param in parameters) else 'deposit'
-        result = update_projections(customer_id, month, year, amount, transaction_type)
-    else:
-        result = f"Error, function '{function}' not recognized"
+def month_index(day):
+    # e.g. 2025/03/01 -> 2025 * 12 + 2
+    return int(day[:4]) * 12 + int(day[5:7]) - 1
+
+def month_day(index):
+    return f"{index // 12:04d}/{index % 12 + 1:02d}/01"
+
+def signed_amount(item):
+    amount = float(Decimal(str(item['transactionAmount'])))
+    return amount if item.get('transactionType', 'deposit') == 'deposit' else -amount
 
-    response = populate_function_response(event, result)
-    print(response)
+def history_matrix(histories):
+    """Builds the monthly net cash flow of several customers as one array
+
+    Parameters:
+    - histories: dict of customer_id -> list of actual transaction items
+
+    Returns:
+    - customer_ids, in row order
+    - last_months: month index of each row's last actual month
+    - matrix: one row per customer, right-aligned on each customer's last month,
+      NaN where a month has no transaction
+    """
+    import numpy as np
+
+    customer_ids = [customer_id for customer_id, items in histories.items() if items]
+    rows = np.array([row for row, customer_id in enumerate(customer_ids) for _ in histories[customer_id]])
+    months = np.array([month_index(item['day']) for customer_id in customer_ids for item in histories[customer_id]])
+    amounts = np.array([signed_amount(item) for customer_id in customer_ids for item in histories[customer_id]])
+
+    last_months = np.full(len(customer_ids), months.min())
+    np.maximum.at(last_months, rows, months)
+    first_months = np.full(len(customer_ids), months.max())
+    np.minimum.at(first_months, rows, months)
+    width = int((last_months - first_months).max()) + 1
+
+    # Column of each transaction once its row is aligned on its last month
+    columns = width - 1 - (last_months[rows] - months)
+    totals = np.zeros((len(customer_ids), width))
+    counts = np.zeros((len(customer_ids), width))
+    np.add.at(totals, (rows, columns), amounts)
+    np.add.at(counts, (rows, columns), 1)
+    return customer_ids, last_months, np.where(counts > 0, totals, np.nan)
+
+def project_series(matrix, horizon_months, method='moving_average', window=3, alpha=0.5):
+    """Forecasts every row of a right-aligned history matrix in one vectorized pass
+
+    Returns an array with one row per customer and one column per forecast month.
+    """
+    import numpy as np
+
+    observed = ~np.isnan(matrix)
+    steps = np.arange(1, horizon_months + 1)
+    if method == 'moving_average':
+        # Mean of the last `window` observed months, flat over the horizon
+        level = np.nanmean(matrix[:, -window:], axis=1)
+        return np.repeat(level[:, None], horizon_months, axis=1)
+    elif method == 'exponential_smoothing':
+        level = matrix[:, 0].copy()
+        for column in matrix.T[1:]:
+            smoothed = alpha * column + (1 - alpha) * level
+            level = np.where(np.isnan(level), column, np.where(np.isnan(column), level, smoothed))
+        return np.repeat(level[:, None], horizon_months, axis=1)
+    elif method == 'linear_trend':
+        # Least squares fit of amount over month position, on observed months only
+        t = np.where(observed, np.arange(matrix.shape[1]), 0.0)
+        y = np.where(observed, matrix, 0.0)
+        n = observed.sum(axis=1)
+        sum_t, sum_y = t.sum(axis=1), y.sum(axis=1)
+        denominator = n * (t * t).sum(axis=1) - sum_t ** 2
+        slope = np.divide(n * (t * y).sum(axis=1) - sum_t * sum_y, denominator,
+                          out=np.zeros(len(n)), where=denominator != 0)
+        intercept = (sum_y - slope * sum_t) / n
+        last = matrix.shape[1] - 1
+        return intercept[:, None] + slope[:, None] * (last + steps[None, :])
+    raise ValueError(f"Unknown projection method: {method}")
+
+def history_gap(last_month):
+    # Months between the last actual month and the current month, 0 when the history ends last month
+    current_month = month_index(truncated_month.strftime('%Y/%m/%d'))
+    return max(0, current_month - int(last_month) - 1)
+
+def forecast_length(last_months, horizon_months):
+    # Histories ending before the current month need extra steps to reach it, since past months can't be
+    # projected (same rule as update_projections). Histories past projection_max_gap_months are not projected
+    gaps = [history_gap(last_month) for last_month in last_months]
+    return max([gap for gap in gaps if gap <= projection_max_gap_months], default=0) + horizon_months
+
+def projection_items(customer_id, last_month, forecast, horizon_months, transaction_types=('deposit', 'withdrawal')):
+    """Projected items of the months from the current one, at most horizon_months of them
+
+    The forecast is a net cash flow. Its sign is the transactionType of a month only when the history has
+    transactions of that type: a forecast of a deposits only history falling under zero is a deposit of 0,
+    not a withdrawal. Histories older than projection_max_gap_months get no items.
+    """
+    if history_gap(last_month) > projection_max_gap_months:
+        return []
+    first_month = max(int(last_month) + 1, month_index(truncated_month.strftime('%Y/%m/%d')))
+    items = []
+    for step, value in enumerate(forecast):
+        month = int(last_month) + 1 + step
+        if month < first_month:
+            continue
+        if len(items) == horizon_months:
+            break
+        transaction_type = 'deposit' if value >= 0 else 'withdrawal'
+        if transaction_type not in transaction_types:
+            transaction_type, value = transaction_types[0], 0.0
+        items.append({
+            'customer_id': customer_id,
+            'day': month_day(month),
+            'transactionAmount': Decimal(str(round(abs(float(value)), 2))),
+            'type': 'projected',
+            'transactionType': transaction_type
+        })
+    return items
+
+def transaction_types(history):
+    # Types of the transactions of a history, deposits first
+    types = {item.get('transactionType', 'deposit') for item in history}
+    return tuple(sorted(types)) or ('deposit',)
+
+def write_projections(table_name, pk_field, sk_field, items, old_items=None):
+    # old_items: day -> projected item being replaced, to keep the aggregates in sync
+    table = get_table(table_name)
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=add_index_keys(item, [type_day_index]))
+
+    old_items = old_items or {}
+    for item in items:
+        old_item = old_items.get(item[sk_field])
+        if old_item:
+            old_item = dict(old_item, **{pk_field: item[pk_field], 'type': 'projected'})
+        update_monthly_aggregates(table_name, pk_field, sk_field, item, old_item)
+    for customer_id in {item[pk_field] for item in items}:
+        query_cache.invalidate(table_name, customer_id)
+
+@action_group.action()
+def generate_projections(customer_id, horizon_months=3, method='moving_average'):
+    horizon_months = int(horizon_months or 3)
+    method = method or 'moving_average'
+    if method not in projection_methods:
+        return f"Error, projection method '{method}' not recognized. Use one of: {', '.join(projection_methods)}"
+
+    # The actual history is read once, then projected in memory
+    history = get_historical_transactions(customer_id)
+    if not history:
+        return f"No transaction history found for customer: {customer_id}"
+    try:
+        customer_ids, last_months, matrix = history_matrix({customer_id: history})
+    except ImportError:
+        return "Error, generate_projections needs NumPy in the Lambda environment (e.g. through a Lambda layer)"
+    if history_gap(last_months[0]) > projection_max_gap_months:
+        return (f"The last actual transaction of customer {customer_id} is in {month_day(int(last_months[0]))[:7]}, "
+                f"more than {projection_max_gap_months} months ago: the history is too old to project. "
+                f"Record the recent actual transactions first.")
+    forecast = project_series(matrix, forecast_length(last_months, horizon_months), method)[0]
+
+    items = projection_items(customer_id, last_months[0], forecast, horizon_months, transaction_types(history))
+    old_items = {item['day']: item for item in get_projected_transactions(customer_id) or []}
+    write_projections(dynamodb_table, dynamodb_pk, dynamodb_sk, items, old_items)
+    return {
+        'method': method,
+        'projections': [{'day': item['day'],
+                         'transactionAmount': float(item['transactionAmount']),
+                         'transactionType': item['transactionType']} for item in items]
+    }
+
+@action_group.action()
+def get_transaction_statistics_batch(customer_ids):
+    customer_ids = parse_customer_ids(customer_ids)
+    day = truncated_month.strftime('%Y/%m/%d')
+    # The aggregate row of the month and, for tables loaded without aggregates, the raw item of the month,
+    # as get_transaction_statistics reads them
+    keys = [{dynamodb_pk: customer_id, dynamodb_sk: sort_key}
+            for customer_id in customer_ids for sort_key in (aggregate_day(day), day)]
+    try:
+        items = batch_read_dynamodb(dynamodb_table, keys)
+    except Exception as e:
+        logger.error('batch read failed', table=dynamodb_table, error=repr(e))
+        return None
+
+    statistics = {}
+    # Raw items first, replaced by the aggregate rows
+    for item in sorted(items, key=lambda item: item[dynamodb_sk].startswith(aggregate_prefix)):
+        statistics[item[dynamodb_pk]] = {key: value for key, value in item.items() if key != dynamodb_pk}
+    return {
+        'day': day,
+        'customers': statistics,
+        'missing': [customer_id for customer_id in customer_ids if customer_id not in statistics]
+    }
+
+def summarize_projected_cash_flow(customer_id):
+    items = get_projected_transactions(customer_id)
+    if items is None:
+        return None
+    net = Decimal(0)
+    for item in items:
+        amount = Decimal(str(item['transactionAmount']))
+        net += amount if item.get('transactionType', 'deposit') == 'deposit' else -amount
+    return {'net': float(net), 'months': len(items)}
+
+@action_group.action()
+def get_projected_cash_flow_batch(customer_ids):
+    customer_ids = parse_customer_ids(customer_ids)
+    # One query per customer, bounded by batch_max_workers
+    with ThreadPoolExecutor(max_workers=batch_max_workers) as executor:
+        summaries = dict(zip(customer_ids, executor.map(summarize_projected_cash_flow, customer_ids)))
+
+    cash_flow = {customer_id: summary for customer_id, summary in summaries.items() if summary is not None}
+    return {
+        'customers': cash_flow,
+        'negative': sorted((customer_id for customer_id, summary in cash_flow.items() if summary['net'] < 0),
+                           key=lambda customer_id: cash_flow[customer_id]['net']),
+        'errors': [customer_id for customer_id, summary in summaries.items() if summary is None]
+    }
+
+def lambda_handler(event, context):
+    response = action_group.handle(event)
+    logger.debug('query cache', **query_cache.stats())
     return response
@@ -0,0 +1,108 @@
+"""Regenerates the projections of every customer in the analytics table in one batch run.
+
+The table is read with a parallel scan (one segment per process), every customer's
+history is projected in a single vectorized pass, and the projections are written
+back with batch writers, again spread across processes. Run it from this folder:
+
+    python regenerate_projections.py --table analytics-<suffix>-table --horizon 3 --method linear_trend --processes 4
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from boto3.dynamodb.conditions import Attr
+from utils.client_helper import get_table
+from utils.dynamodb_helper import scan_pages
+
+import financial_analytics
+
+
+def scan_segment(table_name, segment, total_segments):
+    # Each process reads one segment of the table: customer_id -> {'actual': [...], 'projected': [...]}
+    table = get_table(table_name)
+    histories = {}
+    for page in scan_pages(table,
+                           Attr('type').is_in(['actual', 'projected']),
+                           projection=['customer_id', 'day', 'transactionAmount', 'transactionType', 'type'],
+                           segment=segment,
+                           total_segments=total_segments):
+        for item in page:
+            customer = histories.setdefault(item['customer_id'], {'actual': [], 'projected': []})
+            customer[item['type']].append(item)
+    return histories
+
+
+def write_chunk(table_name, pk_field, sk_field, chunk):
+    # chunk: list of (new projected items, day -> projected item being replaced)
+    count = 0
+    for items, old_items in chunk:
+        financial_analytics.write_projections(table_name, pk_field, sk_field, items, old_items)
+        count += len(items)
+    return count
+
+
+def regenerate_projections(table_name, pk_field, sk_field, horizon_months, method, processes):
+    start = time.perf_counter()
+    # boto3 sessions are not fork safe, each worker builds its own
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        histories = {}
+        for segment in executor.map(scan_segment, [table_name] * processes, range(processes), [processes] * processes):
+            for customer_id, customer in segment.items():
+                merged = histories.setdefault(customer_id, {'actual': [], 'projected': []})
+                merged['actual'] += customer['actual']
+                merged['projected'] += customer['projected']
+        read_time = time.perf_counter() - start
+        if not any(customer['actual'] for customer in histories.values()):
+            print(f"No transaction history found in table: {table_name}")
+            return
+
+        customer_ids, last_months, matrix = financial_analytics.history_matrix(
+            {customer_id: customer['actual'] for customer_id, customer in histories.items()}
+        )
+        forecasts = financial_analytics.project_series(
+            matrix, financial_analytics.forecast_length(last_months, horizon_months), method
+        )
+        project_time = time.perf_counter() - start - read_time
+
+        # Histories older than projection_max_gap_months are left as they are
+        stale = sum(financial_analytics.history_gap(last_month) > financial_analytics.projection_max_gap_months
+                    for last_month in last_months)
+        work = [
+            (financial_analytics.projection_items(customer_id, last_month, forecast, horizon_months,
+                                                  financial_analytics.transaction_types(
+                                                      histories[customer_id]['actual'])),
+             {item['day']: item for item in histories[customer_id]['projected']})
+            for customer_id, last_month, forecast in zip(customer_ids, last_months, forecasts)
+        ]
+        chunks = [work[i::processes] for i in range(processes)]
+        written = sum(executor.map(write_chunk, [table_name] * processes, [pk_field] * processes,
+                                   [sk_field] * processes, chunks))
+
+    elapsed = time.perf_counter() - start
+    print(f"Customers projected: {len(customer_ids) - stale}, projections written: {written}")
+    if stale:
+        print(f"Customers skipped, last actual transaction more than "
+              f"{financial_analytics.projection_max_gap_months} months ago: {stale}")
+    print(f"Read: {read_time:.2f}s, project: {project_time:.3f}s, total: {elapsed:.2f}s "
+          f"({len(customer_ids) / elapsed:,.0f} customers/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--table", required=True, help="analytics DynamoDB table name")
+    parser.add_argument("--pk", default="customer_id", help="partition key attribute")
+    parser.add_argument("--sk", default="day", help="sort key attribute")
+    parser.add_argument("--horizon", type=int, default=3, help="number of months to project")
+    parser.add_argument("--method", default="moving_average", choices=financial_analytics.projection_methods)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    regenerate_projections(args.table, args.pk, args.sk, args.horizon, args.method, args.processes)
@@ -1,78 +1,32 @@
 import os
 import json
-import uuid
-import boto3
 
-from boto3.dynamodb.conditions import Key, Attr
-from datetime import datetime
-from decimal import Decimal
+# boto3 and uuid are imported by the functions that use them: the explain_* functions
+# are pure computations and should not pay for them on a cold start
+from utils.client_helper import get_table
+from utils.dynamodb_helper import iter_query
+from utils.action_group_helper import ActionGroup
+from utils.explanation_cache import ExplanationCache
+from utils.log_helper import logger
+from utils.response_helper import DEFAULT_MAX_CHARS, compact_response, fit_texts
+from utils.metrics_kernel import MAX_LISTED_POINTS, column_metrics, listed, to_columns, variances
+from utils.visualization_parser import parse_visualization
 
-dynamodb_resource = boto3.resource('dynamodb')
 dynamodb_table = os.getenv('dynamodb_table')
 dynamodb_pk = os.getenv('dynamodb_pk')
 dynamodb_sk = os.getenv('dynamodb_sk')
+# Attributes returned to the agent for ticket listings
+ticket_fields = ['ticket_id', 'description', 'status', 'type']
+# Functions exposed to the agent, registered with @action_group.action()
+action_group = ActionGroup()
+# Explanations served again to dashboards reopening a visualization, see utils.explanation_cache
+explanation_cache = ExplanationCache.from_env(dynamodb_table, dynamodb_pk, dynamodb_sk)
+# Bounded fan-out for explain_dashboard
+batch_max_workers = int(os.getenv('batch_max_workers', 8))
 
-# Define the lambda_handler function at the top level to ensure it's properly exposed
-def lambda_handler(event, context):
-    print(event)
-    
-    # name of the function that should be invoked
-    function = event.get('function', '')
-
-    # parameters to invoke function with
-    parameters = event.get('parameters', [])
-    customer_id = get_named_parameter(event, "customer_id")
-
-    if function == 'explain_visualization':
-        visualization_type = get_named_parameter(event, "visualization_type")
-        data = get_named_parameter(event, "data")
-        additional_context = get_named_parameter(event, "additional_context")
-        result = explain_visualization(data, visualization_type, customer_id, additional_context)
-    elif function == 'explain_spending_trend':
-        data = get_named_parameter(event, "data")
-        additional_context = get_named_parameter(event, "additional_context")
-        result = explain_spending_trend(data, customer_id, additional_context)
-    elif function == 'explain_investment_allocation':
-        data = get_named_parameter(event, "data")
-        additional_context = get_named_parameter(event, "additional_context")
-        result = explain_investment_allocation(data, customer_id, additional_context)
-    elif function == 'explain_cash_flow':
-        data = get_named_parameter(event, "data")
-        additional_context = get_named_parameter(event, "additional_context")
-        result = explain_cash_flow(data, customer_id, additional_context)
-    elif function == 'explain_budget_performance':
-        data = get_named_parameter(event, "data")
-        additional_context = get_named_parameter(event, "additional_context")
-        result = explain_budget_performance(data, customer_id, additional_context)
-    elif function == 'recommend_financial_products':
-        visualization_type = get_named_parameter(event, "visualization_type")
-        data = get_named_parameter(event, "data")
-        result = recommend_financial_products(visualization_type, data, customer_id)
-    elif function == 'create_support_ticket':
-        description = get_named_parameter(event, "description")
-        result = create_support_ticket(customer_id, description)
-    elif function == 'get_support_tickets':
-        ticket_id = get_named_parameter(event, "ticket_id")
-        result = get_support_tickets(customer_id, ticket_id)
-    else:
-        result = f"Error, function '{function}' not recognized"
-
-    response = populate_function_response(event, result)
-    print(response)
-    return response
-
-def get_named_parameter(event, name):
-    try:
-        return next(item for item in event['parameters'] if item['name'] == name)['value']
-    except:
-        return None
-    
-def populate_function_response(event, response_body):
-    return {'response': {'actionGroup': event['actionGroup'], 'function': event['function'],
-                'functionResponse': {'responseBody': {'TEXT': {'body': str(response_body)}}}}}
 
 def put_dynamodb(table_name, item):
-    table = dynamodb_resource.Table(table_name)
+    table = get_table(table_name)
     resp = table.put_item(Item=item)
     return resp
 
@@ -83,31 +37,46 @@ def read_dynamodb(
     sk_field: str=None, 
     sk_value: str=None,
     attr_key: str=None,
-    attr_val: str=None
+    attr_val: str=None,
+    projection: list=None,
+    page_size: int=None,
+    max_items: int=None
 ):
     try:
-        table = dynamodb_resource.Table(table_name)
-        # Create expression
-        if sk_field:
-            key_expression = Key(pk_field).eq(pk_value) & Key(sk_field).eq(sk_value)
-        else:
-            key_expression = Key(pk_field).eq(pk_value)
+        return list(iter_dynamodb(table_name, pk_field, pk_value, sk_field, sk_value,
+                                  attr_key, attr_val, projection, page_size, max_items))
+    except Exception as e:
+        logger.error('query failed', table=table_name, error=repr(e))
 
-        if attr_key:
-            attr_expression = Attr(attr_key).eq(attr_val)
-            query_data = table.query(
-                KeyConditionExpression=key_expression,
-                FilterExpression=attr_expression
-            )
-        else:
-            query_data = table.query(
-                KeyConditionExpression=key_expression
-            )
-        
-        return query_data['Items']
-    except Exception:
-        print(f'Error querying table: {table_name}.')
+def iter_dynamodb(
+    table_name: str, 
+    pk_field: str,
+    pk_value: str,
+    sk_field: str=None, 
+    sk_value: str=None,
+    attr_key: str=None,
+    attr_val: str=None,
+    projection: list=None,
+    page_size: int=None,
+    max_items: int=None
+):
+    from boto3.dynamodb.conditions import Key, Attr
+
+    table = get_table(table_name)
+    # Create expression
+    if sk_value:
+        key_expression = Key(pk_field).eq(pk_value) & Key(sk_field).eq(sk_value)
+    else:
+        key_expression = Key(pk_field).eq(pk_value)
+
+    attr_expression = Attr(attr_key).eq(attr_val) if attr_key else None
 
+    # Items are yielded page by page, following LastEvaluatedKey only when needed
+    return iter_query(table, key_expression, attr_expression,
+                      projection=projection, page_size=page_size, max_items=max_items)
+
+@action_group.action()
+@explanation_cache.memoize
 def explain_visualization(data, visualization_type=None, customer_id=None, additional_context=None):
     """
     Main function to explain a financial visualization based on its underlying data
@@ -124,7 +93,7 @@ def explain_visualization(data, visualization_type=None, customer_id=None, addit
     # Parse the data if it's a string
     if isinstance(data, str):
         try:
-            data = json.loads(data)
+            data = parse_visualization(data)
         except json.JSONDecodeError:
             return "Error: Unable to parse the visualization data. Please ensure it's valid JSON."
     
@@ -148,9 +117,69 @@ def explain_visualization(data, visualization_type=None, customer_id=None, addit
     else:
         return f"I don't have an explanation model for {visualization_type} visualizations yet."
 
+def parse_visualizations(visualizations):
+    # Accepts a JSON array of visualizations, or an object holding it under "visualizations"
+    if isinstance(visualizations, str):
+        visualizations = json.loads(visualizations)
+    if isinstance(visualizations, dict):
+        visualizations = visualizations.get('visualizations', [visualizations])
+    return [json.loads(visualization) if isinstance(visualization, str) else visualization
+            for visualization in visualizations]
+
+@action_group.action()
+def explain_dashboard(visualizations, customer_id=None, additional_context=None):
+    """
+    Explains every visualization of a dashboard in one call, instead of one call per chart
+    
+    Parameters:
+    - visualizations: JSON array of visualizations, each one the data of explain_visualization
+      with its visualization_id and visualization_type
+    - customer_id: Optional customer ID of the visualizations that do not name one
+    - additional_context: Any additional context about the dashboard
+    
+    Returns:
+    - explanations keyed by visualization_id, the visualization_ids whose explanation failed, and those
+      left out (truncated) when the explanations do not fit the response budget
+    """
+    try:
+        visualizations = parse_visualizations(visualizations)
+    except (json.JSONDecodeError, TypeError):
+        return "Error: Unable to parse the visualizations. Please send them as a JSON array."
+    
+    def explain(visualization):
+        if not isinstance(visualization, dict):
+            return "Error: Each visualization must be a JSON object."
+        return explain_visualization(visualization, customer_id=visualization.get('customer_id', customer_id),
+                                     additional_context=additional_context)
+    
+    visualization_ids = [str(visualization.get('visualization_id') or f"visualization_{i + 1}")
+                         if isinstance(visualization, dict) else f"visualization_{i + 1}"
+                         for i, visualization in enumerate(visualizations)]
+    # Explanations are computed side by side, bounded by batch_max_workers. Imported here, like boto3,
+    # to keep concurrent.futures out of the cold start of the other functions
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=batch_max_workers) as executor:
+        explanations = dict(zip(visualization_ids, executor.map(explain, visualizations)))
+    errors = [visualization_id for visualization_id, explanation in explanations.items()
+              if explanation.startswith('Error')]
+    
+    # The explanations share the response budget: shortened, and the last ones dropped and listed under
+    # truncated when they do not fit, rather than the JSON being cut by compact_response
+    reserved = len(compact_response({'explanations': {}, 'errors': errors, 'truncated': visualization_ids}))
+    explanations, truncated = fit_texts(explanations, DEFAULT_MAX_CHARS - reserved)
+    result = {'explanations': explanations, 'errors': errors}
+    if truncated:
+        result['truncated'] = truncated
+    return result
+
+@action_group.action()
 def explain_spending_trend(data, customer_id=None, additional_context=None):
     """Generate explanation for a spending trend visualization"""
     try:
+        # Parse data if it's a string
+        if isinstance(data, str):
+            data = parse_visualization(data)
+
         # Extract key data points
         data_points = data.get('data_points', [])
         categories = data.get('categories', [])
@@ -159,29 +188,21 @@ def explain_spending_trend(data, customer_id=None, additional_context=None):
         if not data_points:
             return "This spending trend visualization doesn't contain any data points to analyze."
         
-        # Calculate key metrics
-        amounts = [point.get('amount', 0) for point in data_points]
-        total_spending = sum(amounts)
-        average_spending = total_spending / len(amounts) if amounts else 0
-        min_spending = min(amounts) if amounts else 0
-        max_spending = max(amounts) if amounts else 0
+        # Calculate key metrics, trend and anomalies (points 30% off the average) in one pass
+        amounts = column_metrics(to_columns(data_points, ['amount']))['amount']
+        total_spending = amounts['total']
+        average_spending = amounts['mean']
+        min_spending = amounts['min']
+        max_spending = amounts['max']
         
         # Find trends
         trend_direction = "stable"
-        if len(amounts) > 1:
-            if amounts[-1] > amounts[0] * 1.1:  # 10% increase
+        if amounts['count'] > 1:
+            if amounts['last'] > amounts['first'] * 1.1:  # 10% increase
                 trend_direction = "increasing"
-            elif amounts[-1] < amounts[0] * 0.9:  # 10% decrease
+            elif amounts['last'] < amounts['first'] * 0.9:  # 10% decrease
                 trend_direction = "decreasing"
         
-        # Find anomalies (values that deviate significantly from the average)
-        anomalies = []
-        for i, amount in enumerate(amounts):
-            if amount > average_spending * 1.3:  # 30% above average
-                anomalies.append((i, "significantly higher"))
-            elif amount < average_spending * 0.7:  # 30% below average
-                anomalies.append((i, "significantly lower"))
-        
         # Generate explanation
         explanation = f"This spending trend visualization for customer {customer_id} shows their spending patterns over the past {time_period.replace('_', ' ')}.\n\n"
         
@@ -190,21 +211,25 @@ def explain_spending_trend(data, customer_id=None, additional_context=None):
         explanation += f"They spent a total of ${total_spending:,.2f}, with an average monthly spending of ${average_spending:,.2f}. "
         explanation += f"Their spending ranged from ${min_spending:,.2f} to ${max_spending:,.2f}.\n\n"
         
-        # Anomalies
-        if anomalies:
+        # Anomalies, the most extreme ones first when there are too many to list
+        if amounts['anomalies']:
             explanation += "Notable spending patterns:\n"
-            for idx, description in anomalies:
+            for idx in amounts['anomalies']:
+                amount = amounts['values'][idx]
+                description = "significantly higher" if amount > average_spending else "significantly lower"
                 month = data_points[idx].get('month', f"period {idx+1}")
-                explanation += f"- {month}: ${amounts[idx]:,.2f} ({description} than average)\n"
+                explanation += f"- {month}: ${amount:,.2f} ({description} than average)\n"
+            explanation += listed(amounts['anomaly_count'])
             explanation += "\n"
         
         # Category breakdown if available
         if categories:
             explanation += "Spending by category:\n"
-            for category in categories:
+            for category in categories[:MAX_LISTED_POINTS]:
                 name = category.get('name', 'Unknown')
                 percentage = category.get('percentage', 0)
                 explanation += f"- {name}: {percentage}% of total spending\n"
+            explanation += listed(len(categories))
             explanation += "\n"
         
         # Insights and recommendations
@@ -224,9 +249,14 @@ def explain_spending_trend(data, customer_id=None, additional_context=None):
     except Exception as e:
         return f"Error analyzing spending trend visualization: {str(e)}"
 
+@action_group.action()
 def explain_investment_allocation(data, customer_id=None, additional_context=None):
     """Generate explanation for an investment allocation visualization"""
     try:
+        # Parse data if it's a string
+        if isinstance(data, str):
+            data = parse_visualization(data)
+
         # Extract key data points
         data_points = data.get('data_points', [])
         
@@ -234,18 +264,13 @@ def explain_investment_allocation(data, customer_id=None, additional_context=Non
             return "This investment allocation visualization doesn't contain any data points to analyze."
         
         # Calculate diversification metrics
-        total_allocation = sum(point.get('percentage', 0) for point in data_points)
-        largest_allocation = max(point.get('percentage', 0) for point in data_points)
-        largest_asset = next((point.get('asset_class', 'Unknown') for point in data_points 
-                             if point.get('percentage', 0) == largest_allocation), 'Unknown')
+        percentages = column_metrics(to_columns(data_points, ['percentage']))['percentage']
+        largest_allocation = percentages['max']
+        largest_asset = data_points[percentages['argmax']].get('asset_class', 'Unknown')
         
         # Determine risk profile
-        stocks_percentage = next((point.get('percentage', 0) for point in data_points 
-                                 if point.get('asset_class', '').lower() == 'stocks'), 0)
-        bonds_percentage = next((point.get('percentage', 0) for point in data_points 
-                                if point.get('asset_class', '').lower() == 'bonds'), 0)
-        cash_percentage = next((point.get('percentage', 0) for point in data_points 
-                               if point.get('asset_class', '').lower() == 'cash'), 0)
+        stocks_percentage = next((percentage for point, percentage in zip(data_points, percentages['values'])
+                                  if str(point.get('asset_class', '')).lower() == 'stocks'), 0)
         
         if stocks_percentage > 70:
             risk_profile = "aggressive"
@@ -262,14 +287,15 @@ def explain_investment_allocation(data, customer_id=None, additional_context=Non
         explanation = f"This investment allocation visualization for customer {customer_id} shows how their portfolio is distributed across different asset classes.\n\n"
         
         # Overall allocation
-        explanation += f"The portfolio has a {risk_profile} risk profile, with the largest allocation ({largest_allocation}%) in {largest_asset}.\n\n"
+        explanation += f"The portfolio has a {risk_profile} risk profile, with the largest allocation ({largest_allocation:g}%) in {largest_asset}.\n\n"
         
         # Detailed breakdown
         explanation += "Asset allocation breakdown:\n"
-        for point in data_points:
+        for point in data_points[:MAX_LISTED_POINTS]:
             asset_class = point.get('asset_class', 'Unknown')
             percentage = point.get('percentage', 0)
             explanation += f"- {asset_class}: {percentage}%\n"
+        explanation += listed(len(data_points))
         explanation += "\n"
         
         # Insights and recommendations
@@ -277,7 +303,7 @@ def explain_investment_allocation(data, customer_id=None, additional_context=Non
         
         # Diversification assessment
         if largest_allocation > 60:
-            explanation += f"- The portfolio is relatively concentrated, with {largest_allocation}% in {largest_asset}.\n"
+            explanation += f"- The portfolio is relatively concentrated, with {largest_allocation:g}% in {largest_asset}.\n"
             explanation += "- Consider diversifying to reduce risk exposure to a single asset class.\n"
         else:
             explanation += "- The portfolio shows good diversification across multiple asset classes.\n"
@@ -299,9 +325,14 @@ def explain_investment_allocation(data, customer_id=None, additional_context=Non
     except Exception as e:
         return f"Error analyzing investment allocation visualization: {str(e)}"
 
+@action_group.action()
 def explain_cash_flow(data, customer_id=None, additional_context=None):
     """Generate explanation for a cash flow visualization"""
     try:
+        # Parse data if it's a string
+        if isinstance(data, str):
+            data = parse_visualization(data)
+
         # Extract key data points
         data_points = data.get('data_points', [])
         time_period = data.get('time_period', '3_months')
@@ -310,29 +341,20 @@ def explain_cash_flow(data, customer_id=None, additional_context=None):
             return "This cash flow visualization doesn't contain any data points to analyze."
         
         # Calculate key metrics
-        total_income = sum(point.get('income', 0) for point in data_points)
-        total_expenses = sum(point.get('expenses', 0) for point in data_points)
+        cash_flow = column_metrics(to_columns(data_points, ['income', 'expenses']))
+        income, expenses = cash_flow['income'], cash_flow['expenses']
+        total_income = income['total']
+        total_expenses = expenses['total']
         net_cash_flow = total_income - total_expenses
         saving_rate = (net_cash_flow / total_income) * 100 if total_income > 0 else 0
         
-        # Analyze monthly patterns
-        monthly_savings = []
-        for point in data_points:
-            month = point.get('month', 'Unknown')
-            income = point.get('income', 0)
-            expenses = point.get('expenses', 0)
-            savings = income - expenses
-            saving_percentage = (savings / income) * 100 if income > 0 else 0
-            monthly_savings.append((month, savings, saving_percentage))
-        
-        # Determine cash flow trend
-        if len(monthly_savings) > 1:
-            if monthly_savings[-1][1] > monthly_savings[0][1]:
-                trend = "improving"
-            elif monthly_savings[-1][1] < monthly_savings[0][1]:
-                trend = "declining"
-            else:
-                trend = "stable"
+        # Determine cash flow trend from the savings of the first and last months
+        first_savings = income['first'] - expenses['first']
+        last_savings = income['last'] - expenses['last']
+        if last_savings > first_savings:
+            trend = "improving"
+        elif last_savings < first_savings:
+            trend = "declining"
         else:
             trend = "stable"
         
@@ -347,14 +369,23 @@ def explain_cash_flow(data, customer_id=None, additional_context=None):
             explanation += f"Overall, the customer has a negative cash flow of ${abs(net_cash_flow):,.2f}, "
             explanation += "meaning they're spending more than they earn.\n\n"
         
-        # Monthly breakdown
-        explanation += "Monthly breakdown:\n"
-        for month, savings, saving_percentage in monthly_savings:
+        # Monthly breakdown, of the most recent months when there are too many to list
+        first_listed = max(0, len(data_points) - MAX_LISTED_POINTS)
+        if first_listed:
+            explanation += f"Monthly breakdown (last {MAX_LISTED_POINTS} of {len(data_points):,} months):\n"
+        else:
+            explanation += "Monthly breakdown:\n"
+        for idx in range(first_listed, len(data_points)):
+            month = data_points[idx].get('month', 'Unknown')
+            month_income = income['values'][idx]
+            month_expenses = expenses['values'][idx]
+            savings = month_income - month_expenses
+            saving_percentage = (savings / month_income) * 100 if month_income > 0 else 0
             if savings >= 0:
-                explanation += f"- {month}: Income ${point.get('income', 0):,.2f}, Expenses ${point.get('expenses', 0):,.2f}, "
+                explanation += f"- {month}: Income ${month_income:,.2f}, Expenses ${month_expenses:,.2f}, "
                 explanation += f"Savings ${savings:,.2f} ({saving_percentage:.1f}% of income)\n"
             else:
-                explanation += f"- {month}: Income ${point.get('income', 0):,.2f}, Expenses ${point.get('expenses', 0):,.2f}, "
+                explanation += f"- {month}: Income ${month_income:,.2f}, Expenses ${month_expenses:,.2f}, "
                 explanation += f"Deficit ${abs(savings):,.2f}\n"
         explanation += "\n"
         
@@ -386,33 +417,32 @@ def explain_cash_flow(data, customer_id=None, additional_context=None):
     except Exception as e:
         return f"Error analyzing cash flow visualization: {str(e)}"
 
+@action_group.action()
 def explain_budget_performance(data, customer_id=None, additional_context=None):
     """Generate explanation for a budget performance visualization"""
     try:
+        # Parse data if it's a string
+        if isinstance(data, str):
+            data = parse_visualization(data)
+
         # Extract key data points
         data_points = data.get('data_points', [])
         
         if not data_points:
             return "This budget performance visualization doesn't contain any data points to analyze."
         
-        # Calculate key metrics
-        total_planned = sum(point.get('planned', 0) for point in data_points)
-        total_actual = sum(point.get('actual', 0) for point in data_points)
+        # Calculate key metrics and the variance of every category
+        columns = to_columns(data_points, ['planned', 'actual'])
+        budget = variances(columns['planned'], columns['actual'])
+        total_planned = budget['total_planned']
+        total_actual = budget['total_actual']
         overall_variance = total_actual - total_planned
         variance_percentage = (overall_variance / total_planned) * 100 if total_planned > 0 else 0
         
-        # Analyze category variances
-        category_variances = []
-        for point in data_points:
-            category = point.get('category', 'Unknown')
-            planned = point.get('planned', 0)
-            actual = point.get('actual', 0)
-            variance = actual - planned
-            variance_pct = (variance / planned) * 100 if planned > 0 else 0
-            category_variances.append((category, planned, actual, variance, variance_pct))
-        
-        # Sort categories by absolute variance percentage
-        category_variances.sort(key=lambda x: abs(x[4]), reverse=True)
+        # Categories over 10% off their plan, by absolute variance percentage
+        def category_variance(idx):
+            return (data_points[idx].get('category', 'Unknown'), columns['planned'][idx], columns['actual'][idx],
+                    budget['variance'][idx], budget['variance_pct'][idx])
         
         # Generate explanation
         explanation = f"This budget performance visualization for customer {customer_id} compares planned versus actual spending across different categories.\n\n"
@@ -429,16 +459,17 @@ def explain_budget_performance(data, customer_id=None, additional_context=None):
         
         # Categories with significant variances
         explanation += "Categories with significant variances:\n"
-        significant_variances = [v for v in category_variances if abs(v[4]) > 10]  # >10% variance
         
-        if significant_variances:
-            for category, planned, actual, variance, variance_pct in significant_variances:
+        if len(budget['significant']):
+            for idx in budget['significant'][:MAX_LISTED_POINTS]:
+                category, planned, actual, variance, variance_pct = category_variance(idx)
                 if variance_pct > 0:
                     explanation += f"- {category}: ${actual:,.2f} spent vs. ${planned:,.2f} planned "
                     explanation += f"(${variance:,.2f} or {variance_pct:.1f}% over budget)\n"
                 else:
                     explanation += f"- {category}: ${actual:,.2f} spent vs. ${planned:,.2f} planned "
                     explanation += f"(${abs(variance):,.2f} or {abs(variance_pct):.1f}% under budget)\n"
+            explanation += listed(len(budget['significant']))
         else:
             explanation += "- No categories showed significant variance from the budget.\n"
         explanation += "\n"
@@ -458,17 +489,15 @@ def explain_budget_performance(data, customer_id=None, additional_context=None):
             explanation += "- Continue monitoring to maintain this performance.\n"
         
         # Category-specific insights
-        if significant_variances:
-            over_budget = [v for v in significant_variances if v[4] > 0]
-            if over_budget:
-                worst_category = over_budget[0]
+        if len(budget['significant']):
+            if len(budget['over']):
+                worst_category = category_variance(budget['over'][0])
                 explanation += f"- The {worst_category[0]} category shows the largest over-budget spending "
                 explanation += f"({worst_category[4]:.1f}%).\n"
                 explanation += "- Consider strategies to better control spending in this area.\n"
             
-            under_budget = [v for v in significant_variances if v[4] < 0]
-            if under_budget:
-                most_under = under_budget[0]
+            if len(budget['under']):
+                most_under = category_variance(budget['under'][0])
                 explanation += f"- The {most_under[0]} category is significantly under budget "
                 explanation += f"({abs(most_under[4]):.1f}%).\n"
                 explanation += "- Consider whether this represents savings or delayed expenses.\n"
@@ -478,6 +507,7 @@ def explain_budget_performance(data, customer_id=None, additional_context=None):
     except Exception as e:
         return f"Error analyzing budget performance visualization: {str(e)}"
 
+@action_group.action()
 def recommend_financial_products(visualization_type, data, customer_id=None):
     """Recommend financial products based on visualization insights"""
     try:
@@ -603,8 +633,11 @@ def recommend_financial_products(visualization_type, data, customer_id=None):
     except Exception as e:
         return f"Error generating product recommendations: {str(e)}"
 
+@action_group.action()
 def create_support_ticket(customer_id, description):
     """Create a support ticket for visualization explanation assistance"""
+    import uuid
+
     ticket_id = str(uuid.uuid1())
     item = {
         'ticket_id': ticket_id,
@@ -614,62 +647,19 @@ def create_support_ticket(customer_id, description):
         'type': 'visualization_explanation'
     }
     resp = put_dynamodb(dynamodb_table, item)
-    print(resp)
+    logger.debug('ticket created', response=resp.get('ResponseMetadata'))
     return f"Support ticket created for customer {customer_id}. A financial advisor will review the visualization and provide a detailed explanation. Ticket ID: {ticket_id}"
 
+@action_group.action()
 def get_support_tickets(customer_id, ticket_id=None):
     """Get support tickets for a customer"""
     return read_dynamodb(dynamodb_table, 
                          dynamodb_pk,
                          customer_id,
                          dynamodb_sk,
-                         ticket_id)
+                         ticket_id,
+                         projection=ticket_fields)
 
 # This is the main Lambda handler function that AWS Lambda will call
 def lambda_handler(event, context):
-    print(event)
-    
-    # name of the function that should be invoked
-    function = event.get('function', '')
-
-    # parameters to invoke function with
-    parameters = event.get('parameters', [])
-    customer_id = get_named_parameter(event, "customer_id")
-
-    if function == 'explain_visualization':
-        visualization_type = get_named_parameter(event, "visualization_type")
-        data = get_named_parameter(event, "data")
-        additional_context = get_named_parameter(event, "additional_context")
-        result = explain_visualization(data, visualization_type, customer_id, additional_context)
-    elif function == 'explain_spending_trend':
-        data = get_named_parameter(event, "data")
-        additional_context = get_named_parameter(event, "additional_context")
-        result = explain_spending_trend(data, customer_id, additional_context)
-    elif function == 'explain_investment_allocation':
-        data = get_named_parameter(event, "data")
-        additional_context = get_named_parameter(event, "additional_context")
-        result = explain_investment_allocation(data, customer_id, additional_context)
-    elif function == 'explain_cash_flow':
-        data = get_named_parameter(event, "data")
-        additional_context = get_named_parameter(event, "additional_context")
-        result = explain_cash_flow(data, customer_id, additional_context)
-    elif function == 'explain_budget_performance':
-        data = get_named_parameter(event, "data")
-        additional_context = get_named_parameter(event, "additional_context")
-        result = explain_budget_performance(data, customer_id, additional_context)
-    elif function == 'recommend_financial_products':
-        visualization_type = get_named_parameter(event, "visualization_type")
-        data = get_named_parameter(event, "data")
-        result = recommend_financial_products(visualization_type, data, customer_id)
-    elif function == 'create_support_ticket':
-        description = get_named_parameter(event, "description")
-        result = create_support_ticket(customer_id, description)
-    elif function == 'get_support_tickets':
-        ticket_id = get_named_parameter(event, "ticket_id")
-        result = get_support_tickets(customer_id, ticket_id)
-    else:
-        result = f"Error, function '{function}' not recognized"
-
-    response = populate_function_response(event, result)
-    print(response)
-    return response
+    return action_group.handle(event)
@@ -1,43 +1,49 @@
-import boto3
 import json
 import os
 
-from boto3.dynamodb.conditions import Key, Attr
-from datetime import datetime
-from decimal import Decimal
+# boto3 is only loaded when a table is first read, see utils.client_helper
+from utils.client_helper import get_table
+from utils.dynamodb_helper import iter_query
+from utils.action_group_helper import ActionGroup
+from utils.explanation_cache import ExplanationCache
+from utils.metrics_kernel import MAX_LISTED_POINTS, column_metrics, listed, to_columns, variances
+from utils.recommendation_engine import decision_table
+from utils.response_helper import DEFAULT_MAX_CHARS, compact_response, fit_texts
+from utils.visualization_parser import parse_visualization
 
-dynamodb_resource = boto3.resource('dynamodb')
 dynamodb_table = os.getenv('dynamodb_table')
 dynamodb_pk = os.getenv('dynamodb_pk')
 dynamodb_sk = os.getenv('dynamodb_sk')
+# Functions exposed to the agent, registered with @action_group.action()
+action_group = ActionGroup()
+# Explanations served again to dashboards reopening a visualization, see utils.explanation_cache
+explanation_cache = ExplanationCache.from_env(dynamodb_table, dynamodb_pk, dynamodb_sk)
+# Bounded fan-out for explain_dashboard
+batch_max_workers = int(os.getenv('batch_max_workers', 8))
 
 
-def get_named_parameter(event, name):
-    try:
-        return next(item for item in event['parameters'] if item['name'] == name)['value']
-    except:
-        return None
-    
-def populate_function_response(event, response_body):
-    return {'response': {'actionGroup': event['actionGroup'], 'function': event['function'],
-                'functionResponse': {'responseBody': {'TEXT': {'body': str(response_body)}}}}}
-
 def put_dynamodb(table_name, item):
-    table = dynamodb_resource.Table(table_name)
+    table = get_table(table_name)
     resp = table.put_item(Item=item)
     return resp
 
-def read_dynamodb(table_name, key_condition_expression):
-    table = dynamodb_resource.Table(table_name)
-    resp = table.query(KeyConditionExpression=key_condition_expression)
-    return resp.get('Items', [])
+def read_dynamodb(table_name, key_condition_expression, projection=None, page_size=None, max_items=None):
+    return list(iter_dynamodb(table_name, key_condition_expression, projection, page_size, max_items))
+
+def iter_dynamodb(table_name, key_condition_expression, projection=None, page_size=None, max_items=None):
+    table = get_table(table_name)
+    # Items are yielded page by page, following LastEvaluatedKey only when needed
+    return iter_query(table, key_condition_expression,
+                      projection=projection, page_size=page_size, max_items=max_items)
 
+@action_group.action()
+@explanation_cache.memoize
 def explain_visualization(data, visualization_type=None, customer_id=None, additional_context=None):
     """Main function to explain a financial visualization based on its underlying data"""
     try:
         # Parse data if it's a string
         if isinstance(data, str):
-            data = json.loads(data)
+            data = parse_visualization(data)
             
         # If visualization_type is not provided, try to get it from the data
         if not visualization_type:
@@ -57,13 +63,57 @@ def explain_visualization(data, visualization_type=None, customer_id=None, addit
     except Exception as e:
         return f"Error explaining visualization: {str(e)}"
 
+def parse_visualizations(visualizations):
+    # Accepts a JSON array of visualizations, or an object holding it under "visualizations"
+    if isinstance(visualizations, str):
+        visualizations = json.loads(visualizations)
+    if isinstance(visualizations, dict):
+        visualizations = visualizations.get('visualizations', [visualizations])
+    return [json.loads(visualization) if isinstance(visualization, str) else visualization
+            for visualization in visualizations]
+
+@action_group.action()
+def explain_dashboard(visualizations, customer_id=None, additional_context=None):
+    """Explains every visualization of a dashboard in one call, keyed by visualization_id"""
+    try:
+        visualizations = parse_visualizations(visualizations)
+    except (json.JSONDecodeError, TypeError):
+        return "Error: Unable to parse the visualizations. Please send them as a JSON array."
+    
+    def explain(visualization):
+        if not isinstance(visualization, dict):
+            return "Error explaining visualization: it must be a JSON object."
+        return explain_visualization(visualization, customer_id=visualization.get('customer_id', customer_id),
+                                     additional_context=additional_context)
+    
+    visualization_ids = [str(visualization.get('visualization_id') or f"visualization_{i + 1}")
+                         if isinstance(visualization, dict) else f"visualization_{i + 1}"
+                         for i, visualization in enumerate(visualizations)]
+    # Explanations are computed side by side, bounded by batch_max_workers. Imported here, like boto3,
+    # to keep concurrent.futures out of the cold start of the other functions
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=batch_max_workers) as executor:
+        explanations = dict(zip(visualization_ids, executor.map(explain, visualizations)))
+    errors = [visualization_id for visualization_id, explanation in explanations.items()
+              if explanation.startswith('Error')]
+    
+    # The explanations share the response budget: shortened, and the last ones dropped and listed under
+    # truncated when they do not fit, rather than the JSON being cut by compact_response
+    reserved = len(compact_response({'explanations': {}, 'errors': errors, 'truncated': visualization_ids}))
+    explanations, truncated = fit_texts(explanations, DEFAULT_MAX_CHARS - reserved)
+    result = {'explanations': explanations, 'errors': errors}
+    if truncated:
+        result['truncated'] = truncated
+    return result
+
 
+@action_group.action()
 def explain_spending_trend(data, customer_id=None, additional_context=None):
     """Generate explanation for a spending trend visualization"""
     try:
         # Parse data if it's a string
         if isinstance(data, str):
-            data = json.loads(data)
+            data = parse_visualization(data)
             
         # Extract key data points
         data_points = data.get('data_points', [])
@@ -73,29 +123,21 @@ def explain_spending_trend(data, customer_id=None, additional_context=None):
         if not data_points:
             return "This spending trend visualization doesn't contain any data points to analyze."
         
-        # Calculate key metrics
-        amounts = [point.get('amount', 0) for point in data_points]
-        total_spending = sum(amounts)
-        average_spending = total_spending / len(amounts) if amounts else 0
-        min_spending = min(amounts) if amounts else 0
-        max_spending = max(amounts) if amounts else 0
+        # Calculate key metrics, trend and anomalies (points 30% off the average) in one pass
+        amounts = column_metrics(to_columns(data_points, ['amount']))['amount']
+        total_spending = amounts['total']
+        average_spending = amounts['mean']
+        min_spending = amounts['min']
+        max_spending = amounts['max']
         
         # Find trends
         trend_direction = "stable"
-        if len(amounts) > 1:
-            if amounts[-1] > amounts[0] * 1.1:  # 10% increase
+        if amounts['count'] > 1:
+            if amounts['last'] > amounts['first'] * 1.1:  # 10% increase
                 trend_direction = "increasing"
-            elif amounts[-1] < amounts[0] * 0.9:  # 10% decrease
+            elif amounts['last'] < amounts['first'] * 0.9:  # 10% decrease
                 trend_direction = "decreasing"
         
-        # Find anomalies (values that deviate significantly from the average)
-        anomalies = []
-        for i, amount in enumerate(amounts):
-            if amount > average_spending * 1.3:  # 30% above average
-                anomalies.append((i, "significantly higher"))
-            elif amount < average_spending * 0.7:  # 30% below average
-                anomalies.append((i, "significantly lower"))
-        
         # Generate explanation
         explanation = f"This spending trend visualization for customer {customer_id} shows their spending patterns over the past {time_period.replace('_', ' ')}.\n\n"
         
@@ -104,21 +146,25 @@ def explain_spending_trend(data, customer_id=None, additional_context=None):
         explanation += f"They spent a total of ${total_spending:,.2f}, with an average monthly spending of ${average_spending:,.2f}. "
         explanation += f"Their spending ranged from ${min_spending:,.2f} to ${max_spending:,.2f}.\n\n"
         
-        # Anomalies
-        if anomalies:
+        # Anomalies, the most extreme ones first when there are too many to list
+        if amounts['anomalies']:
             explanation += "Notable spending patterns:\n"
-            for idx, description in anomalies:
+            for idx in amounts['anomalies']:
+                amount = amounts['values'][idx]
+                description = "significantly higher" if amount > average_spending else "significantly lower"
                 month = data_points[idx].get('month', f"period {idx+1}")
-                explanation += f"- {month}: ${amounts[idx]:,.2f} ({description} than average)\n"
+                explanation += f"- {month}: ${amount:,.2f} ({description} than average)\n"
+            explanation += listed(amounts['anomaly_count'])
             explanation += "\n"
         
         # Category breakdown if available
         if categories:
             explanation += "Spending by category:\n"
-            for category in categories:
+            for category in categories[:MAX_LISTED_POINTS]:
                 name = category.get('name', 'Unknown')
                 percentage = category.get('percentage', 0)
                 explanation += f"- {name}: {percentage}% of total spending\n"
+            explanation += listed(len(categories))
             explanation += "\n"
         
         # Insights and recommendations
@@ -139,12 +185,13 @@ def explain_spending_trend(data, customer_id=None, additional_context=None):
         return f"Error analyzing spending trend visualization: {str(e)}"
 
 
+@action_group.action()
 def explain_investment_allocation(data, customer_id=None, additional_context=None):
     """Generate explanation for an investment allocation visualization"""
     try:
         # Parse data if it's a string
         if isinstance(data, str):
-            data = json.loads(data)
+            data = parse_visualization(data)
             
         # Extract key data points
         allocations = data.get('allocations', [])
@@ -159,7 +206,7 @@ def explain_investment_allocation(data, customer_id=None, additional_context=Non
         allocations.sort(key=lambda x: x.get('percentage', 0), reverse=True)
         
         # Calculate key metrics
-        total_percentage = sum(alloc.get('percentage', 0) for alloc in allocations)
+        percentages = column_metrics(to_columns(allocations, ['percentage']))['percentage']
         
         # Categorize allocations by risk level
         high_risk = []
@@ -186,11 +233,12 @@ def explain_investment_allocation(data, customer_id=None, additional_context=Non
         
         # Overall allocation
         explanation += "Asset allocation breakdown:\n"
-        for alloc in allocations:
+        for alloc in allocations[:MAX_LISTED_POINTS]:
             asset_class = alloc.get('asset_class', 'Unknown')
             percentage = alloc.get('percentage', 0)
             amount = total_investment * percentage / 100 if total_investment else 0
             explanation += f"- {asset_class}: {percentage}% (${amount:,.2f})\n"
+        explanation += listed(len(allocations))
         explanation += "\n"
         
         # Risk profile analysis
@@ -219,7 +267,7 @@ def explain_investment_allocation(data, customer_id=None, additional_context=Non
         if len(allocations) < 4:
             explanation += "- The portfolio has limited diversification across asset classes.\n"
             explanation += "- Consider adding more asset classes to reduce risk through diversification.\n"
-        elif max(alloc.get('percentage', 0) for alloc in allocations) > 50:
+        elif percentages['max'] > 50:
             explanation += "- There is significant concentration in a single asset class.\n"
             explanation += "- Consider diversifying further to reduce concentration risk.\n"
         else:
@@ -231,12 +279,13 @@ def explain_investment_allocation(data, customer_id=None, additional_context=Non
         return f"Error analyzing investment allocation visualization: {str(e)}"
 
 
+@action_group.action()
 def explain_cash_flow(data, customer_id=None, additional_context=None):
     """Generate explanation for a cash flow visualization"""
     try:
         # Parse data if it's a string
         if isinstance(data, str):
-            data = json.loads(data)
+            data = parse_visualization(data)
             
         # Extract key data points
         months = data.get('months', [])
@@ -248,22 +297,22 @@ def explain_cash_flow(data, customer_id=None, additional_context=None):
             return "This cash flow visualization doesn't contain enough data to analyze."
         
         # Calculate key metrics
-        total_income = sum(income)
-        total_expenses = sum(expenses)
+        cash_flow = column_metrics({'income': income, 'expenses': expenses})
+        total_income = cash_flow['income']['total']
+        total_expenses = cash_flow['expenses']['total']
         net_cash_flow = total_income - total_expenses
-        average_income = total_income / len(income) if income else 0
-        average_expenses = total_expenses / len(expenses) if expenses else 0
+        average_income = cash_flow['income']['mean']
+        average_expenses = cash_flow['expenses']['mean']
         average_net = average_income - average_expenses
         
-        # Calculate monthly net cash flows
-        monthly_net = [inc - exp for inc, exp in zip(income, expenses)]
-        
-        # Determine cash flow trend
+        # Determine cash flow trend from the net cash flow of the first and last months
+        first_net = cash_flow['income']['first'] - cash_flow['expenses']['first']
+        last_net = cash_flow['income']['last'] - cash_flow['expenses']['last']
         trend = "stable"
-        if len(monthly_net) > 1:
-            if monthly_net[-1] > monthly_net[0] * 1.1:  # 10% increase
+        if cash_flow['income']['count'] > 1:
+            if last_net > first_net * 1.1:  # 10% increase
                 trend = "improving"
-            elif monthly_net[-1] < monthly_net[0] * 0.9:  # 10% decrease
+            elif last_net < first_net * 0.9:  # 10% decrease
                 trend = "declining"
         
         # Generate explanation
@@ -278,10 +327,16 @@ def explain_cash_flow(data, customer_id=None, additional_context=None):
         explanation += f"- Average monthly expenses: ${average_expenses:,.2f}\n"
         explanation += f"- Average monthly net cash flow: ${average_net:,.2f}\n\n"
         
-        # Monthly breakdown
-        explanation += "Monthly breakdown:\n"
-        for i, month in enumerate(months):
-            explanation += f"- {month}: Income ${income[i]:,.2f}, Expenses ${expenses[i]:,.2f}, Net ${monthly_net[i]:,.2f}\n"
+        # Monthly breakdown, of the most recent months when there are too many to list
+        month_count = min(len(months), cash_flow['income']['count'])
+        first_listed = max(0, month_count - MAX_LISTED_POINTS)
+        if first_listed:
+            explanation += f"Monthly breakdown (last {MAX_LISTED_POINTS} of {month_count:,} months):\n"
+        else:
+            explanation += "Monthly breakdown:\n"
+        for i in range(first_listed, month_count):
+            month_net = income[i] - expenses[i]
+            explanation += f"- {months[i]}: Income ${income[i]:,.2f}, Expenses ${expenses[i]:,.2f}, Net ${month_net:,.2f}\n"
         explanation += "\n"
         
         # Insights and recommendations
@@ -320,12 +375,13 @@ def explain_cash_flow(data, customer_id=None, additional_context=None):
         return f"Error analyzing cash flow visualization: {str(e)}"
 
 
+@action_group.action()
 def explain_budget_performance(data, customer_id=None, additional_context=None):
     """Generate explanation for a budget performance visualization"""
     try:
         # Parse data if it's a string
         if isinstance(data, str):
-            data = json.loads(data)
+            data = parse_visualization(data)
             
         # Extract key data points
         categories = data.get('categories', [])
@@ -336,25 +392,21 @@ def explain_budget_performance(data, customer_id=None, additional_context=None):
         if not categories or not planned or not actual:
             return "This budget performance visualization doesn't contain enough data to analyze."
         
-        # Calculate key metrics
-        total_planned = sum(planned)
-        total_actual = sum(actual)
+        # Calculate key metrics and the variance of every category
+        budget = variances(planned, actual)
+        total_planned = budget['total_planned']
+        total_actual = budget['total_actual']
         total_variance = total_actual - total_planned
         total_variance_pct = (total_variance / total_planned * 100) if total_planned else 0
+        variance_amounts = budget['variance']
+        variance_pcts = budget['variance_pct']
+        category_count = min(len(categories), len(variance_amounts))
         
-        # Calculate category variances
-        variances = [a - p for a, p in zip(actual, planned)]
-        variance_pcts = [(v / p * 100) if p else 0 for v, p in zip(variances, planned)]
-        
-        # Identify categories with significant variances
-        over_budget = [(categories[i], actual[i], planned[i], variances[i], variance_pcts[i]) 
-                      for i in range(len(categories)) if variance_pcts[i] > 10]  # Over by 10%
-        under_budget = [(categories[i], actual[i], planned[i], variances[i], variance_pcts[i]) 
-                       for i in range(len(categories)) if variance_pcts[i] < -10]  # Under by 10%
-        
-        # Sort by absolute variance percentage (descending)
-        over_budget.sort(key=lambda x: x[4], reverse=True)
-        under_budget.sort(key=lambda x: abs(x[4]), reverse=True)
+        # Identify categories with significant variances (over or under by 10%), by absolute variance percentage
+        over_budget, under_budget = budget['over'], budget['under']
+        if category_count < len(variance_amounts):
+            over_budget = [i for i in over_budget if i < category_count]
+            under_budget = [i for i in under_budget if i < category_count]
         
         # Generate explanation
         explanation = f"This budget performance visualization for customer {customer_id} shows their planned versus actual spending for {time_period.replace('_', ' ')}.\n\n"
@@ -367,8 +419,9 @@ def explain_budget_performance(data, customer_id=None, additional_context=None):
         
         # Category breakdown
         explanation += "Category breakdown:\n"
-        for i, category in enumerate(categories):
-            explanation += f"- {category}: Planned ${planned[i]:,.2f}, Actual ${actual[i]:,.2f}, Variance ${variances[i]:,.2f} ({variance_pcts[i]:+.1f}%)\n"
+        for i in range(min(category_count, MAX_LISTED_POINTS)):
+            explanation += f"- {categories[i]}: Planned ${planned[i]:,.2f}, Actual ${actual[i]:,.2f}, Variance ${variance_amounts[i]:,.2f} ({variance_pcts[i]:+.1f}%)\n"
+        explanation += listed(category_count)
         explanation += "\n"
         
         # Insights and recommendations
@@ -393,19 +446,23 @@ def explain_budget_performance(data, customer_id=None, additional_context=None):
             explanation += "- Overall spending is exactly on budget.\n"
         
         # Categories significantly over budget
-        if over_budget:
+        if len(over_budget):
             explanation += "\nCategories significantly over budget:\n"
-            for category, actual_amt, planned_amt, variance, variance_pct in over_budget:
+            for i in over_budget[:MAX_LISTED_POINTS]:
+                category, planned_amt, variance, variance_pct = categories[i], planned[i], variance_amounts[i], variance_pcts[i]
                 explanation += f"- {category}: ${variance:,.2f} ({variance_pct:+.1f}%) over planned ${planned_amt:,.2f}\n"
+            explanation += listed(len(over_budget))
             explanation += "\nRecommendations for over-budget categories:\n"
             explanation += "- Review these categories to understand the causes of overspending.\n"
             explanation += "- Consider adjusting future budgets or implementing spending controls.\n"
         
         # Categories significantly under budget
-        if under_budget:
+        if len(under_budget):
             explanation += "\nCategories significantly under budget:\n"
-            for category, actual_amt, planned_amt, variance, variance_pct in under_budget:
+            for i in under_budget[:MAX_LISTED_POINTS]:
+                category, planned_amt, variance, variance_pct = categories[i], planned[i], variance_amounts[i], variance_pcts[i]
                 explanation += f"- {category}: ${abs(variance):,.2f} ({variance_pct:+.1f}%) under planned ${planned_amt:,.2f}\n"
+            explanation += listed(len(under_budget))
             explanation += "\nConsiderations for under-budget categories:\n"
             explanation += "- Determine if underspending represents savings or delayed expenses.\n"
             explanation += "- Consider reallocating budget from these categories if the trend continues.\n"
@@ -416,6 +473,22 @@ def explain_budget_performance(data, customer_id=None, additional_context=None):
         return f"Error analyzing budget performance visualization: {str(e)}"
 
 
+def format_recommendations(recommendations):
+    """Writes recommendations, in priority order, as the response of recommend_financial_products"""
+    if not recommendations:
+        return "Based on the customer profile, there are no additional financial products to recommend at this time. The customer appears to have a comprehensive suite of financial products that align with their needs."
+    
+    response = "Based on the customer profile, here are personalized financial product recommendations:\n\n"
+    for i, rec in enumerate(recommendations):
+        response += f"{i+1}. {rec['product_name']} ({rec['product_type']})\n"
+        response += f"   Priority: {rec['priority']}\n"
+        response += f"   Rationale: {rec['rationale']}\n\n"
+    
+    response += "These recommendations are based on the provided customer profile and should be discussed with the customer to ensure they align with their current financial situation and goals."
+    return response
+
+# The data parameter contains the customer profile
+@action_group.action(customer_profile="data")
 def recommend_financial_products(customer_profile, visualization_data=None, additional_context=None):
     """Recommend financial products based on customer profile and visualization data"""
     try:
@@ -427,178 +500,51 @@ def recommend_financial_products(customer_profile, visualization_data=None, addi
         if visualization_data and isinstance(visualization_data, str):
             visualization_data = json.loads(visualization_data)
         
-        # Extract customer profile information
-        age = customer_profile.get('age', 35)
-        income = customer_profile.get('income', 75000)
-        credit_score = customer_profile.get('credit_score', 700)
-        risk_tolerance = customer_profile.get('risk_tolerance', 'moderate')
-        financial_goals = customer_profile.get('financial_goals', [])
-        existing_products = customer_profile.get('existing_products', [])
-        life_stage = customer_profile.get('life_stage', 'adult')
-        net_worth = customer_profile.get('net_worth', income * 2)
-        debt_to_income = customer_profile.get('debt_to_income', 0.3)
-        
-        # Initialize recommendations
-        recommendations = []
-        explanations = []
-        
-        # Helper function to check if a product is already owned
-        def has_product(product_type):
-            return any(product.get('type', '').lower() == product_type.lower() for product in existing_products)
-        
-        # Check for basic financial products everyone should have
-        if not has_product('checking account'):
-            recommendations.append({
-                'product_type': 'Checking Account',
-                'product_name': 'Everyday Checking',
-                'priority': 'High'
-            })
-            explanations.append("A checking account is essential for day-to-day transactions and bill payments.")
-        
-        if not has_product('savings account') and income > 0:
-            recommendations.append({
-                'product_type': 'Savings Account',
-                'product_name': 'High-Yield Savings',
-                'priority': 'High'
-            })
-            explanations.append("A high-yield savings account provides a safe place for emergency funds while earning interest.")
-        
-        # Credit products based on credit score
-        if not has_product('credit card') and credit_score >= 650:
-            if credit_score >= 750:
-                card_type = 'Premium Rewards Card'
-                explanation = "With an excellent credit score, you qualify for our premium rewards card with enhanced benefits."
-            elif credit_score >= 700:
-                card_type = 'Cash Back Card'
-                explanation = "Your good credit score qualifies you for a competitive cash back credit card."
-            else:
-                card_type = 'Secured Credit Card'
-                explanation = "This card can help you continue building your credit history with responsible use."
-                
-            recommendations.append({
-                'product_type': 'Credit Card',
-                'product_name': card_type,
-                'priority': 'Medium'
-            })
-            explanations.append(explanation)
-        
-        # Investment products based on risk tolerance and life stage
-        if not has_product('investment account'):
-            if risk_tolerance == 'aggressive' and age < 50:
-                investment_type = 'Growth Stock Portfolio'
-                explanation = "Based on your aggressive risk tolerance and age, a growth-focused investment strategy may align with your long-term goals."
-            elif risk_tolerance == 'conservative' or age >= 60:
-                investment_type = 'Income & Dividend Portfolio'
-                explanation = "A more conservative investment approach focused on income generation and capital preservation."
-            else:  # moderate risk tolerance
-                investment_type = 'Balanced Fund Portfolio'
-                explanation = "A balanced investment approach provides a mix of growth potential and risk management."
-                
-            recommendations.append({
-                'product_type': 'Investment Account',
-                'product_name': investment_type,
-                'priority': 'Medium'
-            })
-            explanations.append(explanation)
-        
-        # Loan products based on needs and life stage
-        if life_stage == 'young adult' and not has_product('student loan') and 'education' in financial_goals:
-            recommendations.append({
-                'product_type': 'Student Loan',
-                'product_name': 'Education Financing',
-                'priority': 'Medium'
-            })
-            explanations.append("Education financing options to help achieve your educational goals with competitive rates.")
-        
-        if (life_stage in ['adult', 'family'] and not has_product('mortgage') and 
-            'home_ownership' in financial_goals and income >= 50000 and credit_score >= 680):
-            recommendations.append({
-                'product_type': 'Mortgage',
-                'product_name': 'Home Buyer Mortgage',
-                'priority': 'Medium'
-            })
-            explanations.append("Financing options for home purchase with competitive rates based on your solid financial profile.")
-        
-        # Retirement planning
-        if not has_product('retirement account') and age < 65:
-            if income > 100000 and not has_product('401k'):
-                retirement_type = 'Solo 401(k)'
-                explanation = "A tax-advantaged retirement account with higher contribution limits for high-income individuals."
-            else:
-                retirement_type = 'IRA Account'
-                explanation = "A tax-advantaged retirement account to help secure your financial future."
-                
-            recommendations.append({
-                'product_type': 'Retirement Account',
-                'product_name': retirement_type,
-                'priority': 'High'
-            })
-            explanations.append(explanation)
-        
-        # Insurance products based on life stage and needs
-        if life_stage in ['family', 'adult'] and not has_product('life insurance') and income > 40000:
-            recommendations.append({
-                'product_type': 'Life Insurance',
-                'product_name': 'Term Life Protection',
-                'priority': 'Medium'
-            })
-            explanations.append("Life insurance provides financial protection for your loved ones and peace of mind for you.")
-        
-        # Format the response
-        if not recommendations:
-            return "Based on the customer profile, there are no additional financial products to recommend at this time. The customer appears to have a comprehensive suite of financial products that align with their needs."
-        
-        response = "Based on the customer profile, here are personalized financial product recommendations:\n\n"
-        
-        # Sort recommendations by priority
-        priority_order = {"High": 0, "Medium": 1, "Low": 2}
-        recommendations.sort(key=lambda x: priority_order.get(x.get('priority', 'Low'), 3))
-        
-        for i, rec in enumerate(recommendations):
-            response += f"{i+1}. {rec['product_name']} ({rec['product_type']})\n"
-            response += f"   Priority: {rec['priority']}\n"
-            response += f"   Rationale: {explanations[i]}\n\n"
-        
-        response += "These recommendations are based on the provided customer profile and should be discussed with the customer to ensure they align with their current financial situation and goals."
-        
-        return response
+        # Rules are compiled once per container, see utils.recommendation_engine
+        recommendations = decision_table().recommend(customer_profile)
+        return format_recommendations(recommendations)
     
     except Exception as e:
         return f"Error generating financial product recommendations: {str(e)}"
 
 
-def lambda_handler(event, context):
-    print(event)
+@action_group.action()
+def recommend_financial_products_batch(customer_profiles):
+    """Recommend financial products to many customers at once, e.g. for a campaign"""
+    try:
+        if isinstance(customer_profiles, str):
+            customer_profiles = json.loads(customer_profiles)
+        if isinstance(customer_profiles, dict):
+            customer_profiles = customer_profiles.get('customer_profiles', [customer_profiles])
+    except json.JSONDecodeError:
+        return "Error: Unable to parse the customer profiles. Please send them as a JSON array."
     
-    # name of the function that should be invoked
-    function = event.get('function', '')
-
-    # parameters to invoke function with
-    parameters = event.get('parameters', [])
-    customer_id = get_named_parameter(event, "customer_id")
-    data = get_named_parameter(event, "data")
-    additional_context = get_named_parameter(event, "additional_context")
+    table = decision_table()
+    try:
+        results = table.recommend_batch(customer_profiles)
+    except (TypeError, ValueError, AttributeError):
+        # A malformed profile fails the whole batch, the others are scored one by one
+        results = []
+        for profile in customer_profiles:
+            try:
+                results.append(table.recommend(profile))
+            except (TypeError, ValueError, AttributeError):
+                results.append(None)
+    
+    customer_ids = [str(profile.get('customer_id', f"profile_{i + 1}")) if isinstance(profile, dict)
+                    else f"profile_{i + 1}" for i, profile in enumerate(customer_profiles)]
+    products = {}
+    for recommendations in results:
+        for rec in recommendations or []:
+            products[rec['product_name']] = products.get(rec['product_name'], 0) + 1
+    return {
+        'profiles': len(results),
+        'products': dict(sorted(products.items(), key=lambda item: -item[1])),
+        'recommendations': [{'customer_id': customer_id, 'products': [rec['product_name'] for rec in recommendations]}
+                            for customer_id, recommendations in zip(customer_ids, results) if recommendations is not None],
+        'errors': [customer_id for customer_id, recommendations in zip(customer_ids, results) if recommendations is None]
+    }
 
-    # Call the appropriate function based on the function name
-    if function == 'explain_spending_trend':
-        result = explain_spending_trend(data, customer_id, additional_context)
-    elif function == 'explain_investment_allocation':
-        result = explain_investment_allocation(data, customer_id, additional_context)
-    elif function == 'explain_cash_flow':
-        result = explain_cash_flow(data, customer_id, additional_context)
-    elif function == 'explain_budget_performance':
-        result = explain_budget_performance(data, customer_id, additional_context)
-    elif function == 'explain_visualization':
-        visualization_type = get_named_parameter(event, "visualization_type")
-        result = explain_visualization(data, visualization_type, customer_id, additional_context)
-    elif function == 'recommend_financial_products':
-        customer_profile = data  # The data parameter contains the customer profile
-        visualization_data = get_named_parameter(event, "visualization_data")
-        result = recommend_financial_products(customer_profile, visualization_data, additional_context)
-    else:
-        # Default response for functions not yet implemented
-        result = f"Function '{function}' not yet implemented in this version."
 
-    response = populate_function_response(event, result)
-    print(response)
-    return response
+def lambda_handler(event, context):
+    return action_group.handle(event)
@@ -1,27 +1,59 @@
 import os
 import json
-import uuid
-import boto3
+import threading
 
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from utils.client_helper import get_client, get_table, new_resource
+from utils.dynamodb_helper import add_index_keys, index_key_name, iter_query
+from utils.action_group_helper import ActionGroup
+from utils.faq_index import FAQ_INDEX_FILE, FaqIndex, embed_text
+from utils.id_helper import creation_key, new_ulid, ulid_datetime
+from utils.log_helper import logger
 
-dynamodb_resource = boto3.resource('dynamodb')
 dynamodb_table = os.getenv('dynamodb_table')
 dynamodb_pk = os.getenv('dynamodb_pk')
 dynamodb_sk = os.getenv('dynamodb_sk')
+# Attributes returned to the agent for ticket listings
+ticket_fields = ['ticket_id', 'description', 'status', 'assignee']
+# Status changes and reassignments of a ticket, appended to its item by update_ticket_status
+history_field = 'history'
+# Secondary indexes the table was created with, see AgentsForAmazonBedrock.create_dynamodb
+dynamodb_indexes = os.getenv('dynamodb_indexes', '').split(',')
+# Tickets of a customer by status, newest first within a status
+status_index = {'name': 'customer-status-index', 'partition_key': dynamodb_pk, 'sort_key': ['status', 'ticket_id']}
+# Statuses a ticket can have, and those of the tickets listed with status="open"
+ticket_statuses = os.getenv('ticket_statuses', 'created,in_progress,resolved,closed').split(',')
+open_statuses = os.getenv('ticket_open_statuses', 'created,in_progress').split(',')
+# Tickets listed per call of get_ticket_status by default, and at most
+ticket_page_size = int(os.getenv('ticket_page_size', 20))
+ticket_max_page_size = 100
+# Most writes a DynamoDB transaction, and a BatchWriteItem request, can hold
+transaction_max_items = 100
+batch_write_max_items = 25
+# Transactions retried when they conflict with concurrent writes
+write_max_attempts = 3
+# Threads writing the transactions or batches of a bulk operation, each with its own boto3 resource
+ticket_write_threads = int(os.getenv('ticket_write_threads', 8))
+# Passages of the kb_documents returned by lookup_faq by default, and at most
+faq_top_k = int(os.getenv('faq_top_k', 3))
+faq_max_top_k = 10
+# Passages under this relevance (see utils.faq_index) are not answers: the question goes to the knowledge base
+faq_min_score = float(os.getenv('faq_min_score', 0.08))
+# Embeds the questions with the model of the FAQ index, when it was built with --embeddings. A Bedrock call
+# per question, tens of milliseconds, where the lexical search alone takes a fraction of a millisecond.
+faq_query_embeddings = os.getenv('faq_query_embeddings', 'false').lower() == 'true'
+# FAQ index of the kb_documents, packaged next to this file, loaded by the first lookup_faq call
+faq_index_file = os.path.join(os.environ.get('LAMBDA_TASK_ROOT', os.getcwd()), FAQ_INDEX_FILE)
+_faq_index = None
+# Functions exposed to the agent, registered with @action_group.action()
+action_group = ActionGroup()
 
-def get_named_parameter(event, name):
-    try:
-        return next(item for item in event['parameters'] if item['name'] == name)['value']
-    except:
-        return None
-    
-def populate_function_response(event, response_body):
-    return {'response': {'actionGroup': event['actionGroup'], 'function': event['function'],
-                'functionResponse': {'responseBody': {'TEXT': {'body': str(response_body)}}}}}
 
 def put_dynamodb(table_name, item):
-    table = dynamodb_resource.Table(table_name)
+    table = get_table(table_name)
     resp = table.put_item(Item=item)
     return resp
 
@@ -29,64 +61,292 @@ def read_dynamodb(table_name: str,
                    pk_field: str,
                    pk_value: str,
                    sk_field: str=None, 
-                   sk_value: str=None):
+                   sk_value: str=None,
+                   projection: list=None,
+                   page_size: int=None,
+                   max_items: int=None):
     try:
-        table = dynamodb_resource.Table(table_name)
-        # Create expression
-        if sk_value:
-            key_expression = Key(pk_field).eq(pk_value) & Key(sk_field).begins_with(sk_value)
-        else:
-            key_expression = Key(pk_field).eq(pk_value)
-
-        query_data = table.query(
-            KeyConditionExpression=key_expression
-        )
-        
-        return query_data['Items']
-    except Exception:
-        print(f'Error querying table: {table_name}.')
+        return list(iter_dynamodb(table_name, pk_field, pk_value, sk_field, sk_value,
+                                  projection, page_size, max_items))
+    except Exception as e:
+        logger.error('query failed', table=table_name, error=repr(e))
 
-def open_ticket(customer_id, msg):
-    ticket_id = str(uuid.uuid1())
+def iter_dynamodb(table_name: str, 
+                  pk_field: str,
+                  pk_value: str,
+                  sk_field: str=None, 
+                  sk_value: str=None,
+                  projection: list=None,
+                  page_size: int=None,
+                  max_items: int=None):
+    table = get_table(table_name)
+    # Create expression
+    if sk_value:
+        key_expression = Key(pk_field).eq(pk_value) & Key(sk_field).begins_with(sk_value)
+    else:
+        key_expression = Key(pk_field).eq(pk_value)
+
+    # Items are yielded page by page, following LastEvaluatedKey only when needed
+    return iter_query(table, key_expression,
+                      projection=projection, page_size=page_size, max_items=max_items)
+
+def status_sort_value(status, ticket_id):
+    # Status index sort key of a ticket. Tickets opened before the IDs were ULIDs keep their UUID1 IDs, sorted
+    # on the ULID of their creation time, see utils/ticket_backfill.py
+    return f"{status}#{creation_key(ticket_id)}"
+
+def read_tickets(customer_id, status, limit, before=None):
+    # Newest tickets of a customer with a status (any if None), up to limit of them created before the
+    # creation_key before. Tickets are ordered by the creation_key of their ID
+    table = get_table(dynamodb_table)
+    if status is not None and status_index['name'] in dynamodb_indexes:
+        # Only the tickets with the status are read from the index
+        sort_key = index_key_name(status_index['sort_key'])
+        key_expression = Key(dynamodb_pk).eq(customer_id) & (
+            Key(sort_key).between(f"{status}#", f"{status}#{before}") if before
+            else Key(sort_key).begins_with(f"{status}#"))
+        tickets = iter_query(table, key_expression, projection=ticket_fields,
+                             max_items=limit + 1, index_name=status_index['name'], scan_forward=False)
+        # between includes the ticket the page starts after
+        return [ticket for ticket in tickets if creation_key(ticket['ticket_id']) != before][:limit]
+    # The table sorts the tickets by ID, which is not the creation order of UUID1 IDs: every ticket of the
+    # customer is read and sorted here
+    filter_expression = Attr('status').eq(status) if status is not None else None
+    tickets = sorted(iter_query(table, Key(dynamodb_pk).eq(customer_id), filter_expression, projection=ticket_fields),
+                     key=lambda ticket: creation_key(ticket['ticket_id']), reverse=True)
+    return [ticket for ticket in tickets if before is None or creation_key(ticket['ticket_id']) < before][:limit]
+
+def with_created_at(ticket):
+    created_at = ulid_datetime(creation_key(ticket.get('ticket_id')))
+    if created_at is None:
+        return ticket
+    return {**ticket, 'created_at': created_at.isoformat(timespec='seconds')}
+
+def ticket_event(status=None, assignee=None):
+    # Entry of the event log of a ticket, with what changed
+    event = {'at': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+    if status:
+        event['status'] = status
+    if assignee:
+        event['assignee'] = assignee
+    return event
+
+def new_ticket(customer_id, msg):
     item = {
-        'ticket_id': ticket_id,
+        'ticket_id': new_ulid(),
         'customer_id': customer_id,
         'description': msg,
-        'status': 'created'
+        'status': 'created',
+        history_field: [ticket_event('created')]
     }
+    return add_index_keys(item, [status_index])
+
+def parse_tickets(tickets, fields):
+    # JSON array of objects with the given fields, other fields are ignored
+    if isinstance(tickets, str):
+        tickets = json.loads(tickets)
+    if not isinstance(tickets, list):
+        raise ValueError("not a JSON array")
+    parsed = []
+    for ticket in tickets:
+        if ticket.get(fields[-1]) in (None, ''):
+            raise KeyError(fields[-1])
+        parsed.append({field: str(ticket[field]) for field in fields})
+    return parsed
+
+def in_threads(function, chunks):
+    # function(resource, chunk) of each chunk, in threads with their own resource: boto3 resources are not thread safe
+    resources = threading.local()
+
+    def call(chunk):
+        if not hasattr(resources, 'dynamodb'):
+            resources.dynamodb = new_resource('dynamodb')
+        return function(resources.dynamodb, chunk)
+
+    if len(chunks) <= 1:
+        return [call(chunk) for chunk in chunks]
+    with ThreadPoolExecutor(max_workers=min(ticket_write_threads, len(chunks))) as executor:
+        return list(executor.map(call, chunks))
+
+def write_tickets(resource, items):
+    # One BatchWriteItem request, unprocessed items are retried by the batch writer
+    with resource.Table(dynamodb_table).batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+    return len(items)
+
+def ticket_update(key, status, assignee, event):
+    # Update of a transaction: the status and assignee of an existing ticket, with the change appended to its log
+    names = {'#ticket': dynamodb_sk, '#history': history_field}
+    values = {':event': [event], ':empty': []}
+    actions = ['#history = list_append(if_not_exists(#history, :empty), :event)']
+    if status:
+        # The status index key follows the status
+        names.update({'#status': 'status', '#status_ticket': index_key_name(status_index['sort_key'])})
+        values.update({':status': status, ':status_ticket': status_sort_value(status, key[dynamodb_sk])})
+        actions += ['#status = :status', '#status_ticket = :status_ticket']
+    if assignee:
+        names['#assignee'] = 'assignee'
+        values[':assignee'] = assignee
+        actions.append('#assignee = :assignee')
+    return {'Update': {
+        'TableName': dynamodb_table,
+        'Key': key,
+        'UpdateExpression': 'SET ' + ', '.join(actions),
+        # boto3 serializes the values of a transaction but not Attr conditions
+        'ConditionExpression': 'attribute_exists(#ticket)',
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': values
+    }}
+
+def update_tickets(resource, keys, status, assignee, event):
+    # Updates up to transaction_max_items tickets in one transaction. Returns (updated, not found, failed) keys
+    not_found = []
+    for attempt in range(write_max_attempts):
+        try:
+            resource.meta.client.transact_write_items(
+                TransactItems=[ticket_update(key, status, assignee, event) for key in keys])
+            return keys, not_found, []
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+        # Tickets that do not exist fail their condition, the others are written again without them
+        not_found += [key for key, reason in zip(keys, reasons) if reason == 'ConditionalCheckFailed']
+        keys = [key for key, reason in zip(keys, reasons) if reason != 'ConditionalCheckFailed']
+        if not keys:
+            return [], not_found, []
+        if any(reason not in ('None', 'ConditionalCheckFailed') for reason in reasons):
+            logger.info('ticket update conflict', tickets=len(keys), attempt=attempt + 1,
+                        reasons=sorted(set(reasons)))
+    return [], not_found, keys
+
+@action_group.action()
+def open_ticket(customer_id, msg):
+    item = new_ticket(customer_id, msg)
     resp = put_dynamodb(dynamodb_table, item)
-    print(resp)
+    logger.debug('ticket created', response=resp.get('ResponseMetadata'))
     return "Thanks for contact customer {}! Your support case was generated with ID: {}".format(
-        customer_id, ticket_id
+        customer_id, item['ticket_id']
     )
 
+@action_group.action()
+def open_tickets(tickets):
+    """Opens many tickets at once, written 25 per request by parallel threads"""
+    try:
+        entries = parse_tickets(tickets, ['customer_id', 'msg'])
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError, AttributeError) as e:
+        return f"Error: Unable to parse the tickets ({e}). Send a JSON array of {{\"customer_id\", \"msg\"}} objects."
+    items = [new_ticket(entry['customer_id'], entry['msg']) for entry in entries]
+    in_threads(write_tickets, [items[start:start + batch_write_max_items]
+                               for start in range(0, len(items), batch_write_max_items)])
+    logger.info('tickets created', tickets=len(items))
+    return {
+        'opened': len(items),
+        'tickets': [{'customer_id': item['customer_id'], 'ticket_id': item['ticket_id']} for item in items]
+    }
+
+@action_group.action()
+def update_ticket_status(tickets, status=None, assignee=None):
+    """Closes, reassigns or changes the status of many tickets at once, in transactions of up to 100 tickets"""
+    if not status and not assignee:
+        return "Error: give the new status of the tickets, their new assignee, or both"
+    if status and status not in ticket_statuses:
+        return f"Error: unknown status {status}, the statuses are: {', '.join(ticket_statuses)}"
+    try:
+        keys = [{dynamodb_pk: ticket['customer_id'], dynamodb_sk: ticket['ticket_id']}
+                for ticket in parse_tickets(tickets, ['customer_id', 'ticket_id'])]
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError, AttributeError) as e:
+        return (f"Error: Unable to parse the tickets ({e}). "
+                f"Send a JSON array of {{\"customer_id\", \"ticket_id\"}} objects.")
+    # A transaction cannot write an item twice
+    keys = list({(key[dynamodb_pk], key[dynamodb_sk]): key for key in keys}.values())
+
+    event = ticket_event(status, assignee)
+    results = in_threads(lambda resource, chunk: update_tickets(resource, chunk, status, assignee, event),
+                         [keys[start:start + transaction_max_items]
+                          for start in range(0, len(keys), transaction_max_items)])
+    updated = sum(len(result[0]) for result in results)
+    not_found = [key for result in results for key in result[1]]
+    failed = [key for result in results for key in result[2]]
+    logger.info('tickets updated', tickets=len(keys), updated=updated, not_found=len(not_found), failed=len(failed))
+    return {'updated': updated, 'not_found': not_found, 'failed': failed}
+
+@action_group.action()
 def get_ticket_status(customer_id,
-                      ticket_id: str=None):
-    return read_dynamodb(dynamodb_table, 
-                         dynamodb_pk,
-                         customer_id,
-                         dynamodb_sk,
-                         ticket_id)
+                      ticket_id: str=None,
+                      status: str=None,
+                      limit: int=None,
+                      next_token: str=None):
+    """Gets a ticket by ID, or lists the tickets of a customer newest first, a page of limit tickets at a time"""
+    if ticket_id:
+        tickets = read_dynamodb(dynamodb_table,
+                                dynamodb_pk,
+                                customer_id,
+                                dynamodb_sk,
+                                ticket_id,
+                                projection=ticket_fields + [history_field])
+        return [with_created_at(ticket) for ticket in tickets] if tickets is not None else None
+    try:
+        limit = int(limit) if limit else ticket_page_size
+        if limit < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        return f"Error: limit must be a positive number of tickets, got: {limit}"
+    limit = min(limit, ticket_max_page_size)
 
-def lambda_handler(event, context):
-    print(event)
-    
-    # name of the function that should be invoked
-    function = event.get('function', '')
-
-    # parameters to invoke function with
-    parameters = event.get('parameters', [])
-    customer_id = get_named_parameter(event, "customer_id")
-
-    if function == 'open_ticket':
-        msg = get_named_parameter(event, "msg")
-        result = open_ticket(customer_id, msg)
-    elif function == 'get_ticket_status':
-        ticket_id = get_named_parameter(event, "ticket_id")
-        result = get_ticket_status(customer_id, ticket_id)
+    if status == 'open':
+        statuses = open_statuses
+    elif status or status_index['name'] not in dynamodb_indexes:
+        statuses = [status or None]
     else:
-        result = f"Error, function '{function}' not recognized"
+        # Every status is read from the index, in creation order, rather than the table in ID order
+        statuses = ticket_statuses
+    try:
+        # One more ticket than the page tells whether there is a next one
+        tickets = [ticket for each in statuses for ticket in read_tickets(customer_id, each, limit + 1, next_token)]
+    except Exception as e:
+        logger.error('query failed', table=dynamodb_table, error=repr(e))
+        return f"Error: Unable to read the tickets of customer {customer_id}"
+    tickets.sort(key=lambda ticket: creation_key(ticket['ticket_id']), reverse=True)
+    page = {'tickets': [with_created_at(ticket) for ticket in tickets[:limit]]}
+    if len(tickets) > limit:
+        # The tickets older than the last one listed
+        page['next_token'] = creation_key(tickets[limit - 1]['ticket_id'])
+    return page
+
+def get_faq_index():
+    global _faq_index
+    if _faq_index is None:
+        if not os.path.exists(faq_index_file):
+            return None
+        _faq_index = FaqIndex.load(faq_index_file)
+        logger.info('faq index loaded', passages=len(_faq_index.passages), embeddings=_faq_index.embedding_model)
+    return _faq_index
 
-    response = populate_function_response(event, result)
-    print(response)
-    return response
+@action_group.action()
+def lookup_faq(question, top_k: int=None):
+    """Finds the passages of the solar panel installation and maintenance documents answering a question"""
+    index = get_faq_index()
+    if index is None:
+        return f"Error: the FAQ index {FAQ_INDEX_FILE} is not packaged with this function, use the knowledge base"
+    try:
+        top_k = int(top_k) if top_k else faq_top_k
+        if top_k < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        return f"Error: top_k must be a positive number of passages, got: {top_k}"
+    query_vector = None
+    if faq_query_embeddings and index.embedding_model:
+        try:
+            query_vector = embed_text(get_client('bedrock-runtime'), index.embedding_model, question)
+        except Exception as e:
+            # The lexical search still answers
+            logger.warning('question embedding failed', model=index.embedding_model, error=repr(e))
+    passages = index.search(question, min(top_k, faq_max_top_k), query_vector, min_relevance=faq_min_score)
+    if not passages:
+        return f"No FAQ match for: {question}. Use the knowledge base."
+    return passages
+
+def lambda_handler(event, context):
+    return action_group.handle(event)
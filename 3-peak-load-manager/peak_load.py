@@ -1,32 +1,58 @@
 import os
-import boto3
 import json
 import random
 
+from decimal import Decimal, InvalidOperation
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta, timezone
+from utils.client_helper import get_table, new_resource
+from utils.dynamodb_helper import QueryCache, iter_query
+from utils.action_group_helper import ActionGroup
+from utils.log_helper import logger
+from utils.fleet_scan import fleet_metrics, scan_columns
+from utils.load_forecast import FORECAST_SUMMARY_KEY, unpack_forecast
+from utils.peak_detector import PEAK_THRESHOLD, DeviceLoad
 
-dynamodb_resource = boto3.resource('dynamodb')
 dynamodb_table = os.getenv('dynamodb_table')
 dynamodb_pk = os.getenv('dynamodb_pk')
 dynamodb_sk = os.getenv('dynamodb_sk')
+# Query results kept across invocations of a warm container, dropped on writes
+query_cache = QueryCache(max_entries=int(os.getenv('query_cache_size', 256)),
+                         ttl_seconds=float(os.getenv('query_cache_ttl', 30)))
+# Secondary indexes the table was created with, see AgentsForAmazonBedrock.create_dynamodb
+dynamodb_indexes = os.getenv('dynamodb_indexes', '').split(',')
+# Sparse index, only devices flagged with a peak are in it
+peak_index = {'name': 'customer-peak-index', 'partition_key': dynamodb_pk, 'sort_key': 'peak'}
+essential_index = {'name': 'customer-essential-index', 'partition_key': dynamodb_pk, 'sort_key': 'essential'}
+# Attributes returned to the agent for device listings
+device_fields = ['item_id', 'item_desc', 'quota', 'used', 'essential', 'peak']
+# Peak detection summary of a customer, in the customer partition: one device#<item_id> attribute
+# per device at a peak, see ingest_readings
+peak_summary_key = 'summary#peaks'
+# Conditional writes retried when the devices they read were written concurrently
+write_max_attempts = 3
+# Most writes a DynamoDB transaction can hold
+transaction_max_items = 100
+# Segments of the parallel scan of scan_fleet, each read by its own thread
+fleet_scan_segments = int(os.getenv('fleet_scan_segments', 8))
+# Functions exposed to the agent, registered with @action_group.action()
+action_group = ActionGroup()
 
-def get_named_parameter(event, name):
-    return next(item for item in event['parameters'] if item['name'] == name)['value']
-    
-def populate_function_response(event, response_body):
-    return {'response': {'actionGroup': event['actionGroup'], 'function': event['function'],
-                'functionResponse': {'responseBody': {'TEXT': {'body': str(response_body)}}}}}
 
 def put_dynamodb(table_name, item):
-    table = dynamodb_resource.Table(table_name)
+    table = get_table(table_name)
     
+    # The updated item is needed to check its peak against the new quota
     resp = table.update_item(
         Key={'customer_id': item['customer_id'],
              'item_id': item['item_id']},
         UpdateExpression='SET #attr1 = :val1',
         ExpressionAttributeNames={'#attr1': 'quota'},
-        ExpressionAttributeValues={':val1':  item['quota']}
+        ExpressionAttributeValues={':val1':  item['quota']},
+        ReturnValues='ALL_NEW'
     )
+    query_cache.invalidate(table_name, item['customer_id'])
     return resp
 
 def read_dynamodb(
@@ -36,46 +62,210 @@ def read_dynamodb(
     sk_field: str=None, 
     sk_value: str=None,
     attr_key: str=None,
-    attr_val: str=None
+    attr_val: str=None,
+    projection: list=None,
+    page_size: int=None,
+    max_items: int=None,
+    index_name: str=None
 ):
+    cache_key = (table_name, pk_value, sk_field, sk_value, attr_key, attr_val,
+                 tuple(projection or ()), max_items, index_name)
+    items = query_cache.get(cache_key)
+    if items is not None:
+        return items
     try:
+        items = list(iter_dynamodb(table_name, pk_field, pk_value, sk_field, sk_value,
+                                   attr_key, attr_val, projection, page_size, max_items,
+                                   index_name))
+    except Exception as e:
+        logger.error('query failed', table=table_name, error=repr(e))
+        return None
+    query_cache.put(cache_key, items)
+    return items
 
-        table = dynamodb_resource.Table(table_name)
-        # Create expression
-        if sk_field:
-            key_expression = Key(pk_field).eq(pk_value) & Key(sk_field).eq(sk_value)
-        else:
-            key_expression = Key(pk_field).eq(pk_value)
-
-        if attr_key:
-            attr_expression = Attr(attr_key).eq(attr_val)
-            query_data = table.query(
-                KeyConditionExpression=key_expression,
-                FilterExpression=attr_expression
-            )
-        else:
-            query_data = table.query(
-                KeyConditionExpression=key_expression
-            )
-        
-        return query_data['Items']
-    except Exception:
-        print(f'Error querying table: {table_name}.')
+def iter_dynamodb(
+    table_name: str, 
+    pk_field: str,
+    pk_value: str,
+    sk_field: str=None, 
+    sk_value: str=None,
+    attr_key: str=None,
+    attr_val: str=None,
+    projection: list=None,
+    page_size: int=None,
+    max_items: int=None,
+    index_name: str=None
+):
+    table = get_table(table_name)
+    # Create expression
+    if sk_field:
+        key_expression = Key(pk_field).eq(pk_value) & Key(sk_field).eq(sk_value)
+    else:
+        key_expression = Key(pk_field).eq(pk_value)
 
+    attr_expression = Attr(attr_key).eq(attr_val) if attr_key else None
 
-def detect_peak(customer_id):
+    # Items are yielded page by page, following LastEvaluatedKey only when needed
+    return iter_query(table, key_expression, attr_expression,
+                      projection=projection, page_size=page_size, max_items=max_items,
+                      index_name=index_name)
+
+
+def read_devices_by_flag(customer_id, index, flag_val):
+    if index['name'] in dynamodb_indexes:
+        # Only the flagged devices are read from the index
+        return read_dynamodb(dynamodb_table,
+                             dynamodb_pk,
+                             customer_id,
+                             index['sort_key'],
+                             flag_val,
+                             projection=device_fields,
+                             index_name=index['name'])
     return read_dynamodb(dynamodb_table, 
                          dynamodb_pk, 
                          customer_id, 
-                         attr_key="peak", attr_val="True")
+                         attr_key=index['sort_key'], attr_val=flag_val,
+                         projection=device_fields)
+
+def parse_readings(readings):
+    # JSON array of {"item_id": "4", "value": 180} objects, or object of item_id -> value or list of
+    # values. Returns item_id -> values, in reading order
+    if isinstance(readings, str):
+        readings = json.loads(readings)
+    if isinstance(readings, dict):
+        readings = [{'item_id': item_id, 'value': value} for item_id, values in readings.items()
+                    for value in (values if isinstance(values, list) else [values])]
+    values = {}
+    for reading in readings:
+        values.setdefault(str(reading['item_id']), []).append(float(reading.get('value', reading.get('used'))))
+    return values
+
+def peak_entry(item):
+    # Device as listed by detect_peak
+    entry = {field: item[field] for field in device_fields if field in item}
+    entry['load_ewma'] = item.get('load_ewma')
+    return entry
+
+def update_device_load(customer_id, item_id, values):
+    # Adds readings to the state of a device with a conditional write, the state of the device being
+    # versioned by its reading count. Returns (updated item, was at a peak), None for unknown devices
+    table = get_table(dynamodb_table)
+    key = {dynamodb_pk: customer_id, dynamodb_sk: item_id}
+    for attempt in range(write_max_attempts):
+        item = table.get_item(Key=key, ConsistentRead=True).get('Item')
+        if item is None:
+            return None
+        load = DeviceLoad.from_item(item)
+        for value in values:
+            load.add(value)
+        was_peak = item.get('peak') == 'True'
+        attributes = {**load.attributes(), 'used': f"{load.last:.15g}"}
+        if load.is_peak(item.get('quota', 0), was_peak):
+            attributes['peak'] = 'True'
+        names = {f"#a{i}": name for i, name in enumerate(attributes)}
+        expression = 'SET ' + ', '.join(f"#a{i} = :v{i}" for i in range(len(attributes)))
+        if was_peak and 'peak' not in attributes:
+            names['#peak'] = 'peak'
+            expression += ' REMOVE #peak'
+        condition = Attr('load_readings').eq(item['load_readings']) if 'load_readings' in item \
+            else Attr('load_readings').not_exists()
+        try:
+            table.update_item(Key=key, UpdateExpression=expression,
+                              ConditionExpression=condition & Attr(dynamodb_sk).exists(),
+                              ExpressionAttributeNames=names,
+                              ExpressionAttributeValues={f":v{i}": value for i, value in enumerate(attributes.values())})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.info('device load write conflict', item_id=item_id, attempt=attempt + 1)
+            continue
+        item = {**item, **attributes}
+        if 'peak' not in attributes:
+            item.pop('peak', None)
+        return item, was_peak
+    raise RuntimeError(f"Readings of item {item_id} kept conflicting with concurrent ones")
+
+def update_peak_summary(customer_id, changes):
+    # Applies item_id -> device entry (at a peak) or None (not at a peak) to the peak summary
+    table = get_table(dynamodb_table)
+    key = {dynamodb_pk: customer_id, dynamodb_sk: peak_summary_key}
+
+    def update(changes, return_values='NONE'):
+        names = {'#updated': 'updated_at'}
+        values = {':updated': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+        set_parts, remove_parts = ['#updated = :updated'], []
+        for i, (item_id, entry) in enumerate(changes.items()):
+            names[f"#d{i}"] = f"device#{item_id}"
+            if entry is None:
+                remove_parts.append(f"#d{i}")
+            else:
+                values[f":d{i}"] = entry
+                set_parts.append(f"#d{i} = :d{i}")
+        expression = 'SET ' + ', '.join(set_parts) + (' REMOVE ' + ', '.join(remove_parts) if remove_parts else '')
+        return table.update_item(Key=key, UpdateExpression=expression, ExpressionAttributeNames=names,
+                                 ExpressionAttributeValues=values, ReturnValues=return_values)
+
+    resp = update(changes, 'ALL_OLD')
+    if not resp.get('Attributes'):
+        # First summary of the customer: devices flagged before detection started stay at a peak
+        flagged = {device['item_id']: device for device in read_devices_by_flag(customer_id, peak_index, "True") or []
+                   if device['item_id'] not in changes}
+        if flagged:
+            update(flagged)
+    query_cache.invalidate(dynamodb_table, customer_id)
+
+@action_group.action()
+def ingest_readings(customer_id, readings):
+    """Adds meter readings to the sliding window state of the devices and updates their peak flag"""
+    try:
+        values = parse_readings(readings)
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError, AttributeError) as e:
+        return f"Error: Unable to parse the readings ({e}). Send a JSON array of {{\"item_id\", \"value\"}} objects."
+
+    changes, started, ended, unknown = {}, [], [], []
+    for item_id, series in values.items():
+        result = update_device_load(customer_id, item_id, series)
+        if result is None:
+            unknown.append(item_id)
+            continue
+        item, was_peak = result
+        peak = item.get('peak') == 'True'
+        if peak:
+            changes[item_id] = peak_entry(item)
+        elif was_peak:
+            changes[item_id] = None
+        if peak != was_peak:
+            (started if peak else ended).append(item_id)
+    query_cache.invalidate(dynamodb_table, customer_id)
+    if len(unknown) < len(values):
+        update_peak_summary(customer_id, changes)
+    logger.info('readings ingested', customer_id=customer_id, devices=len(values) - len(unknown),
+                readings=sum(len(series) for series in values.values()), started=started, ended=ended)
+    return {
+        'readings': sum(len(values[item_id]) for item_id in values if item_id not in unknown),
+        'devices': len(values) - len(unknown),
+        'peaks': [item_id for item_id, entry in changes.items() if entry is not None],
+        'started': started,
+        'ended': ended,
+        'unknown': unknown
+    }
 
+@action_group.action()
+def detect_peak(customer_id):
+    # Devices at a peak are kept up to date in a single summary item by ingest_readings
+    summary = read_dynamodb(dynamodb_table, dynamodb_pk, customer_id, dynamodb_sk, peak_summary_key)
+    if summary:
+        return sorted((entry for attr, entry in summary[0].items() if attr.startswith('device#')),
+                      key=lambda entry: entry['item_id'])
+    # No readings ingested yet, the devices flagged at load time
+    return read_devices_by_flag(customer_id, peak_index, "True")
+
+@action_group.action()
 def detect_non_essential_processes(customer_id):
-    return read_dynamodb(dynamodb_table, 
-                         dynamodb_pk, 
-                         customer_id,
-                         attr_key="essential", attr_val="False")
+    return read_devices_by_flag(customer_id, essential_index, "False")
 
                 
+@action_group.action()
 def redistribute_allocation(customer_id, item_id, quota):
     item = {
         'customer_id': customer_id,
@@ -83,31 +273,183 @@ def redistribute_allocation(customer_id, item_id, quota):
         'quota': quota
     }
     resp = put_dynamodb(dynamodb_table, item)
+    refresh_peak(customer_id, resp.get('Attributes', {}))
     return "Item {} has been updated. New quota: {}".format(item_id, quota)
 
+def plan_quotas(devices, target_kw):
+    # Greedy allocation of the quota cut bringing the household down to target_kw: the unused quota of the
+    # non-essential devices first, then the quota they use, the largest first so the fewest devices
+    # change. Returns (item_id -> new quota, total before, quota non-essential devices can free at most)
+    total = sum(device['quota'] for device in devices)
+    excess = total - target_kw
+    flexible = [device for device in devices if device.get('essential') != 'True']
+    freeable = sum(device['quota'] for device in flexible)
+    quotas = {}
+    if excess <= 0 or excess > freeable:
+        return quotas, total, freeable
+    for cuttable in (lambda device: device['quota'] - min(device['used'], device['quota']),
+                     lambda device: quotas.get(device['item_id'], device['quota'])):
+        for device in sorted(flexible, key=cuttable, reverse=True):
+            cut = min(cuttable(device), excess)
+            if cut <= 0:
+                break
+            quotas[device['item_id']] = quotas.get(device['item_id'], device['quota']) - cut
+            excess -= cut
+        if excess <= 0:
+            break
+    return quotas, total, freeable
 
-def lambda_handler(event, context):
-    print(event)
-    
-    # name of the function that should be invoked
-    function = event.get('function', '')
+def to_quota(value):
+    # Quotas and readings are stored as strings, e.g. "20"
+    try:
+        return Decimal(str(value or 0))
+    except InvalidOperation:
+        return Decimal(0)
 
-    # parameters to invoke function with
-    parameters = event.get('parameters', [])
-    
-    customer_id = get_named_parameter(event, "customer_id")
-
-    if function == 'detect_peak':    
-        result = detect_peak(customer_id)
-    elif function == 'detect_non_essential_processes':    
-        result = detect_non_essential_processes(customer_id)
-    elif function == 'redistribute_allocation':    
-        item_id = get_named_parameter(event, "item_id")
-        quota = get_named_parameter(event, "quota")
-        result = redistribute_allocation(customer_id, item_id, quota)
-    else:
-        result = f"Error, function '{function}' not recognized"
+@action_group.action()
+def rebalance_quotas(customer_id, target_kw):
+    """Cuts the quotas of non-essential devices so the household total fits target_kw, in one transaction"""
+    try:
+        target_kw = Decimal(str(target_kw))
+        if not target_kw.is_finite() or target_kw < 0:
+            raise InvalidOperation
+    except InvalidOperation:
+        return f"Error: target_kw must be a non-negative number, got: {target_kw}"
+
+    table = get_table(dynamodb_table)
+    for attempt in range(write_max_attempts):
+        # Device items only, not the peak summary
+        items = [item for item in iter_dynamodb(dynamodb_table, dynamodb_pk, customer_id) if 'quota' in item]
+        devices = [{**item, 'quota': to_quota(item['quota']), 'used': to_quota(item.get('used'))} for item in items]
+        quotas, total, freeable = plan_quotas(devices, target_kw)
+        if total <= target_kw:
+            return f"The quotas of customer {customer_id} already total {total} kW, within {target_kw} kW"
+        if not quotas:
+            return (f"Unable to reach {target_kw} kW for customer {customer_id}: quotas total {total} kW and "
+                    f"non-essential devices can free at most {freeable} kW. Essential devices were left unchanged.")
+        if len(quotas) > transaction_max_items:
+            return f"Error: {len(quotas)} devices to update, a transaction holds at most {transaction_max_items}"
 
-    response = populate_function_response(event, result)
-    print(response)
+        writes, changes, peaks = [], [], {}
+        for item in items:
+            if item['item_id'] not in quotas:
+                continue
+            quota = f"{quotas[item['item_id']]:f}"
+            attributes = {'#quota': 'quota'}
+            expression = 'SET #quota = :quota'
+            # The peak flag follows the new quota, see ingest_readings
+            was_peak = item.get('peak') == 'True'
+            peak = DeviceLoad.from_item(item).is_peak(quota, was_peak) if 'load_readings' in item else was_peak
+            if peak != was_peak:
+                attributes['#peak'] = 'peak'
+                expression += ', #peak = :peak' if peak else ' REMOVE #peak'
+            if peak or was_peak:
+                peaks[item['item_id']] = peak_entry({**item, 'quota': quota, 'peak': 'True'}) if peak else None
+            writes.append({'Update': {
+                'TableName': dynamodb_table,
+                'Key': {dynamodb_pk: customer_id, dynamodb_sk: item['item_id']},
+                'UpdateExpression': expression,
+                # Applied only if nothing changed the quota since it was read. boto3 serializes the values
+                # of a transaction but not Attr conditions
+                'ConditionExpression': '#quota = :quota_before',
+                'ExpressionAttributeNames': attributes,
+                'ExpressionAttributeValues': {':quota': quota, ':quota_before': item['quota'],
+                                              **({':peak': 'True'} if peak and not was_peak else {})}
+            }})
+            changes.append({'item_id': item['item_id'], 'item_desc': item.get('item_desc'),
+                            'essential': item.get('essential'), 'used': item.get('used'),
+                            'quota_before': item['quota'], 'quota': quota})
+        try:
+            table.meta.client.transact_write_items(TransactItems=writes)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            logger.info('rebalance write conflict', customer_id=customer_id, attempt=attempt + 1,
+                        reasons=[reason.get('Code') for reason in e.response.get('CancellationReasons', [])])
+            continue
+        query_cache.invalidate(dynamodb_table, customer_id)
+        if peaks:
+            update_peak_summary(customer_id, peaks)
+        return {
+            'target_kw': target_kw,
+            'total_before': total,
+            'total_after': total - sum(to_quota(change['quota_before']) - to_quota(change['quota'])
+                                       for change in changes),
+            'changes': changes
+        }
+    return f"Error: the devices of customer {customer_id} kept changing, the quotas were not rebalanced. Try again."
+
+@action_group.action()
+def scan_fleet(max_households=20):
+    """Ranks the households over quota across the whole table, with the load their non-essential devices can shed"""
+    # boto3 resources are not thread safe, each segment is read with its own
+    columns = scan_columns(lambda: new_resource('dynamodb').Table(dynamodb_table), fleet_scan_segments)
+    return fleet_metrics(columns, int(max_households))
+
+@action_group.action()
+def forecast_peak(customer_id):
+    """Forecasts the load of the devices over the next hours, with the devices expected to go over quota"""
+    # Precomputed by utils/load_forecast_batch.py, one item per customer
+    forecast = read_dynamodb(dynamodb_table, dynamodb_pk, customer_id, dynamodb_sk, FORECAST_SUMMARY_KEY)
+    if forecast is None:
+        return f"Error: Unable to read the load forecast of customer {customer_id}"
+    if not forecast:
+        return f"No load forecast for customer {customer_id} yet, the forecast batch job has not fitted its devices"
+    item = forecast[0]
+    start = datetime.fromisoformat(item['forecast_start'])
+
+    def hour(offset):
+        return (start + timedelta(hours=offset)).isoformat(timespec='seconds')
+
+    household, devices = [], []
+    for attr in sorted(attr for attr in item if attr.startswith('device#')):
+        device = item[attr]
+        values = unpack_forecast(device['forecast'])
+        if not values:
+            continue
+        household = [total + value for total, value in zip(household, values)] if household else values
+        limit = PEAK_THRESHOLD * float(to_quota(device.get('quota')))
+        over = [offset for offset, value in enumerate(values) if value > limit]
+        peak = max(range(len(values)), key=values.__getitem__)
+        devices.append({'item_id': attr[len('device#'):], 'item_desc': device.get('item_desc'),
+                        'essential': device.get('essential'), 'quota': device.get('quota'),
+                        'model': device.get('model'), 'peak_kw': values[peak], 'peak_hour': hour(peak),
+                        'hours_over_quota': len(over), 'over_quota_from': hour(over[0]) if over else None})
+    peak = max(range(len(household)), key=household.__getitem__) if household else None
+    return {
+        'customer_id': customer_id,
+        'forecast_start': item['forecast_start'],
+        'fitted_at': item.get('fitted_at'),
+        # Past the last hour forecast, until the batch job runs again
+        'stale': datetime.now(timezone.utc) >= start + timedelta(hours=len(household)),
+        'household': {'peak_kw': round(household[peak], 2) if household else None,
+                      'peak_hour': hour(peak) if household else None,
+                      'load': [round(value, 2) for value in household]},
+        'expected_peaks': [device['item_id'] for device in devices if device['hours_over_quota']],
+        'devices': devices
+    }
+
+def refresh_peak(customer_id, item):
+    # Checks the peak of a device whose readings are ingested against its quota, after a quota change
+    if 'load_readings' not in item:
+        return
+    was_peak = item.get('peak') == 'True'
+    peak = DeviceLoad.from_item(item).is_peak(item.get('quota', 0), was_peak)
+    if peak != was_peak:
+        get_table(dynamodb_table).update_item(
+            Key={dynamodb_pk: customer_id, dynamodb_sk: item['item_id']},
+            UpdateExpression='SET #peak = :peak' if peak else 'REMOVE #peak',
+            ExpressionAttributeNames={'#peak': 'peak'},
+            **({'ExpressionAttributeValues': {':peak': 'True'}} if peak else {})
+        )
+    if peak or was_peak:
+        update_peak_summary(customer_id, {item['item_id']: peak_entry({**item, 'peak': 'True'}) if peak else None})
+
+
+def lambda_handler(event, context):
+    # Meter readings sent directly, e.g. by an AWS IoT rule, rather than through the agent
+    if 'readings' in event and 'function' not in event:
+        return ingest_readings(str(event.get('customer_id', '')), event['readings'])
+    response = action_group.handle(event)
+    logger.debug('query cache', **query_cache.stats())
     return response
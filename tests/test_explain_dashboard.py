@@ -0,0 +1,42 @@
+"""explain_dashboard responses stay valid JSON within the response budget, for large dashboards."""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.explain_benchmark import MODULES, VISUALIZATION_TYPES, load_module, visualization
+from utils.response_helper import DEFAULT_MAX_CHARS, SHORTENED_MARKER, fit_texts
+
+
+def _event(function, **parameters):
+    return {'messageVersion': '1.0', 'actionGroup': 'test', 'function': function,
+            'parameters': [{'name': name, 'type': 'string', 'value': value} for name, value in parameters.items()]}
+
+
+@pytest.mark.parametrize("module_name", list(MODULES))
+@pytest.mark.parametrize("charts", [12, 40])
+def test_explain_dashboard_body_parses(module_name, charts):
+    module = load_module(module_name)
+    visualizations = [{**visualization(module_name, VISUALIZATION_TYPES[_i % 4], 24, seed=_i),
+                       'visualization_id': f"chart_{_i}", 'customer_id': '1'} for _i in range(charts)]
+    response = module.lambda_handler(_event('explain_dashboard', visualizations=json.dumps(visualizations)), None)
+    body = response['response']['functionResponse']['responseBody']['TEXT']['body']
+
+    result = json.loads(body)
+    assert len(body) <= DEFAULT_MAX_CHARS
+    assert result['errors'] == []
+    assert list(result['explanations']) + result.get('truncated', []) == [f"chart_{_i}" for _i in range(charts)]
+    assert all(_explanation for _explanation in result['explanations'].values())
+
+
+def test_fit_texts_keeps_short_texts_whole():
+    texts = {'short': 'A short explanation.', 'long': 'word ' * 2000}
+    fitted, dropped = fit_texts(texts, 1000)
+    assert dropped == []
+    assert fitted['short'] == texts['short']
+    assert fitted['long'].endswith(SHORTENED_MARKER)
+    assert len(json.dumps(fitted, separators=(',', ':'))) <= 1000
@@ -0,0 +1,63 @@
+"""generate_projections does not extrapolate stale histories nor turn a falling forecast into withdrawals."""
+
+import importlib.util
+import os
+import sys
+
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+@pytest.fixture
+def analytics():
+    spec = importlib.util.spec_from_file_location(
+        "financial_analytics", os.path.join(_root, "1-data-analytics/financial_analytics.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.truncated_month = datetime(2026, 10, 1)
+    return module
+
+
+def _history(amounts, last_day):
+    last_month = int(last_day[:4]) * 12 + int(last_day[5:7]) - 1
+    return [{'customer_id': '1', 'day': f"{(last_month - _i) // 12:04d}/{(last_month - _i) % 12 + 1:02d}/01",
+             'transactionAmount': str(_amount), 'type': 'actual', 'transactionType': 'deposit'}
+            for _i, _amount in enumerate(reversed(amounts))]
+
+
+def _project(analytics, history, method='linear_trend', horizon_months=3):
+    customer_ids, last_months, matrix = analytics.history_matrix({'1': history})
+    forecast = analytics.project_series(matrix, analytics.forecast_length(last_months, horizon_months), method)[0]
+    return analytics.projection_items('1', last_months[0], forecast, horizon_months,
+                                      analytics.transaction_types(history))
+
+
+def test_stale_history_is_not_projected(analytics):
+    # Sample customer 1: deposits falling from 2000 to 1460, ending 2025/03
+    history = _history([2000, 1850, 1700, 1580, 1440.5, 1460.75], '2025/03/01')
+    assert analytics.history_gap(analytics.month_index('2025/03/01')) > analytics.projection_max_gap_months
+    assert _project(analytics, history) == []
+    analytics.get_historical_transactions = lambda customer_id: history
+    reply = analytics.generate_projections('1', 3, 'linear_trend')
+    assert isinstance(reply, str) and 'too old to project' in reply
+
+
+def test_falling_deposits_are_not_projected_as_withdrawals(analytics):
+    history = _history([900, 600, 300, 100], '2026/09/01')
+    items = _project(analytics, history)
+    assert [item['day'] for item in items] == ['2026/10/01', '2026/11/01', '2026/12/01']
+    assert {item['transactionType'] for item in items} == {'deposit'}
+    assert [float(item['transactionAmount']) for item in items] == [0.0, 0.0, 0.0]
+
+
+def test_recent_history_is_projected_from_the_current_month(analytics):
+    history = _history([1000, 1100, 1200], '2026/08/01')
+    items = _project(analytics, history)
+    # One month of gap is bridged by the fit, the projections start at the current month
+    assert [item['day'] for item in items] == ['2026/10/01', '2026/11/01', '2026/12/01']
+    assert [float(item['transactionAmount']) for item in items] == [1400.0, 1500.0, 1600.0]
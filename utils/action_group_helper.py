@@ -0,0 +1,241 @@
+"""Function registry and dispatch shared by the action group Lambda functions.
+
+Each Lambda registers its functions once, at import time, and hands the
+event to the registry:
+
+    >>> from utils.action_group_helper import ActionGroup
+    >>> action_group = ActionGroup()
+    >>> @action_group.action()
+    ... def get_ticket_status(customer_id, ticket_id=None):
+    ...     ...
+    >>> def lambda_handler(event, context):
+    ...     return action_group.handle(event)
+
+The parameters of an event are read into a dict once per invocation, coerced
+to the type declared for them, and passed to the function by name. Parameter
+types come from the agent_api_definition.json packaged next to the Lambda
+source file, when there is one, and otherwise from the type the agent sends
+with each parameter. Unknown functions, missing parameters, values that do not
+match their type and exceptions raised by a function all end up as an
+"Error, ..." response body.
+"""
+
+import inspect
+import json
+import os
+import time
+
+from typing import Callable, Dict
+
+from utils.client_helper import call_stats, reset_call_stats
+from utils.log_helper import item_count, logger
+from utils.response_helper import compact_response
+
+# Name of the API definition create_lambda packages next to the Lambda source file
+API_DEFINITION_FILE = "agent_api_definition.json"
+
+
+class ActionError(Exception):
+    """Raised for an invocation that cannot be dispatched, its message is the response body."""
+
+
+def load_api_definition(path: str) -> Dict[str, Dict[str, str]]:
+    """Reads the parameter types of every function of an agent_api_definition.json.
+
+    Args:
+        path (str): path to the API definition file
+
+    Returns:
+        Dict[str, Dict[str, str]]: function name -> parameter name -> type. Empty if the file is missing.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        _definition = json.load(f)
+
+    _types = {}
+    for _group in _definition.get('actionGroups', []):
+        for _action in _group.get('actions', []):
+            _schema = _action.get('inputSchema', {})
+            if isinstance(_schema, str):
+                _schema = json.loads(_schema)
+            _types[_action['name']] = {
+                _name: _prop.get('type', 'string') for _name, _prop in _schema.get('properties', {}).items()
+            }
+    return _types
+
+
+def _coerce_array(value):
+    try:
+        _value = json.loads(value)
+    except json.JSONDecodeError:
+        return [_part.strip() for _part in value.split(',') if _part.strip()]
+    return _value if isinstance(_value, list) else [_value]
+
+
+def _coerce_boolean(value):
+    if value.strip().lower() in ('true', 'yes', '1'):
+        return True
+    if value.strip().lower() in ('false', 'no', '0'):
+        return False
+    raise ValueError(value)
+
+
+def _coerce_integer(value):
+    _value = float(value)
+    if not _value.is_integer():
+        raise ValueError(value)
+    return int(_value)
+
+
+def _coerce_number(value):
+    _value = float(value)
+    return int(_value) if _value.is_integer() and '.' not in value else _value
+
+
+COERCERS = {
+    'string': str,
+    'integer': _coerce_integer,
+    'number': _coerce_number,
+    'boolean': _coerce_boolean,
+    'array': _coerce_array
+}
+
+
+class ActionGroup:
+    """Registry of the functions of an action group Lambda."""
+
+    def __init__(self, api_definition: str = None):
+        """Constructs an instance.
+
+        Args:
+            api_definition (str, Optional): path of the agent_api_definition.json declaring the parameter types.
+            Defaults to the file packaged next to the Lambda source file, if any.
+        """
+        if api_definition is None:
+            api_definition = os.path.join(os.environ.get('LAMBDA_TASK_ROOT', os.getcwd()), API_DEFINITION_FILE)
+        self._types = load_api_definition(api_definition)
+        self._actions = {}
+
+    def register(self, name: str, func: Callable, **param_names) -> None:
+        """Registers a function of the action group.
+
+        Args:
+            name (str): function name, as declared to the agent
+            func (Callable): implementation, called with the parameters matching its argument names
+            **param_names: agent parameter name of the arguments named differently, e.g. customer_profile="data"
+        """
+        _args = []
+        for _arg in inspect.signature(func).parameters.values():
+            _required = _arg.default is inspect.Parameter.empty
+            _args.append((_arg.name, param_names.get(_arg.name, _arg.name), _required))
+        self._actions[name] = (func, _args, self._types.get(name, {}))
+
+    def action(self, name: str = None, **param_names) -> Callable:
+        """Decorator registering a function, under its own name by default. See register."""
+        def _decorator(func):
+            self.register(name or func.__name__, func, **param_names)
+            return func
+        return _decorator
+
+    @property
+    def functions(self):
+        return list(self._actions)
+
+    def parameters(self, event: Dict, types: Dict[str, str] = None) -> Dict:
+        """Reads the parameters of an event into a dict, coerced to their declared type."""
+        types = types or {}
+        _params = {}
+        for _param in event.get('parameters') or []:
+            _name, _value = _param['name'], _param.get('value')
+            _type = types.get(_name) or _param.get('type') or 'string'
+            if isinstance(_value, str) and _type in COERCERS:
+                try:
+                    _value = COERCERS[_type](_value)
+                except (ValueError, TypeError):
+                    raise ActionError(f"Error, parameter '{_name}' must be of type {_type}, got: {_value}")
+            _params[_name] = _value
+        return _params
+
+    def invoke(self, event: Dict):
+        """Calls the function an event asks for and returns its result, or an error message."""
+        return self._dispatch(event)[0]
+
+    def _dispatch(self, event: Dict):
+        # Returns the result and the time spent in the function itself
+        _function = event.get('function', '')
+        if _function not in self._actions:
+            return f"Error, function '{_function}' not recognized", 0.0
+        _func, _args, _types = self._actions[_function]
+        _start = None
+        try:
+            _params = self.parameters(event, _types)
+            _kwargs = {}
+            for _arg, _param, _required in _args:
+                if _params.get(_param) is not None:
+                    _kwargs[_arg] = _params[_param]
+                elif _required:
+                    raise ActionError(f"Error, function '{_function}' is missing parameter '{_param}'")
+            _start = time.perf_counter()
+            _result = _func(**_kwargs)
+            return _result, time.perf_counter() - _start
+        except ActionError as e:
+            return str(e), 0.0
+        except Exception as e:
+            logger.error('function failed', function=_function, error=repr(e))
+            return f"Error, function '{_function}' failed: {e}", time.perf_counter() - _start if _start else 0.0
+
+    def handle(self, event: Dict) -> Dict:
+        """Handles a Lambda event: dispatches it and wraps the result in an action group response.
+
+        The AWS calls made by the function (see utils.client_helper) are returned in the
+        session attributes of the response as aws_calls, aws_retries and aws_throttles,
+        alongside the attributes the event came with. A function that returned None
+        after throttled calls gets an error body saying so.
+
+        The event and the response are logged for a sample of the invocations, and for
+        every failed one (see utils.log_helper). The invocation itself is always logged
+        with its metrics: duration, dispatch overhead (parameter parsing, coercion and
+        serialization, without the time spent in the function), item count, response
+        size and AWS calls.
+        """
+        _function = event.get('function')
+        _sampled = logger.sampled(_function)
+        if _sampled:
+            logger.info('event', function=_function, payload=logger.payload(event))
+        _start = time.perf_counter()
+        reset_call_stats()
+        _result, _function_time = self._dispatch(event)
+        _calls = call_stats()
+        if _calls['throttles'] and _result is None:
+            _result = (f"Error, function '{_function}' was throttled by the table "
+                       f"({_calls['throttles']} throttled requests), retry later")
+
+        _body = compact_response(_result)
+        response = {'response': {'actionGroup': event.get('actionGroup'), 'function': _function,
+                                 'functionResponse': {'responseBody': {'TEXT': {'body': _body}}}}}
+        if _calls['calls']:
+            response['sessionAttributes'] = {**(event.get('sessionAttributes') or {}),
+                                             **{f"aws_{_key}": str(_val) for _key, _val in _calls.items()}}
+        _duration = time.perf_counter() - _start
+        _error = isinstance(_result, str) and _result.startswith('Error')
+        if _error and not _sampled:
+            logger.warning('event', function=_function, payload=logger.payload(event))
+        if _sampled or _error:
+            logger.log('WARNING' if _error else 'INFO', 'response', function=_function,
+                       payload=logger.payload(response))
+        logger.metrics(
+            {'ActionGroup': str(event.get('actionGroup')), 'Function': str(_function)},
+            {'Duration': round(_duration * 1e3, 3),
+             'DispatchOverhead': round((_duration - _function_time) * 1e6),
+             'ItemCount': item_count(_result),
+             'ResponseSize': len(_body.encode()),
+             'Errors': int(_error),
+             'AWSCalls': _calls['calls'],
+             'AWSRetries': _calls['retries'],
+             'AWSThrottles': _calls['throttles']},
+            {'Duration': 'Milliseconds', 'DispatchOverhead': 'Microseconds', 'ItemCount': 'Count',
+             'ResponseSize': 'Bytes', 'Errors': 'Count', 'AWSCalls': 'Count', 'AWSRetries': 'Count',
+             'AWSThrottles': 'Count'}
+        )
+        return response
@@ -33,18 +33,18 @@ import boto3
 import json
 import time
 import uuid
-import zipfile
 from dateutil.tz import tzutc
 import os
 import datetime
 from dateutil.relativedelta import relativedelta
 import random
-from io import BytesIO
 from typing import List, Dict, Tuple
 import re
 from boto3.session import Session
 from botocore.config import Config
 from boto3.dynamodb.conditions import Key
+from utils.dynamodb_helper import add_index_keys, index_key_name
+from utils.lambda_package_helper import build_lambda_package
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 from IPython.display import display, Markdown
@@ -295,14 +295,26 @@ class AgentsForAmazonBedrock:
                         "Effect": "Allow",
                         "Action": [
                             "dynamodb:GetItem",
+                            "dynamodb:BatchGetItem",
                             "dynamodb:PutItem",
+                            "dynamodb:BatchWriteItem",
                             "dynamodb:DeleteItem",
                             "dynamodb:Query",
+                            "dynamodb:Scan",
                             "dynamodb:UpdateItem"
                         ],
                         "Resource": "arn:aws:dynamodb:{}:{}:table/{}".format(
                             self._region, self._account_id, dynamodb_table_name
                         )
+                    },
+                    {
+                        "Effect": "Allow",
+                        "Action": [
+                            "dynamodb:Query"
+                        ],
+                        "Resource": "arn:aws:dynamodb:{}:{}:table/{}/index/*".format(
+                            self._region, self._account_id, dynamodb_table_name
+                        )
                     }
                 ]
             }
@@ -478,7 +490,9 @@ class AgentsForAmazonBedrock:
             source_code_file: str,
             additional_function_iam_policy: Dict = None,
             sub_agent_arns: List[str] = None,
-            dynamo_args: List[str] = None
+            dynamo_args: List[str] = None,
+            layers: List[str] = None,
+            compile_bytecode: bool = False
     ) -> str:
         """Creates a new Lambda function that implements a set of actions for an Agent Action Group.
 
@@ -489,6 +503,11 @@ class AgentsForAmazonBedrock:
             Must be a local file, and use underscores, not hyphens.
             additional_function_iam_policy (Dict, Optional): Additional IAM policy to attach to the Lambda function. Defaults to None.
             sub_agent_arns (List[str], Optional): List of ARNs of the sub-agents that this Lambda is allowed to invoke.
+            dynamo_args (List, Optional): [table name, partition key, sort key] of the DynamoDB table used by the Lambda,
+            optionally followed by a list of secondary index definitions (see create_dynamodb).
+            layers (List[str], Optional): ARNs of Lambda layers to attach, e.g. one providing NumPy.
+            compile_bytecode (bool, Optional): package precompiled bytecode to shorten cold starts. Only done
+            when the local Python version matches the Lambda runtime. Defaults to False.
 
         Returns:
             str: ARN of the new Lambda function
@@ -500,12 +519,8 @@ class AgentsForAmazonBedrock:
 
         _base_filename = source_code_file.split(".py")[0]
 
-        # Package up the lambda function code
-        s = BytesIO()
-        z = zipfile.ZipFile(s, "w")
-        z.write(f"{source_code_file}")
-        z.close()
-        zip_content = s.getvalue()
+        # Package up the lambda function code with the shared modules it imports
+        zip_content = build_lambda_package(source_code_file, compile_bytecode, PYTHON_RUNTIME)
         if sub_agent_arns:
             env_variables = {
                 "Variables": {
@@ -524,14 +539,18 @@ class AgentsForAmazonBedrock:
                 agent_name, sub_agent_arns, dynamodb_table_name=dynamo_args[0]
             )
             # create DynamoDB Table to be used on Lambda Code
+            _indexes = dynamo_args[3] if len(dynamo_args) > 3 else None
             self.create_dynamodb(
                 dynamo_args[0],
                 dynamo_args[1],
-                dynamo_args[2]
+                dynamo_args[2],
+                indexes=_indexes
             )
             env_variables['Variables']['dynamodb_table'] = dynamo_args[0]
             env_variables['Variables']['dynamodb_pk'] = dynamo_args[1]
             env_variables['Variables']['dynamodb_sk'] = dynamo_args[2]
+            if _indexes:
+                env_variables['Variables']['dynamodb_indexes'] = ",".join(_index['name'] for _index in _indexes)
         else:
             lambda_role = self._create_lambda_iam_role(
                 agent_name, sub_agent_arns
@@ -546,7 +565,8 @@ class AgentsForAmazonBedrock:
             Code={"ZipFile": zip_content},
             Handler=f"{_base_filename}.lambda_handler",
             # TODO: make this an optional keyword arg. only supply it when sub-agent-arns are provided
-            Environment=env_variables
+            Environment=env_variables,
+            Layers=layers or []
         )
 
         self._allow_agent_lambda(_agent_id, lambda_function_name)
@@ -1137,6 +1157,8 @@ class AgentsForAmazonBedrock:
             additional_function_iam_policy: Dict = None,
             sub_agent_arns: List[str] = None,
             dynamo_args: List[str] = None,
+            layers: List[str] = None,
+            compile_bytecode: bool = False,
             verbose: bool = False
     ) -> None:
         """Adds an action group to an existing agent, creates a Lambda function to
@@ -1152,6 +1174,9 @@ class AgentsForAmazonBedrock:
             agent_action_group_description (str): description of the agent action group
             additional_function_iam_policy (Dict, Optional): additional IAM policy to attach to the Lambda function
             sub_agent_arns (List[str], Optional): list of ARNs of sub-agents (if any) to permit the Lambda to invoke
+            dynamo_args (List, Optional): DynamoDB table arguments, see create_lambda
+            layers (List[str], Optional): ARNs of Lambda layers to attach to the new Lambda function
+            compile_bytecode (bool, Optional): package precompiled bytecode, see create_lambda
         """
 
         _agent_id = self.get_agent_id_by_name(agent_name)
@@ -1167,7 +1192,9 @@ class AgentsForAmazonBedrock:
                 source_code_file,
                 additional_function_iam_policy=additional_function_iam_policy,
                 sub_agent_arns=sub_agent_arns,
-                dynamo_args=dynamo_args
+                dynamo_args=dynamo_args,
+                layers=layers,
+                compile_bytecode=compile_bytecode
             )
 
         self.wait_agent_status_update(_agent_id)
@@ -1921,7 +1948,52 @@ class AgentsForAmazonBedrock:
 
         return _update_agent_response
 
-    def create_dynamodb(self, table_name, pk_item, sk_item):
+    def create_dynamodb(self, table_name, pk_item, sk_item, indexes: List[Dict] = None):
+        """Creates an on-demand DynamoDB table, optionally with secondary indexes.
+
+        Args:
+            table_name (str): name of the table
+            pk_item (str): partition key attribute
+            sk_item (str): sort key attribute
+            indexes (List[Dict], Optional): secondary index definitions. Each one has a "name",
+            a "partition_key" and an optional "sort_key", given as an attribute name or as a list
+            of attribute names for a composite key (see utils.dynamodb_helper.add_index_keys).
+            "projection" is "ALL" (default), "KEYS_ONLY" or a list of attributes to include, and
+            "local": True creates a local secondary index on the table partition key. e.g.:
+                {"name": "customer-type-day-index", "partition_key": "customer_id", "sort_key": ["type", "day"]}
+                {"name": "customer-peak-index", "partition_key": "customer_id", "sort_key": "peak"}
+        """
+        _key_attributes = [pk_item, sk_item]
+        _global_indexes = []
+        _local_indexes = []
+        for _index in indexes or []:
+            _key_schema = [{'AttributeName': index_key_name(_index['partition_key']), 'KeyType': 'HASH'}]
+            if _index.get('sort_key'):
+                _key_schema.append({'AttributeName': index_key_name(_index['sort_key']), 'KeyType': 'RANGE'})
+            _key_attributes += [_key['AttributeName'] for _key in _key_schema]
+
+            _projection = _index.get('projection', 'ALL')
+            if isinstance(_projection, str):
+                _projection = {'ProjectionType': _projection}
+            else:
+                _projection = {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': list(_projection)}
+
+            _definition = {
+                'IndexName': _index['name'],
+                'KeySchema': _key_schema,
+                'Projection': _projection
+            }
+            if _index.get('local'):
+                _local_indexes.append(_definition)
+            else:
+                _global_indexes.append(_definition)
+
+        _table_args = {}
+        if _global_indexes:
+            _table_args['GlobalSecondaryIndexes'] = _global_indexes
+        if _local_indexes:
+            _table_args['LocalSecondaryIndexes'] = _local_indexes
+
         try:
             table = self._dynamodb_resource.create_table(
                 TableName=table_name,
@@ -1937,15 +2009,13 @@ class AgentsForAmazonBedrock:
                 ],
                 AttributeDefinitions=[
                     {
-                        'AttributeName': pk_item,
-                        'AttributeType': 'S'
-                    },
-                    {
-                        'AttributeName': sk_item,
+                        'AttributeName': _attribute,
                         'AttributeType': 'S'
                     }
+                    for _attribute in dict.fromkeys(_key_attributes)
                 ],
-                BillingMode='PAY_PER_REQUEST'  # Use on-demand capacity mode
+                BillingMode='PAY_PER_REQUEST',  # Use on-demand capacity mode
+                **_table_args
             )
 
             # Wait for the table to be created
@@ -1958,13 +2028,26 @@ class AgentsForAmazonBedrock:
     def load_dynamodb(
             self,
             table_name: str,
-            items: List
+            items: List,
+            indexes: List[Dict] = None,
+            on_write=None
     ):
+        """Writes items to a DynamoDB table.
+
+        Args:
+            table_name (str): name of the table
+            items (List): items to write
+            indexes (List[Dict], Optional): secondary index definitions, used to fill in composite index keys
+            on_write (Optional): called as on_write(new_item, old_item) after each write, where old_item is
+            the item that was replaced (or None), e.g. to maintain aggregates incrementally
+        """
         try:
 
             table = self._dynamodb_resource.Table(table_name)
             for item in items:
-                table.put_item(Item=item)
+                _resp = table.put_item(Item=add_index_keys(item, indexes), ReturnValues='ALL_OLD')
+                if on_write:
+                    on_write(item, _resp.get('Attributes'))
         except self._dynamodb_client.exceptions.ResourceInUseException:
             print(f'Error on loading process for table: {table_name}.')
 
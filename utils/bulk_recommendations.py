@@ -0,0 +1,245 @@
+"""Scores the product recommendations of a whole customer file, offline.
+
+Runs the rules of the recommend_financial_products tool of the customer
+insights Lambda (utils.recommendation_engine) over every profile of a JSONL
+file, one profile per line in the format of the tool, or of a Parquet file
+with one column per profile field. Profiles are read in chunks, each chunk is
+scored column by column (with NumPy when installed, see recommend_columns) in
+a pool of worker processes, and the results are written as they come, in the
+order of the input, one JSON line per profile:
+
+    {"customer_id": "42", "products": ["Everyday Checking", "High-Yield Savings"]}
+    {"customer_id": "43", "error": "'<' not supported between instances of 'str' and 'int'"}
+
+At most two chunks per worker are read ahead of the writer, so memory stays
+bounded whatever the size of the file. The throughput is reported as the
+chunks complete and at the end. Run it from the root of the repository:
+
+    python utils/bulk_recommendations.py customers.jsonl recommendations.jsonl
+    python utils/bulk_recommendations.py customers.parquet recommendations.jsonl --workers 8 --chunk-size 100000
+    python utils/bulk_recommendations.py --synthetic 1000000 /dev/null
+
+--synthetic scores generated profiles (see utils.recommendation_benchmark)
+instead of a file. Reading Parquet files requires pyarrow, which is not needed
+otherwise.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.recommendation_engine import PROFILE_DEFAULTS, decision_table
+
+# Profiles scored per task of the pool
+CHUNK_SIZE = 50000
+
+
+def _scored_line(customer_id, recommendations=None, error=None) -> str:
+    if error is not None:
+        return json.dumps({'customer_id': customer_id, 'error': error})
+    return json.dumps({'customer_id': customer_id, 'products': [_rec['product_name'] for _rec in recommendations]})
+
+
+def _scored_lines(customer_ids, results):
+    # Output lines of scored profiles. recommend_columns shares the list of the profiles with the same
+    # recommendations, whose products are encoded once
+    _products = {}
+    _lines = []
+    for customer_id, recommendations in zip(customer_ids, results):
+        _encoded = _products.get(id(recommendations))
+        if _encoded is None:
+            _encoded = _products[id(recommendations)] = json.dumps([_rec['product_name'] for _rec in recommendations])
+        _lines.append(f'{{"customer_id": {json.dumps(customer_id)}, "products": {_encoded}}}')
+    return _lines
+
+
+def _score_profiles(profiles, customer_ids):
+    # (output lines, errors) of profiles, scored one by one when a malformed profile fails the chunk
+    table = decision_table()
+    try:
+        results = table.recommend_columns(table.to_columns(profiles))
+        return _scored_lines(customer_ids, results), 0
+    except (TypeError, ValueError, AttributeError):
+        pass
+    lines, errors = [], 0
+    for customer_id, profile in zip(customer_ids, profiles):
+        try:
+            lines.append(_scored_line(customer_id, table.recommend(profile)))
+        except (TypeError, ValueError, AttributeError) as e:
+            lines.append(_scored_line(customer_id, error=str(e)))
+            errors += 1
+    return lines, errors
+
+
+def score_lines(lines, start):
+    """Scores JSONL lines, the first one being profile number start of the file. Returns (output lines, errors)."""
+    profiles, customer_ids, output = [], [], {}
+    for i, line in enumerate(lines, start + 1):
+        try:
+            profile = json.loads(line)
+        except json.JSONDecodeError as e:
+            output[len(profiles) + len(output)] = _scored_line(f"profile_{i}", error=f"Invalid JSON: {e}")
+            continue
+        if not isinstance(profile, dict):
+            output[len(profiles) + len(output)] = _scored_line(f"profile_{i}", error="Not a JSON object")
+            continue
+        profiles.append(profile)
+        customer_ids.append(str(profile.get('customer_id', f"profile_{i}")))
+    lines, errors = _score_profiles(profiles, customer_ids)
+    if not output:
+        return lines, errors
+    scored = iter(lines)
+    return [output[_i] if _i in output else next(scored) for _i in range(len(lines) + len(output))], \
+        errors + len(output)
+
+
+def score_columns(columns, customer_ids):
+    """Scores profiles read into columns, existing_products included. Returns (output lines, errors)."""
+    table = decision_table()
+    columns = dict(columns)
+    columns['owned_mask'] = [table.owned_mask(_products or []) for _products in columns.pop('existing_products')]
+    try:
+        results = table.recommend_columns(columns)
+    except (TypeError, ValueError, AttributeError):
+        fields = [_field for _field in columns if _field != 'owned_mask']
+        profiles = [dict(zip(fields, _row)) for _row in zip(*(columns[_field] for _field in fields))]
+        return _score_profiles(profiles, customer_ids)
+    return _scored_lines(customer_ids, results), 0
+
+
+def jsonl_chunks(path, chunk_size):
+    """Yields (score_lines, lines, start) tasks of chunk_size lines of a JSONL file, blank lines skipped."""
+    start = 0
+    with open(path) as f:
+        lines = (_line for _line in f if _line.strip())
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                return
+            yield score_lines, chunk, start
+            start += len(chunk)
+
+
+def parquet_chunks(path, chunk_size):
+    """Yields (score_columns, columns, customer_ids) tasks of chunk_size rows of a Parquet file.
+
+    Null values take their PROFILE_DEFAULTS value, like fields missing from a JSON profile.
+    """
+    try:
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Error: reading Parquet files requires pyarrow (pip install pyarrow)")
+
+    parquet_file = pq.ParquetFile(path)
+    names = set(parquet_file.schema_arrow.names)
+    fields = [_field for _field in PROFILE_DEFAULTS if _field in names]
+    read = fields + [_field for _field in ('customer_id', 'existing_products') if _field in names]
+    start = 0
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=read):
+        columns = {}
+        for field in fields:
+            column = batch.column(field)
+            default = PROFILE_DEFAULTS[field]
+            if isinstance(default, (int, float)):
+                columns[field] = pc.fill_null(column, default).to_numpy(zero_copy_only=False)
+            else:
+                columns[field] = [default if _value is None else _value for _value in column.to_pylist()]
+        columns['existing_products'] = batch.column('existing_products').to_pylist() \
+            if 'existing_products' in names else [[]] * batch.num_rows
+        customer_ids = [f"profile_{start + _i + 1}" if _id is None else str(_id) for _i, _id in
+                        enumerate(batch.column('customer_id').to_pylist())] if 'customer_id' in names \
+            else [f"profile_{start + _i + 1}" for _i in range(batch.num_rows)]
+        yield score_columns, columns, customer_ids
+        start += batch.num_rows
+
+
+def score_synthetic(count, start):
+    """Generates count profiles as JSONL lines, numbered from start + 1, and scores them like score_lines."""
+    from utils.recommendation_benchmark import profiles
+    chunk = profiles(count, seed=start)
+    for i, profile in enumerate(chunk, start + 1):
+        profile['customer_id'] = str(i)
+    return score_lines([json.dumps(_profile) for _profile in chunk], start)
+
+
+def synthetic_chunks(count, chunk_size):
+    """Yields (score_synthetic, count, start) tasks of count generated profiles, generated by the workers."""
+    for start in range(0, count, chunk_size):
+        yield score_synthetic, min(chunk_size, count - start), start
+
+
+def _run(task):
+    function, *args = task
+    return function(*args)
+
+
+def run(tasks, output, workers, report=sys.stderr):
+    """Scores tasks in a pool of workers processes (in this process if 0), writing the lines to output in order.
+
+    Returns:
+        Tuple[int, int, float]: profiles scored, profiles in error and the wall time in seconds
+    """
+    start = time.perf_counter()
+    profiles = errors = 0
+
+    def write(result):
+        nonlocal profiles, errors
+        lines, chunk_errors = result
+        output.write('\n'.join(lines) + '\n' if lines else '')
+        profiles += len(lines)
+        errors += chunk_errors
+        elapsed = time.perf_counter() - start
+        print(f"{profiles:>12,} profiles {errors:>9,} errors {elapsed:>8.1f}s {profiles / elapsed:>10,.0f} profiles/s",
+              file=report)
+
+    if workers == 0:
+        for task in tasks:
+            write(_run(task))
+        return profiles, errors, time.perf_counter() - start
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(_run, task))
+            # Bounds the chunks held in memory, read ahead or waiting to be written
+            while len(pending) >= 2 * workers:
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+    return profiles, errors, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", nargs="?", help="JSONL or Parquet (.parquet) file of customer profiles")
+    parser.add_argument("output", help="JSONL file of the recommendations, - for the standard output")
+    parser.add_argument("--synthetic", type=int, default=0, help="score this many generated profiles instead")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes, 0 to score in process")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="profiles per task")
+    args = parser.parse_args()
+    if not args.input and not args.synthetic:
+        parser.error("an input file or --synthetic is required")
+
+    if args.synthetic:
+        tasks = synthetic_chunks(args.synthetic, args.chunk_size)
+    elif args.input.endswith('.parquet'):
+        tasks = parquet_chunks(args.input, args.chunk_size)
+    else:
+        tasks = jsonl_chunks(args.input, args.chunk_size)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        profiles, errors, elapsed = run(tasks, output, args.workers)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f"Scored {profiles:,} profiles ({errors:,} errors) in {elapsed:.1f}s: "
+          f"{profiles / elapsed if elapsed else 0:,.0f} profiles/s", file=sys.stderr)
@@ -0,0 +1,150 @@
+"""Lazily created AWS clients shared by the action group Lambda functions.
+
+Nothing is created at import time: the boto3 session, and each client or
+resource, is built on first use and then reused by every invocation served by
+the same container. All of them come from a single botocore session, so the
+service models are loaded from disk once per container.
+
+Clients are tuned for concurrent agent traffic: a connection pool sized for
+the batch tools, adaptive retries (client side rate limiting when the table
+throttles), tight timeouts and TCP keep-alive. Each setting can be overridden
+with an environment variable of the Lambda function, see client_config. Every
+call made through these clients is counted, with its retries and throttled
+attempts, see call_stats.
+
+    >>> from utils.client_helper import get_table
+    >>> table = get_table('my-table')
+"""
+
+import os
+import threading
+
+from typing import Dict
+
+# botocore sessions are not thread safe, clients and resources are created under this lock
+_lock = threading.RLock()
+_botocore_session = None
+_resources = {}
+_clients = {}
+# Resources standing in for AWS ones, see set_resource
+_overrides = {}
+
+# Error codes of a throttled request, across services
+THROTTLE_ERROR_CODES = {
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'ThrottlingException',
+    'Throttling',
+    'TooManyRequestsException'
+}
+_stats_lock = threading.Lock()
+_call_stats = {'calls': 0, 'retries': 0, 'throttles': 0}
+
+
+def client_config():
+    """Returns the botocore Config of the clients, read from the environment.
+
+    Environment variables (defaults): aws_max_pool_connections (50), aws_retry_mode
+    (adaptive), aws_max_attempts (3, first attempt included), aws_connect_timeout
+    (2 seconds), aws_read_timeout (5 seconds) and aws_tcp_keepalive (true).
+    """
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=int(os.getenv('aws_max_pool_connections', 50)),
+        retries={'mode': os.getenv('aws_retry_mode', 'adaptive'),
+                 'total_max_attempts': int(os.getenv('aws_max_attempts', 3))},
+        connect_timeout=float(os.getenv('aws_connect_timeout', 2)),
+        read_timeout=float(os.getenv('aws_read_timeout', 5)),
+        tcp_keepalive=os.getenv('aws_tcp_keepalive', 'true').lower() == 'true'
+    )
+
+
+def _count_call(parsed=None, **kwargs):
+    _retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    with _stats_lock:
+        _call_stats['calls'] += 1
+        _call_stats['retries'] += _retries
+
+
+def _count_throttle(response=None, **kwargs):
+    # response is (http response, parsed response), None when the request itself failed
+    if response and response[1].get('Error', {}).get('Code') in THROTTLE_ERROR_CODES:
+        with _stats_lock:
+            _call_stats['throttles'] += 1
+
+
+def _instrument(client):
+    client.meta.events.register('after-call', _count_call)
+    client.meta.events.register('needs-retry', _count_throttle)
+    return client
+
+
+def call_stats() -> Dict:
+    """Returns the number of calls, retries and throttled attempts since the last reset."""
+    with _stats_lock:
+        return dict(_call_stats)
+
+
+def reset_call_stats() -> None:
+    """Resets the call counters, e.g. at the start of an invocation."""
+    with _stats_lock:
+        for _key in _call_stats:
+            _call_stats[_key] = 0
+
+
+def get_session():
+    """Returns a boto3 session backed by the botocore session shared across the container."""
+    global _botocore_session
+    import boto3.session
+    import botocore.session
+
+    with _lock:
+        if _botocore_session is None:
+            _botocore_session = botocore.session.get_session()
+        return boto3.session.Session(botocore_session=_botocore_session)
+
+
+def set_resource(service_name: str, resource) -> None:
+    """Makes get_resource and new_resource return the given object for a service, or the AWS
+    resource again when it is None. Used to run the Lambda functions offline, see utils.local_dynamodb.
+    """
+    with _lock:
+        _resources.pop(service_name, None)
+        if resource is None:
+            _overrides.pop(service_name, None)
+        else:
+            _overrides[service_name] = resource
+
+
+def new_resource(service_name: str = 'dynamodb'):
+    """Creates a new boto3 resource, e.g. for a worker thread: resources are not thread safe."""
+    if service_name in _overrides:
+        return _overrides[service_name]
+    with _lock:
+        _resource = get_session().resource(service_name, config=client_config())
+        _instrument(_resource.meta.client)
+        return _resource
+
+
+def get_resource(service_name: str = 'dynamodb'):
+    """Returns the boto3 resource of a service, created on first use."""
+    if service_name not in _resources:
+        with _lock:
+            if service_name not in _resources:
+                _resources[service_name] = new_resource(service_name)
+    return _resources[service_name]
+
+
+def get_client(service_name: str):
+    """Returns the boto3 client of a service, created on first use. Clients are thread safe."""
+    if service_name not in _clients:
+        with _lock:
+            if service_name not in _clients:
+                _clients[service_name] = _instrument(get_session().client(service_name, config=client_config()))
+    return _clients[service_name]
+
+
+def get_table(table_name: str):
+    """Returns a DynamoDB Table resource, creating the DynamoDB resource on first use."""
+    return get_resource('dynamodb').Table(table_name)
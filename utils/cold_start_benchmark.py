@@ -0,0 +1,104 @@
+"""Measures the cold start of the action group Lambda functions.
+
+Each handler module is packaged with build_lambda_package, extracted to a
+temporary folder and then, in a fresh interpreter per run, imported and
+invoked once with a sample event. The extracted folder is treated as read-only
+(no bytecode is written to it), like the function code folder of a Lambda
+container, so each module is measured both from sources and with precompiled
+bytecode. Run it from the root of the repository:
+
+    python utils/cold_start_benchmark.py --runs 10
+
+The handlers backed by DynamoDB read the table named by the dynamodb_table,
+dynamodb_pk and dynamodb_sk environment variables, so their first invocation
+needs AWS credentials and a loaded table to be representative. Without them
+the invocation still creates the DynamoDB client and then fails, and its error
+is reported in the response body. The explain_* handlers need nothing.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.lambda_package_helper import build_lambda_package
+
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def _event(function, **parameters):
+    return {'actionGroup': 'benchmark', 'function': function,
+            'parameters': [{'name': name, 'type': 'string', 'value': value} for name, value in parameters.items()]}
+
+
+_cash_flow = {'months': ['Jan', 'Feb', 'Mar'], 'income': [5000, 5200, 5100], 'expenses': [4200, 4800, 3900],
+              'data_points': [{'month': 'Jan', 'income': 5000, 'expenses': 4200},
+                              {'month': 'Feb', 'income': 5200, 'expenses': 4800}]}
+
+# Handler module -> sample event of its first invocation
+HANDLERS = {
+    "1-data-analytics/financial_analytics.py": _event('get_transaction_statistics', customer_id='1'),
+    "2-customer-insights/customer_insights.py": _event('explain_cash_flow', customer_id='1', data=json.dumps(_cash_flow)),
+    "2-customer-insights/lambda_function.py": _event('explain_cash_flow', customer_id='1', data=json.dumps(_cash_flow)),
+    "2-solar-panel/solar_energy.py": _event('get_ticket_status', customer_id='1'),
+    "3-peak-load-manager/peak_load.py": _event('detect_peak', customer_id='1'),
+}
+
+# Runs in a fresh interpreter: prints the import and first invocation times in ms
+_PROBE = """
+import io, json, sys, time
+_start = time.perf_counter()
+import {module} as handler
+_imported = time.perf_counter()
+_stdout, sys.stdout = sys.stdout, io.StringIO()
+response = handler.lambda_handler(json.loads(sys.argv[1]), None)
+_invoked = time.perf_counter()
+sys.stdout = _stdout
+print(json.dumps({{'import_ms': (_imported - _start) * 1e3, 'invoke_ms': (_invoked - _imported) * 1e3,
+                  'body': response['response']['functionResponse']['responseBody']['TEXT']['body'][:80]}}))
+"""
+
+
+def measure(source_code_file, event, compile_bytecode, runs):
+    zip_content = build_lambda_package(os.path.join(_root, source_code_file), compile_bytecode)
+    module = os.path.basename(source_code_file).split(".py")[0]
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with tempfile.TemporaryDirectory() as task_root:
+        zipfile.ZipFile(BytesIO(zip_content)).extractall(task_root)
+        env["LAMBDA_TASK_ROOT"] = task_root
+        results = []
+        for _ in range(runs):
+            out = subprocess.run([sys.executable, "-c", _PROBE.format(module=module), json.dumps(event)],
+                                 cwd=task_root, env=env, capture_output=True, text=True)
+            if out.returncode != 0:
+                raise RuntimeError(out.stderr)
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {
+        'import_ms': statistics.median(r['import_ms'] for r in results),
+        'invoke_ms': statistics.median(r['invoke_ms'] for r in results),
+        'body': results[-1]['body']
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters per module and mode")
+    parser.add_argument("--modules", nargs="*", default=list(HANDLERS), help="handler modules to measure")
+    args = parser.parse_args()
+
+    print(f"{'module':<42} {'mode':<9} {'import ms':>10} {'1st call ms':>12} {'total ms':>9}")
+    for source_code_file in args.modules:
+        for mode, compile_bytecode in (("source", False), ("bytecode", True)):
+            result = measure(source_code_file, HANDLERS[source_code_file], compile_bytecode, args.runs)
+            print(f"{source_code_file:<42} {mode:<9} {result['import_ms']:>10.1f} {result['invoke_ms']:>12.1f} "
+                  f"{result['import_ms'] + result['invoke_ms']:>9.1f}")
+        print(f"{'':<42} response: {result['body']}")
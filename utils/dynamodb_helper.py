@@ -0,0 +1,260 @@
+"""DynamoDB read helpers shared by the action group Lambda functions.
+
+This module is packaged next to each Lambda source file by
+AgentsForAmazonBedrock.create_lambda, so it must only depend on boto3 and the
+standard library. Here is a quick example of using the paginated reader:
+
+    >>> from boto3.dynamodb.conditions import Key
+    >>> from utils.dynamodb_helper import iter_query
+    >>> table = boto3.resource('dynamodb').Table('my-table')
+    >>> for item in iter_query(table, Key('customer_id').eq('1'),
+    ...                        projection=['day', 'transactionAmount'],
+    ...                        page_size=100):
+    ...     print(item)
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Tuple
+
+
+def index_key_name(key) -> str:
+    """Returns the attribute name backing a secondary index key.
+
+    Index keys are declared either as a single attribute name or as a list of
+    attribute names, in which case the key is a composite attribute named after
+    its parts, e.g. ['type', 'day'] is stored as 'type_day'.
+    """
+    return key if isinstance(key, str) else '_'.join(key)
+
+
+def add_index_keys(item: Dict, indexes: List[Dict] = None) -> Dict:
+    """Adds the composite attributes backing the given secondary indexes to an item.
+
+    Composite values join their parts with '#', e.g. type_day = 'actual#2025/03/01'.
+    Items missing any of the parts are left out of the index (sparse index).
+
+    Args:
+        item (Dict): item about to be written, updated in place
+        indexes (List[Dict], Optional): index definitions, see AgentsForAmazonBedrock.create_dynamodb
+
+    Returns:
+        Dict: the same item
+    """
+    for _index in indexes or []:
+        for _key in (_index.get('partition_key'), _index.get('sort_key')):
+            if _key and not isinstance(_key, str) and all(_part in item for _part in _key):
+                item[index_key_name(_key)] = '#'.join(str(item[_part]) for _part in _key)
+    return item
+
+
+def projection_args(fields: List[str] = None) -> Dict:
+    """Builds the ProjectionExpression arguments for a list of attribute names.
+
+    Placeholders are always used since several of the attributes read by the
+    agents (day, type, status, ...) are DynamoDB reserved words.
+
+    Args:
+        fields (List[str], Optional): attribute names to fetch. Defaults to None (all attributes).
+
+    Returns:
+        Dict: keyword arguments to merge into a query or scan request
+    """
+    if not fields:
+        return {}
+    _names = {f"#p{i}": field for i, field in enumerate(fields)}
+    return {
+        'ProjectionExpression': ', '.join(_names.keys()),
+        'ExpressionAttributeNames': _names
+    }
+
+
+def query_pages(
+        table,
+        key_condition,
+        filter_expression=None,
+        projection: List[str] = None,
+        page_size: int = None,
+        index_name: str = None,
+        scan_forward: bool = True
+) -> Iterator[List[Dict]]:
+    """Yields the pages of a query, following LastEvaluatedKey lazily.
+
+    The next page is only requested when the caller asks for it, so stopping the
+    iteration early stops reading from the table.
+
+    Args:
+        table: boto3 DynamoDB Table resource
+        key_condition: boto3 key condition expression
+        filter_expression (Optional): boto3 condition applied after the read. Defaults to None.
+        projection (List[str], Optional): attribute names to fetch. Defaults to None (all attributes).
+        page_size (int, Optional): hint for the number of items read per request. Defaults to None.
+        index_name (str, Optional): secondary index to query. Defaults to None (base table).
+        scan_forward (bool, Optional): sort key order, False for descending. Defaults to True.
+    """
+    _args = {'KeyConditionExpression': key_condition}
+    if filter_expression is not None:
+        _args['FilterExpression'] = filter_expression
+    if page_size:
+        _args['Limit'] = page_size
+    if index_name:
+        _args['IndexName'] = index_name
+    if not scan_forward:
+        _args['ScanIndexForward'] = False
+
+    _projection = projection_args(projection)
+    _start_key = None
+    while True:
+        _request = dict(_args)
+        if _projection:
+            _request['ProjectionExpression'] = _projection['ProjectionExpression']
+            # boto3 adds its own placeholders to this dict, so hand it a fresh copy
+            _request['ExpressionAttributeNames'] = dict(_projection['ExpressionAttributeNames'])
+        if _start_key:
+            _request['ExclusiveStartKey'] = _start_key
+
+        _resp = table.query(**_request)
+        yield _resp.get('Items', [])
+
+        _start_key = _resp.get('LastEvaluatedKey')
+        if not _start_key:
+            return
+
+
+def scan_pages(
+        table,
+        filter_expression=None,
+        projection: List[str] = None,
+        page_size: int = None,
+        segment: int = None,
+        total_segments: int = None
+) -> Iterator[List[Dict]]:
+    """Yields the pages of a scan, following LastEvaluatedKey lazily.
+
+    Args:
+        table: boto3 DynamoDB Table resource
+        filter_expression (Optional): boto3 condition applied after the read. Defaults to None.
+        projection (List[str], Optional): attribute names to fetch. Defaults to None (all attributes).
+        page_size (int, Optional): hint for the number of items read per request. Defaults to None.
+        segment (int, Optional): segment to read in a parallel scan. Defaults to None (whole table).
+        total_segments (int, Optional): number of segments of a parallel scan. Defaults to None.
+    """
+    _args = {}
+    if filter_expression is not None:
+        _args['FilterExpression'] = filter_expression
+    if page_size:
+        _args['Limit'] = page_size
+    if total_segments:
+        _args['Segment'] = segment
+        _args['TotalSegments'] = total_segments
+
+    _projection = projection_args(projection)
+    _start_key = None
+    while True:
+        _request = dict(_args)
+        if _projection:
+            _request['ProjectionExpression'] = _projection['ProjectionExpression']
+            _request['ExpressionAttributeNames'] = dict(_projection['ExpressionAttributeNames'])
+        if _start_key:
+            _request['ExclusiveStartKey'] = _start_key
+
+        _resp = table.scan(**_request)
+        yield _resp.get('Items', [])
+
+        _start_key = _resp.get('LastEvaluatedKey')
+        if not _start_key:
+            return
+
+
+def iter_query(
+        table,
+        key_condition,
+        filter_expression=None,
+        projection: List[str] = None,
+        page_size: int = None,
+        index_name: str = None,
+        max_items: int = None,
+        scan_forward: bool = True
+) -> Iterator[Dict]:
+    """Yields the items of a query one at a time across all pages.
+
+    Only one page is held in memory at a time. See query_pages for the arguments.
+
+    Args:
+        max_items (int, Optional): stop after this many items. Defaults to None (no limit).
+    """
+    if max_items and not page_size:
+        page_size = max_items
+
+    _count = 0
+    for _page in query_pages(table, key_condition, filter_expression,
+                             projection, page_size, index_name, scan_forward):
+        for _item in _page:
+            yield _item
+            _count += 1
+            if max_items and _count >= max_items:
+                return
+
+
+class QueryCache:
+    """Size-bounded TTL cache for query results.
+
+    Instances are meant to live at module level in a Lambda function so they
+    survive across invocations served by the same warm container. Keys are
+    tuples starting with (table name, partition key value, ...), which lets a
+    write drop every cached read of the partition it touched.
+
+    A list is cached as a tuple and each get returns a new list, so callers can
+    sort or extend the result. The items themselves are shared with the cache
+    and later hits, and must be treated as read-only: copy an item before
+    changing it.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 30):
+        """Constructs an instance.
+
+        Args:
+            max_entries (int, Optional): least recently used entries are evicted past this size. Defaults to 256.
+            ttl_seconds (float, Optional): entries older than this are ignored. Defaults to 30.
+        """
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple):
+        """Returns the cached value for key, or None on a miss."""
+        with self._lock:
+            _entry = self._entries.get(key)
+            if _entry is None or time.monotonic() - _entry[0] > self._ttl_seconds:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(_entry[1]) if _entry[2] else _entry[1]
+
+    def put(self, key: Tuple, value) -> None:
+        """Caches value under key, evicting the least recently used entry if full."""
+        _is_list = isinstance(value, list)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), tuple(value) if _is_list else value, _is_list)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, table_name: str, pk_value: str) -> int:
+        """Drops every cached read of a partition, returns the number of entries dropped."""
+        with self._lock:
+            _stale = [_key for _key in self._entries if _key[:2] == (table_name, pk_value)]
+            for _key in _stale:
+                del self._entries[_key]
+            return len(_stale)
+
+    def stats(self) -> Dict:
+        """Returns the hit/miss counters since the container started."""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
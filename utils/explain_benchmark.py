@@ -0,0 +1,159 @@
+"""Measures the explain_* functions of the customer insights Lambdas on large visualizations.
+
+Synthetic visualizations of each type are generated at several sizes, in the
+data format of each handler module, and each one is explained a few times.
+The median time is reported with the columnar kernel computed in plain Python
+and with NumPy (see utils.metrics_kernel), next to the time json.loads takes
+to parse the same data sent as a string by the agent. With --memory, the data
+is explained from its JSON string once parsed whole by json.loads and once
+streamed by utils.visualization_parser, and the peak memory allocated by each
+is reported (tracemalloc, the JSON string itself excluded). Run it from the
+root of the repository:
+
+    python utils/explain_benchmark.py --sizes 1000 10000 100000 --runs 5
+    python utils/explain_benchmark.py --memory
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import metrics_kernel, visualization_parser
+
+_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+MODULES = {
+    "customer_insights": "2-customer-insights/customer_insights.py",
+    "lambda_function": "2-customer-insights/lambda_function.py",
+}
+
+
+def load_module(name):
+    os.environ['LAMBDA_TASK_ROOT'] = os.path.join(_root, os.path.dirname(MODULES[name]))
+    # Every run computes its explanation
+    os.environ['explanation_cache_size'] = '0'
+    spec = importlib.util.spec_from_file_location(name, os.path.join(_root, MODULES[name]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _month(i):
+    return f"{2000 + i // 12}/{i % 12 + 1:02d}"
+
+
+VISUALIZATION_TYPES = ["spending_trend", "investment_allocation", "cash_flow", "budget_performance"]
+
+
+def visualization(module_name, visualization_type, size, seed=0):
+    """A synthetic visualization with size data points, in the format of the module."""
+    rng = random.Random(seed)
+    if visualization_type == "spending_trend":
+        return {'visualization_type': visualization_type, 'time_period': f'{size}_months',
+                'data_points': [{'month': _month(i), 'amount': rng.gauss(3000, 400) * (1.6 if rng.random() < 0.02 else 1)}
+                                for i in range(size)],
+                'categories': [{'name': 'Housing', 'percentage': 40}, {'name': 'Food', 'percentage': 60}]}
+    if visualization_type == "investment_allocation":
+        allocations = [{'asset_class': f'Asset {i}', 'percentage': 100 / size} for i in range(size)]
+        if module_name == "customer_insights":
+            return {'visualization_type': visualization_type, 'data_points': allocations}
+        return {'visualization_type': visualization_type, 'total_investment': 1e6, 'allocations': allocations}
+    if visualization_type == "cash_flow":
+        income = [rng.gauss(5500, 300) for _ in range(size)]
+        expenses = [rng.gauss(4800, 500) for _ in range(size)]
+        if module_name == "customer_insights":
+            return {'visualization_type': visualization_type, 'time_period': f'{size}_months',
+                    'data_points': [{'month': _month(i), 'income': income[i], 'expenses': expenses[i]}
+                                    for i in range(size)]}
+        return {'visualization_type': visualization_type, 'time_period': f'{size}_months',
+                'months': [_month(i) for i in range(size)], 'income': income, 'expenses': expenses}
+    planned = [rng.uniform(100, 2000) for _ in range(size)]
+    actual = [value * rng.uniform(0.7, 1.3) for value in planned]
+    if module_name == "customer_insights":
+        return {'visualization_type': visualization_type,
+                'data_points': [{'category': f'Category {i}', 'planned': planned[i], 'actual': actual[i]}
+                                for i in range(size)]}
+    return {'visualization_type': visualization_type, 'categories': [f'Category {i}' for i in range(size)],
+            'planned': planned, 'actual': actual}
+
+
+def median_ms(func, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1e3
+
+
+def peak_memory(func):
+    """Runs func once, returns the peak memory it allocated in MB."""
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def compare_kernels(module, module_name, size, runs):
+    # Explains already parsed data, with the kernel in plain Python and with NumPy
+    vectorize_min_points = metrics_kernel.VECTORIZE_MIN_POINTS
+    for visualization_type in VISUALIZATION_TYPES:
+        data = visualization(module_name, visualization_type, size)
+        payload = json.dumps(data)
+        parse_ms = median_ms(lambda: json.loads(payload), runs)
+        timings = []
+        for threshold in (float('inf'), vectorize_min_points):
+            metrics_kernel.VECTORIZE_MIN_POINTS = threshold
+            timings.append(median_ms(lambda: module.explain_visualization(data), runs))
+        metrics_kernel.VECTORIZE_MIN_POINTS = vectorize_min_points
+        print(f"{module_name:<18} {visualization_type:<22} {size:>9,} {parse_ms:>9.1f} "
+              f"{timings[0]:>10.1f} {timings[1]:>9.1f}")
+
+
+def compare_parsers(module, module_name, size, runs):
+    # Explains the data sent as a JSON string, parsed whole by json.loads and streamed.
+    # Timed apart from the memory measure, which slows allocations down
+    stream_min_chars = visualization_parser.STREAM_MIN_CHARS
+    for visualization_type in VISUALIZATION_TYPES:
+        payload = json.dumps(visualization(module_name, visualization_type, size))
+        results = []
+        for threshold in (float('inf'), 0):
+            visualization_parser.STREAM_MIN_CHARS = threshold
+            results += [peak_memory(lambda: module.explain_visualization(payload)),
+                        median_ms(lambda: module.explain_visualization(payload), runs)]
+        visualization_parser.STREAM_MIN_CHARS = stream_min_chars
+        print(f"{module_name:<18} {visualization_type:<22} {size:>9,} {len(payload) / 2 ** 20:>8.1f} "
+              f"{results[0]:>10.1f} {results[1]:>9.0f} {results[2]:>10.1f} {results[3]:>9.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="*", type=int, default=None,
+                        help="data points per visualization. Defaults to 1k 10k 100k, or 10k 100k 1M with --memory")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modules", nargs="*", default=list(MODULES), choices=list(MODULES))
+    parser.add_argument("--memory", action="store_true", help="compare json.loads and the streaming parser")
+    args = parser.parse_args()
+
+    if args.memory:
+        print(f"{'':<42} {'':>9} {'':>8} {'json.loads':>20} {'streamed':>20}")
+        print(f"{'module':<18} {'visualization':<22} {'points':>9} {'data MB':>8} "
+              f"{'peak MB':>10} {'ms':>9} {'peak MB':>10} {'ms':>9}")
+    else:
+        print(f"{'module':<18} {'visualization':<22} {'points':>9} {'parse ms':>9} {'python ms':>10} {'numpy ms':>9}")
+    for module_name in args.modules:
+        module = load_module(module_name)
+        for size in args.sizes or ([10000, 100000, 1000000] if args.memory else [1000, 10000, 100000]):
+            if args.memory:
+                compare_parsers(module, module_name, size, args.runs)
+            else:
+                compare_kernels(module, module_name, size, args.runs)
@@ -0,0 +1,224 @@
+"""Content-addressed memoization of the explanations of the customer insights Lambda.
+
+Dashboards ask for the explanation of the same visualization every time they
+are opened. A memoized function is keyed by a hash of its arguments, with the
+JSON ones canonicalized (keys sorted, whitespace dropped), so the same data
+sent twice is served from the cache whatever its formatting:
+
+    >>> from utils.explanation_cache import ExplanationCache
+    >>> explanation_cache = ExplanationCache.from_env(dynamodb_table, dynamodb_pk, dynamodb_sk)
+    >>> @action_group.action()
+    ... @explanation_cache.memoize
+    ... def explain_visualization(data, visualization_type=None, customer_id=None, additional_context=None):
+    ...     ...
+
+Explanations are cached in two tiers:
+
+- a least recently used cache in the container (see dynamodb_helper.QueryCache),
+  which serves the repeat requests reaching a warm container
+- optionally, the DynamoDB table of the Lambda function, shared by every
+  container. Each explanation is an item of its own partition,
+  explanation#<hash>, with an expires_at attribute: enable DynamoDB TTL on
+  expires_at for the table to delete the expired ones.
+
+Results starting with "Error" are not cached. Each call emits CacheHits,
+CacheMisses and SavedComputeTime metrics (the compute time of the cached
+explanations served) and logs the hit ratio and saved time of the container.
+
+Configured with environment variables of the Lambda function (defaults):
+
+- explanation_cache_size (256): explanations kept in the container, 0 turns the tier off
+- explanation_cache_ttl (3600): seconds an explanation is served from the container
+- explanation_cache_table_ttl (0): seconds an explanation is kept in the table, 0 turns the tier off
+
+Data strings of STREAM_MIN_CHARS characters or more (see visualization_parser)
+are hashed as sent, in chunks, rather than parsed: the key of a large
+visualization costs no copy of its data.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, Tuple
+
+from utils.client_helper import get_table
+from utils.dynamodb_helper import QueryCache
+from utils.log_helper import logger
+from utils.visualization_parser import STREAM_MIN_CHARS
+
+# Characters hashed at once
+HASH_CHUNK_CHARS = 1 << 16
+# Sort key value of the cached explanations, in tables with a sort key
+SORT_KEY_VALUE = 'explanation'
+
+_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=str)
+
+
+def _canonical_parts(value) -> Iterable[str]:
+    # JSON text of a value with sorted keys, JSON strings parsed first. Large strings as sent
+    if isinstance(value, str) and len(value) < STREAM_MIN_CHARS and value.lstrip()[:1] in ('{', '['):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            pass
+    if isinstance(value, str) and len(value) >= HASH_CHUNK_CHARS:
+        return (value[_pos:_pos + HASH_CHUNK_CHARS] for _pos in range(0, len(value), HASH_CHUNK_CHARS))
+    return (_encoder.encode(value),)
+
+
+def content_hash(name: str, arguments: Dict) -> str:
+    """Returns the SHA-256 hex digest of a function name and its canonicalized arguments."""
+    _hash = hashlib.sha256(name.encode())
+    for _name, _value in sorted(arguments.items()):
+        _hash.update(f"\0{_name}=".encode())
+        for _part in _canonical_parts(_value):
+            _hash.update(_part.encode())
+    return _hash.hexdigest()
+
+
+class ExplanationCache:
+    """Two tier cache of function results keyed by content hash, see the module docstring."""
+
+    def __init__(
+            self,
+            max_entries: int = 256,
+            ttl_seconds: float = 3600,
+            table_name: str = None,
+            pk_field: str = None,
+            sk_field: str = None,
+            table_ttl_seconds: int = 0
+    ):
+        """Constructs an instance.
+
+        Args:
+            max_entries (int, Optional): results kept in the container, 0 turns the tier off. Defaults to 256.
+            ttl_seconds (float, Optional): seconds a result is served from the container. Defaults to 3600.
+            table_name (str, Optional): DynamoDB table of the second tier. Defaults to None (no second tier).
+            pk_field (str, Optional): partition key attribute of the table
+            sk_field (str, Optional): sort key attribute of the table, if it has one
+            table_ttl_seconds (int, Optional): seconds a result is kept in the table, 0 turns the tier off
+        """
+        self._memory = QueryCache(max_entries, ttl_seconds) if max_entries > 0 and ttl_seconds > 0 else None
+        self._table_name = table_name if table_name and pk_field and table_ttl_seconds > 0 else None
+        self._pk_field = pk_field
+        self._sk_field = sk_field
+        self._table_ttl_seconds = int(table_ttl_seconds)
+        self.memory_hits = 0
+        self.table_hits = 0
+        self.misses = 0
+        self.saved_ms = 0.0
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, table_name: str = None, pk_field: str = None, sk_field: str = None) -> 'ExplanationCache':
+        """Constructs an instance configured with the environment variables of the module docstring."""
+        return cls(max_entries=int(os.getenv('explanation_cache_size', 256)),
+                   ttl_seconds=float(os.getenv('explanation_cache_ttl', 3600)),
+                   table_name=table_name, pk_field=pk_field, sk_field=sk_field,
+                   table_ttl_seconds=int(os.getenv('explanation_cache_table_ttl', 0)))
+
+    @property
+    def enabled(self) -> bool:
+        return self._memory is not None or self._table_name is not None
+
+    def _table_key(self, key: str) -> Dict:
+        _key = {self._pk_field: f"explanation#{key}"}
+        if self._sk_field:
+            _key[self._sk_field] = SORT_KEY_VALUE
+        return _key
+
+    def _get_table_item(self, key: str):
+        try:
+            _item = get_table(self._table_name).get_item(Key=self._table_key(key)).get('Item')
+        except Exception as e:
+            logger.warning('explanation cache read failed', table=self._table_name, error=repr(e))
+            return None
+        # DynamoDB TTL deletes expired items up to a few days late
+        if _item is None or int(_item.get('expires_at', 0)) < time.time():
+            return None
+        return _item['result'], float(_item.get('compute_ms', 0))
+
+    def _put_table_item(self, key: str, result: str, compute_ms: float) -> None:
+        try:
+            get_table(self._table_name).put_item(Item={
+                **self._table_key(key),
+                'result': result,
+                'compute_ms': Decimal(str(round(compute_ms, 3))),
+                'expires_at': int(time.time()) + self._table_ttl_seconds
+            })
+        except Exception as e:
+            logger.warning('explanation cache write failed', table=self._table_name, error=repr(e))
+
+    def get(self, key: str) -> Tuple:
+        """Returns (result, compute time in ms, tier) for key, tier being 'memory', 'table' or None on a miss."""
+        _entry = self._memory.get(('explanation', key)) if self._memory else None
+        if _entry is not None:
+            return _entry + ('memory',)
+        _entry = self._get_table_item(key) if self._table_name else None
+        if _entry is not None:
+            if self._memory:
+                self._memory.put(('explanation', key), _entry)
+            return _entry + ('table',)
+        return None, 0.0, None
+
+    def put(self, key: str, result: str, compute_ms: float) -> None:
+        """Caches result, computed in compute_ms, in every tier."""
+        if self._memory:
+            self._memory.put(('explanation', key), (result, compute_ms))
+        if self._table_name:
+            self._put_table_item(key, result, compute_ms)
+
+    def stats(self) -> Dict:
+        """Returns the hits per tier, misses, hit ratio and compute time saved since the container started."""
+        _hits = self.memory_hits + self.table_hits
+        return {'memory_hits': self.memory_hits, 'table_hits': self.table_hits, 'misses': self.misses,
+                'hit_ratio': round(_hits / (_hits + self.misses), 4) if _hits + self.misses else 0.0,
+                'saved_ms': round(self.saved_ms, 3)}
+
+    def _record(self, name: str, tier: str, compute_ms: float) -> None:
+        # Memoized functions may be called from several threads at once
+        _saved_ms = compute_ms if tier else 0.0
+        with self._stats_lock:
+            if tier == 'memory':
+                self.memory_hits += 1
+            elif tier == 'table':
+                self.table_hits += 1
+            else:
+                self.misses += 1
+            self.saved_ms += _saved_ms
+            _stats = self.stats()
+        logger.info('explanation cache', function=name, tier=tier or 'miss',
+                    compute_ms=round(compute_ms, 3), **_stats)
+        logger.metrics({'Function': name},
+                       {'CacheHits': int(tier is not None), 'CacheMisses': int(tier is None),
+                        'SavedComputeTime': round(_saved_ms, 3)},
+                       {'CacheHits': 'Count', 'CacheMisses': 'Count', 'SavedComputeTime': 'Milliseconds'})
+
+    def memoize(self, func: Callable) -> Callable:
+        """Decorator caching the string results of func, keyed by the content hash of its arguments."""
+        _signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def _memoized(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            _arguments = _signature.bind(*args, **kwargs)
+            _arguments.apply_defaults()
+            _key = content_hash(func.__name__, _arguments.arguments)
+            _result, _compute_ms, _tier = self.get(_key)
+            if _tier is None:
+                _start = time.perf_counter()
+                _result = func(*args, **kwargs)
+                _compute_ms = (time.perf_counter() - _start) * 1e3
+                if isinstance(_result, str) and not _result.startswith('Error'):
+                    self.put(_key, _result, _compute_ms)
+            self._record(func.__name__, _tier, _compute_ms)
+            return _result
+
+        return _memoized
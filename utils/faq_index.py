@@ -0,0 +1,183 @@
+"""Lexical FAQ index over the knowledge base documents of an action group Lambda.
+
+The documents a Lambda answers questions about (e.g. 2-solar-panel/kb_documents)
+are split into passages, one per paragraph under its heading, and indexed
+offline with BM25 by utils/faq_index_builder.py into FAQ_INDEX_FILE. The index
+is packaged next to the Lambda source file (see utils.lambda_package_helper)
+and searched in process, so common questions are answered without a knowledge
+base retrieval:
+
+    >>> from utils.faq_index import FaqIndex
+    >>> index = FaqIndex.load('2-solar-panel/faq_index.json')
+    >>> index.search("how do I clean a Sunpower Y panel", top_k=3)[0]
+    {'source': 'solar-panel-maintenance.txt', 'title': 'Sunpower Y', 'text': '1. Clean the solar panel ...',
+     'score': 4.446, 'relevance': 0.185}
+
+Terms are lowercased words and numbers with common suffixes stripped
+(panels, cleaning and installation match panel, clean and install), stop
+words left out. Hyphenated words are one term, so Sunpower X and Sunpower
+Double-X passages don't match each other's model.
+
+The relevance of a passage is its BM25 score relative to the best score a
+query of as many terms (at least FAQ_MIN_QUERY_TERMS) could reach, every
+term matching a single passage. Questions matching only terms found in most
+passages (panel, solar, Sunpower), few of their terms, or made of one or two
+words (install) have a low relevance, and min_relevance leaves them out, so
+that they go to the knowledge base instead.
+
+An index can also hold an embedding of each passage, made with a Bedrock
+embedding model when it is built. A search given the embedding of the
+question then ranks the passages on both scores, see search. Embedding the
+question takes a Bedrock call, tens of milliseconds, while a lexical search
+of a few dozen passages takes microseconds.
+"""
+
+import heapq
+import json
+import math
+import os
+import re
+
+from typing import Callable, Dict, List, Sequence
+
+# File name of the index, packaged at the root of the Lambda zip
+FAQ_INDEX_FILE = "faq_index.json"
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Queries of fewer terms are scored as queries of this many terms by relevance: a term or two is not a question
+FAQ_MIN_QUERY_TERMS = 4
+# Weight of the embedding similarity in the ranking of a search given a question embedding
+FAQ_EMBEDDING_WEIGHT = float(os.getenv('faq_embedding_weight', 0.5))
+STOP_WORDS = frozenset(
+    "a an and are as at be by can could do does for from has have how i if in into is it its me my of on or our "
+    "should so that the their them there these this those to was we what when where which who why will with would "
+    "you your".split())
+_SUFFIXES = ('ations', 'ation', 'ings', 'ing', 'ed', 'es', 's')
+
+
+def _stem(word: str) -> str:
+    for _suffix in _SUFFIXES:
+        if word.endswith(_suffix) and len(word) - len(_suffix) >= 3 and not word.endswith('ss'):
+            return word[:-len(_suffix)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Terms of a text, in order, see the module docstring."""
+    return [_stem(_word) for _word in re.findall(r"[a-z0-9]+(?:-[a-z0-9]+)*", text.lower())
+            if _word not in STOP_WORDS]
+
+
+def split_passages(text: str, source: str) -> List[Dict]:
+    """Splits a document into passages, one per paragraph, titled with the heading they are under.
+
+    A paragraph of one line ending with a colon is a heading. A paragraph whose first line ends with a colon
+    is a passage titled with that line, e.g. the steps under "How to Install a Sunpower X Solar Panel:".
+    """
+    _passages, _title = [], ''
+    for _paragraph in re.split(r'\n\s*\n', text.strip()):
+        _lines = [_line.strip() for _line in _paragraph.strip().splitlines() if _line.strip()]
+        if not _lines:
+            continue
+        if _lines[0].endswith(':'):
+            if len(_lines) == 1:
+                _title = _lines[0][:-1]
+                continue
+            _passages.append({'source': source, 'title': _lines[0][:-1], 'text': '\n'.join(_lines[1:])})
+        else:
+            _passages.append({'source': source, 'title': _title, 'text': '\n'.join(_lines)})
+    return _passages
+
+
+def build_index(passages: List[Dict], embed: Callable[[str], Sequence[float]] = None,
+                embedding_model: str = None) -> Dict:
+    """Indexes passages (source, title and text) with BM25, and with their embeddings if embed is given.
+
+    Returns:
+        Dict: the index, as saved to FAQ_INDEX_FILE and read by FaqIndex
+    """
+    _postings: Dict[str, List[List[int]]] = {}
+    _lengths = []
+    for _i, _passage in enumerate(passages):
+        _terms = tokenize(f"{_passage['title']} {_passage['text']}")
+        _lengths.append(len(_terms))
+        _counts: Dict[str, int] = {}
+        for _term in _terms:
+            _counts[_term] = _counts.get(_term, 0) + 1
+        for _term, _count in _counts.items():
+            _postings.setdefault(_term, []).append([_i, _count])
+    _index = {'version': 1, 'k1': BM25_K1, 'b': BM25_B, 'passages': passages, 'lengths': _lengths,
+              'postings': dict(sorted(_postings.items()))}
+    if embed is not None:
+        _index['embeddings'] = {'model': embedding_model,
+                                'vectors': [_normalized(embed(f"{_p['title']}\n{_p['text']}")) for _p in passages]}
+    return _index
+
+
+def _normalized(vector: Sequence[float]) -> List[float]:
+    _norm = math.sqrt(sum(_v * _v for _v in vector)) or 1.0
+    return [round(_v / _norm, 6) for _v in vector]
+
+
+def embed_text(client, model_id: str, text: str, input_type: str = 'search_query') -> List[float]:
+    """Embeds a text with a Bedrock embedding model (Amazon Titan or Cohere), given a bedrock-runtime client."""
+    if model_id.startswith('cohere.'):
+        _body = {'texts': [text], 'input_type': input_type}
+    else:
+        _body = {'inputText': text}
+    _response = json.loads(client.invoke_model(modelId=model_id, body=json.dumps(_body))['body'].read())
+    return _response['embeddings'][0] if 'embeddings' in _response else _response['embedding']
+
+
+class FaqIndex:
+    """Searches an index built by build_index, see the module docstring."""
+
+    def __init__(self, index: Dict):
+        self.passages = index['passages']
+        self._k1, self._b = index.get('k1', BM25_K1), index.get('b', BM25_B)
+        self._lengths = index['lengths']
+        self._average_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        _count = len(self.passages)
+        # Highest score of a term, at the BM25 saturation of a term found in one passage only
+        self._max_term_score = (self._k1 + 1) * math.log(1 + (_count - 0.5) / 1.5)
+        # Term -> (inverse document frequency, [(passage, term frequency), ...])
+        self._postings = {_term: (math.log(1 + (_count - len(_postings) + 0.5) / (len(_postings) + 0.5)),
+                                  [tuple(_posting) for _posting in _postings])
+                          for _term, _postings in index['postings'].items()}
+        _embeddings = index.get('embeddings') or {}
+        self.embedding_model = _embeddings.get('model')
+        self._vectors = _embeddings.get('vectors')
+
+    @classmethod
+    def load(cls, path: str) -> 'FaqIndex':
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def search(self, query: str, top_k: int = 3, query_vector: Sequence[float] = None,
+               min_relevance: float = 0.0) -> List[Dict]:
+        """The top_k passages matching a query, best first, with their score and relevance.
+
+        Passages whose relevance (see the module docstring) is under min_relevance, or matching no term of
+        the query, are left out. Without query_vector, the score is the BM25 score of the passage. With the
+        embedding of the query, and an index holding passage embeddings of the same model, it is a blend of
+        the BM25 score, relative to the best one, and of the cosine similarity of the embeddings, weighted by
+        FAQ_EMBEDDING_WEIGHT.
+        """
+        _terms = set(tokenize(query))
+        _scores: Dict[int, float] = {}
+        for _term in _terms:
+            _idf, _postings = self._postings.get(_term, (0.0, ()))
+            for _i, _tf in _postings:
+                _norm = self._k1 * (1 - self._b + self._b * self._lengths[_i] / self._average_length)
+                _scores[_i] = _scores.get(_i, 0.0) + _idf * _tf * (self._k1 + 1) / (_tf + _norm)
+        _best_possible = max(len(_terms), FAQ_MIN_QUERY_TERMS) * self._max_term_score
+        _relevance = {_i: _score / _best_possible for _i, _score in _scores.items()}
+        _scores = {_i: _score for _i, _score in _scores.items() if _relevance[_i] >= min_relevance}
+        if query_vector is not None and self._vectors and _scores:
+            _query = _normalized(query_vector)
+            _best = max(_scores.values())
+            _scores = {_i: (1 - FAQ_EMBEDDING_WEIGHT) * _score / _best +
+                       FAQ_EMBEDDING_WEIGHT * sum(_q * _v for _q, _v in zip(_query, self._vectors[_i]))
+                       for _i, _score in _scores.items()}
+        return [{**self.passages[_i], 'score': round(_score, 3), 'relevance': round(_relevance[_i], 3)}
+                for _i, _score in heapq.nlargest(top_k, _scores.items(), key=lambda _item: _item[1])]
@@ -0,0 +1,85 @@
+"""Builds the FAQ index of a Lambda from its knowledge base documents.
+
+Splits the text documents of a folder into passages and writes their BM25
+index (utils.faq_index) next to the Lambda source file, where
+utils.lambda_package_helper packages it. Rebuild it whenever the documents
+change, from the root of the repository:
+
+    python utils/faq_index_builder.py 2-solar-panel/kb_documents --output 2-solar-panel/faq_index.json
+    python utils/faq_index_builder.py 2-solar-panel/kb_documents --output 2-solar-panel/faq_index.json \\
+        --embeddings amazon.titan-embed-text-v2:0
+
+--embeddings also stores the embedding of every passage, made with that
+Bedrock model, for searches given the embedding of the question. The index is
+then searched with the sample questions, or --question ones, and the time a
+search takes is reported with the relevance of the best passage, which the
+Lambda compares to faq_min_score.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.faq_index import FAQ_INDEX_FILE, FaqIndex, build_index, embed_text, split_passages
+
+SAMPLE_QUESTIONS = [
+    "How do I install a Sunpower X solar panel?",
+    "How often should I clean the Sunpower Y panel?",
+    "What is the difference between Sunpower X and Sunpower Double-X?",
+    "How do I check the wiring of my panel?",
+    "Do I need a permit to install solar panels?",
+    "My panel is broken, can I get a refund?",
+]
+
+
+def read_passages(folder):
+    """Passages of the .txt documents of a folder, in file name order."""
+    passages = []
+    for name in sorted(os.listdir(folder)):
+        if name.endswith('.txt'):
+            with open(os.path.join(folder, name)) as f:
+                passages += split_passages(f.read(), name)
+    return passages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("documents", help="folder of the knowledge base documents")
+    parser.add_argument("--output", help=f"index file, {FAQ_INDEX_FILE} in the parent of the folder by default")
+    parser.add_argument("--embeddings", metavar="MODEL_ID", help="Bedrock embedding model of the passages")
+    parser.add_argument("--question", nargs="*", default=SAMPLE_QUESTIONS, help="questions searched after the build")
+    parser.add_argument("--repeat", type=int, default=1000, help="searches timed per question")
+    args = parser.parse_args()
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(args.documents)), FAQ_INDEX_FILE)
+
+    passages = read_passages(args.documents)
+    if not passages:
+        raise SystemExit(f"Error: no passages in the .txt documents of {args.documents}")
+    embed = None
+    if args.embeddings:
+        from utils.client_helper import get_client
+        client = get_client('bedrock-runtime')
+        embed = lambda text: embed_text(client, args.embeddings, text, 'search_document')  # noqa: E731
+    index = build_index(passages, embed, args.embeddings)
+    with open(output, 'w') as f:
+        json.dump(index, f, indent=1)
+        f.write('\n')
+    print(f"Indexed {len(passages)} passages, {len(index['postings'])} terms, into {output} "
+          f"({os.path.getsize(output) / 1024:.1f} KiB)")
+
+    start = time.perf_counter()
+    faq_index = FaqIndex.load(output)
+    print(f"Loaded in {(time.perf_counter() - start) * 1000:.2f} ms")
+    for question in args.question:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            results = faq_index.search(question)
+        elapsed_ms = (time.perf_counter() - start) * 1000 / args.repeat
+        best = results[0] if results else None
+        print(f"{elapsed_ms:.3f} ms  {question}\n" + (
+            f"          score {best['score']}, relevance {best['relevance']}: {best['source']} {best['title']}"
+            if best else "          no match"))
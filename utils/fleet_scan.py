@@ -0,0 +1,171 @@
+"""Fleet-wide scan of the devices of the peak load table, for grid operators.
+
+Answers "which households are over quota right now" in one pass over the
+whole table rather than one detect_peak call per customer. The table is read
+with a parallel Scan, one segment per thread, projected on the attributes
+the scan needs, and every device row is read into columns: household,
+quota, used, essential and peak. fleet_metrics then groups the columns by
+household:
+
+    >>> from utils.fleet_scan import fleet_metrics, scan_columns
+    >>> columns = scan_columns(lambda: new_resource('dynamodb').Table('peak-table'), total_segments=8)
+    >>> fleet_metrics(columns, max_households=20)['households_over'][0]
+    {'customer_id': '2', 'quota': 305.0, 'used': 445.0, 'excess': 140.0, 'sheddable': 300.0, ...}
+
+A household is over quota when its devices use more than their quotas add up
+to. Its sheddable load is what its non-essential devices use, and what
+shedding can recover is the smaller of that and its excess. Long columns are
+computed with NumPy, like the metrics of utils.metrics_kernel, in plain
+Python otherwise. Columns read from an exported snapshot of the table instead
+of a Scan work the same, see to_columns.
+"""
+
+import math
+
+from typing import Callable, Dict, Iterable, List
+
+from utils.dynamodb_helper import scan_pages
+from utils.metrics_kernel import numpy, vectorized
+
+# Attributes read from each device row
+SCAN_FIELDS = ['customer_id', 'quota', 'used', 'essential', 'peak']
+
+
+def _number(value) -> float:
+    # Quotas and readings are stored as strings, e.g. "20", or as numbers
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def to_columns(items: Iterable[Dict]) -> Dict[str, List]:
+    """Reads device rows into the columns of fleet_metrics, skipping rows without a quota (e.g. summaries)."""
+    _customers, _quota, _used, _essential, _peak = [], [], [], [], []
+    for _item in items:
+        if 'quota' not in _item:
+            continue
+        _customers.append(_item['customer_id'])
+        _quota.append(_number(_item['quota']))
+        _used.append(_number(_item.get('used')))
+        _essential.append(_item.get('essential') == 'True')
+        _peak.append(_item.get('peak') == 'True')
+    return {'customer_id': _customers, 'quota': _quota, 'used': _used, 'essential': _essential, 'peak': _peak}
+
+
+def concat_columns(parts: List[Dict[str, List]]) -> Dict[str, List]:
+    """Joins the columns of several segments."""
+    _columns = {_field: [] for _field in ('customer_id', 'quota', 'used', 'essential', 'peak')}
+    for _part in parts:
+        for _field, _values in _part.items():
+            _columns[_field] += _values
+    return _columns
+
+
+def scan_segment(table, segment: int = None, total_segments: int = None, page_size: int = None) -> Dict[str, List]:
+    """Reads one segment of a parallel scan, the whole table by default, into columns."""
+    return concat_columns([to_columns(_page) for _page in
+                           scan_pages(table, projection=SCAN_FIELDS, page_size=page_size,
+                                      segment=segment, total_segments=total_segments)])
+
+
+def scan_columns(table_factory: Callable, total_segments: int = 8, page_size: int = None) -> Dict[str, List]:
+    """Reads the devices of a table into columns with a parallel scan, one segment per thread.
+
+    Args:
+        table_factory (Callable): returns the Table resource a thread reads, called in every thread as boto3
+        resources are not thread safe
+        total_segments (int, Optional): segments of the scan, read at the same time. Defaults to 8.
+        page_size (int, Optional): items read per Scan request. Defaults to None (1 MB pages).
+    """
+    if total_segments <= 1:
+        return scan_segment(table_factory(), page_size=page_size)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        _parts = list(executor.map(lambda _segment: scan_segment(table_factory(), _segment, total_segments, page_size),
+                                   range(total_segments)))
+    return concat_columns(_parts)
+
+
+def _household_rows(customer_ids: List, sums: Dict[str, List], order: List[int]) -> List[Dict]:
+    return [{
+        'customer_id': customer_ids[_i],
+        'quota': sums['quota'][_i], 'used': sums['used'][_i], 'excess': sums['excess'][_i],
+        'sheddable': sums['sheddable'][_i], 'recoverable': min(sums['sheddable'][_i], sums['excess'][_i]),
+        'devices': int(sums['devices'][_i]), 'devices_over_quota': int(sums['devices_over_quota'][_i]),
+        'peak_devices': int(sums['peak_devices'][_i])
+    } for _i in order]
+
+
+def fleet_metrics(columns: Dict[str, List], max_households: int = 20) -> Dict:
+    """Groups device columns by household and ranks the households over quota.
+
+    Args:
+        columns (Dict[str, List]): customer_id, quota, used, essential and peak of each device, see to_columns
+        max_households (int, Optional): households returned, the furthest over quota. Defaults to 20.
+
+    Returns:
+        Dict: fleet totals (households, devices, households_over_quota, devices_over_quota, peak_devices,
+        and the excess, sheddable and recoverable kW of the households over quota) and households_over:
+        the max_households furthest over quota, by decreasing excess, with their quota, used, excess,
+        sheddable and recoverable kW and device counts.
+    """
+    _count = len(columns['customer_id'])
+    # Households numbered in order of appearance
+    _codes = {}
+    _household = [_codes.setdefault(_customer, len(_codes)) for _customer in columns['customer_id']]
+    _customers = list(_codes)
+    _households = len(_customers)
+
+    if vectorized(_count):
+        np = numpy()
+        _index = np.fromiter(_household, np.int64, count=_count)
+        _quota = np.fromiter(columns['quota'], float, count=_count)
+        _used = np.fromiter(columns['used'], float, count=_count)
+        _essential = np.fromiter(columns['essential'], bool, count=_count)
+        _peak = np.fromiter(columns['peak'], bool, count=_count)
+
+        def _sum(weights):
+            return np.bincount(_index, weights=weights, minlength=_households)
+
+        _sums = {'quota': _sum(_quota), 'used': _sum(_used), 'sheddable': _sum(np.where(_essential, 0.0, _used)),
+                 'devices': np.bincount(_index, minlength=_households),
+                 'devices_over_quota': _sum(_used > _quota), 'peak_devices': _sum(_peak)}
+        _sums['excess'] = _sums['used'] - _sums['quota']
+        _over = np.flatnonzero(_sums['excess'] > 0)
+        _order = _over[np.argsort(-_sums['excess'][_over], kind='stable')][:max_households].tolist()
+        _recoverable = np.minimum(_sums['sheddable'][_over], _sums['excess'][_over])
+        _totals = {
+            'households_over_quota': len(_over),
+            'devices_over_quota': int(_sums['devices_over_quota'].sum()),
+            'peak_devices': int(_sums['peak_devices'].sum()),
+            'excess': float(_sums['excess'][_over].sum()),
+            'sheddable': float(_sums['sheddable'][_over].sum()),
+            'recoverable': float(_recoverable.sum())
+        }
+        _sums = {_name: _values.tolist() for _name, _values in _sums.items()}
+    else:
+        _sums = {_name: [0.0] * _households for _name in
+                 ('quota', 'used', 'sheddable', 'devices', 'devices_over_quota', 'peak_devices')}
+        for _i, _quota, _used, _essential, _peak in zip(_household, columns['quota'], columns['used'],
+                                                        columns['essential'], columns['peak']):
+            _sums['quota'][_i] += _quota
+            _sums['used'][_i] += _used
+            if not _essential:
+                _sums['sheddable'][_i] += _used
+            _sums['devices'][_i] += 1
+            _sums['devices_over_quota'][_i] += _used > _quota
+            _sums['peak_devices'][_i] += _peak
+        _sums['excess'] = [_used - _quota for _quota, _used in zip(_sums['quota'], _sums['used'])]
+        _over = [_i for _i in range(_households) if _sums['excess'][_i] > 0]
+        _order = sorted(_over, key=lambda _i: -_sums['excess'][_i])[:max_households]
+        _totals = {
+            'households_over_quota': len(_over),
+            'devices_over_quota': int(sum(_sums['devices_over_quota'])),
+            'peak_devices': int(sum(_sums['peak_devices'])),
+            'excess': math.fsum(_sums['excess'][_i] for _i in _over),
+            'sheddable': math.fsum(_sums['sheddable'][_i] for _i in _over),
+            'recoverable': math.fsum(min(_sums['sheddable'][_i], _sums['excess'][_i]) for _i in _over)
+        }
+    return {'households': _households, 'devices': _count, **_totals,
+            'households_over': _household_rows(_customers, _sums, _order)}
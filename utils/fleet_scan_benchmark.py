@@ -0,0 +1,117 @@
+"""Measures the fleet scan of the peak load Lambda on a large table, offline.
+
+A utils.local_dynamodb table is filled with synthetic households of a few
+devices each, then the households over quota are found three ways:
+
+- one detect_peak call per household, the only way before scan_fleet, timed
+  on a sample of households and extrapolated to all of them
+- a parallel segmented Scan read into columns (utils.fleet_scan.scan_columns)
+- fleet_metrics over the columns, in plain Python and with NumPy
+
+and the scan_fleet tool is timed end to end. Run it from the root of the
+repository:
+
+    python utils/fleet_scan_benchmark.py --rows 1000000
+    python utils/fleet_scan_benchmark.py --rows 100000 --segments 1 4 8 --latency-ms 5 --page-items 2000
+
+The table runs in this process, so without --latency-ms the segments of a
+scan share one CPU and only the request latency they overlap is saved.
+"""
+
+import argparse
+import contextlib
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import client_helper, metrics_kernel
+from utils.fleet_scan import fleet_metrics, scan_columns
+from utils.local_dynamodb import LocalDynamoDB
+from utils.replay_harness import HANDLERS, load_handlers
+
+DEVICES = [('fridge', True), ('iron', False), ('dry-machine', False), ('car charger socket', True),
+           ('gardening electrical system', False), ('heat pump', True), ('pool pump', False)]
+
+
+def devices(rows, seed=0):
+    """Synthetic device rows in the format of the peak table, 3 to 7 per household."""
+    rng = random.Random(seed)
+    household = 0
+    count = 0
+    while count < rows:
+        household += 1
+        for item_id, (item_desc, essential) in enumerate(DEVICES[:min(rng.randint(3, 7), rows - count)], 1):
+            quota = rng.randint(10, 150)
+            used = max(0, int(rng.gauss(quota * 0.9, quota * 0.4)))
+            item = {'customer_id': f"household_{household}", 'item_id': str(item_id), 'item_desc': item_desc,
+                    'quota': str(quota), 'used': str(used), 'essential': str(essential)}
+            if used > quota * 1.5:
+                item['peak'] = 'True'
+            count += 1
+            yield item
+
+
+def median_s(func, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000, help="device rows in the table")
+    parser.add_argument("--segments", nargs="*", type=int, default=[1, 8], help="segments of the parallel scan")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency of each request to the table")
+    parser.add_argument("--page-items", type=int, default=None, help="items per Scan page, standing in for 1 MB")
+    parser.add_argument("--sample", type=int, default=1000, help="households timed with detect_peak")
+    args = parser.parse_args()
+
+    dynamodb = LocalDynamoDB(latency_ms=args.latency_ms, page_items=args.page_items)
+    # The handlers log their invocations, keep them out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        module = load_handlers(dynamodb, ['peak_load'])['peak_load']
+    table_name = HANDLERS['peak_load']['table']
+    start = time.perf_counter()
+    items = list(devices(args.rows))
+    households = len({_item['customer_id'] for _item in items})
+    dynamodb.load_items(table_name, items)
+    del items
+    print(f"Loaded {args.rows:,} device rows of {households:,} households in {time.perf_counter() - start:.1f}s")
+    print(f"{'method':<34} {'seconds':>9} {'rows/s':>12}")
+
+    # One call per household, extrapolated from a sample
+    sample = [f"household_{_i}" for _i in range(1, min(args.sample, households) + 1)]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        elapsed = median_s(lambda: [module.detect_peak(_customer) for _customer in sample], 1)
+    elapsed *= households / len(sample)
+    print(f"{'detect_peak per household (est.)':<34} {elapsed:>9.2f} {args.rows / elapsed:>12,.0f}")
+
+    table = dynamodb.Table(table_name)
+    columns = None
+    for segments in args.segments:
+        elapsed = median_s(lambda: scan_columns(lambda: table, segments), args.runs)
+        print(f"{f'scan to columns, {segments} segments':<34} {elapsed:>9.2f} {args.rows / elapsed:>12,.0f}")
+    columns = scan_columns(lambda: table, max(args.segments))
+
+    vectorize_min_points = metrics_kernel.VECTORIZE_MIN_POINTS
+    for name, threshold in (("fleet_metrics, python", float('inf')), ("fleet_metrics, numpy", vectorize_min_points)):
+        metrics_kernel.VECTORIZE_MIN_POINTS = threshold
+        elapsed = median_s(lambda: fleet_metrics(columns), args.runs)
+        print(f"{name:<34} {elapsed:>9.2f} {args.rows / elapsed:>12,.0f}")
+    metrics_kernel.VECTORIZE_MIN_POINTS = vectorize_min_points
+
+    client_helper.set_resource('dynamodb', dynamodb)
+    elapsed = median_s(lambda: module.scan_fleet(), args.runs)
+    print(f"{'scan_fleet tool':<34} {elapsed:>9.2f} {args.rows / elapsed:>12,.0f}")
+    result = module.scan_fleet(5)
+    print(f"{result['households_over_quota']:,} of {result['households']:,} households over quota by "
+          f"{result['excess']:,.0f} kW, {result['recoverable']:,.0f} kW recoverable by shedding. "
+          f"Furthest over: {', '.join(_row['customer_id'] for _row in result['households_over'])}")
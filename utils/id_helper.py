@@ -0,0 +1,87 @@
+"""Time-ordered identifiers for the items written by the action group Lambda functions.
+
+new_ulid returns a ULID (https://github.com/ulid/spec): 26 characters of
+Crockford base32, a 48-bit millisecond timestamp followed by 80 random bits,
+so identifiers sort in creation order as strings and a DynamoDB sort key of
+ULIDs reads oldest to newest, or newest first with ScanIndexForward=False.
+The identifiers created in the same millisecond by a container increment the
+random part of the previous one, so they keep their creation order too:
+
+    >>> from utils.id_helper import new_ulid, ulid_datetime
+    >>> ticket_id = new_ulid()
+    >>> ticket_id, ulid_datetime(ticket_id)
+    ('01JA8Z5Q7P3N4C9W2XKJ6R1T0B', datetime.datetime(2024, 10, 14, 9, 30, 12, 345000, tzinfo=...))
+
+Items created before their IDs were ULIDs have UUID1 IDs, which hold their
+creation time too but do not sort by it. creation_key maps both to a string
+that does, the ULID of the creation time of a UUID1.
+"""
+
+import os
+import threading
+import time
+import uuid
+
+from datetime import datetime, timezone
+
+_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_DECODE = {_char: _i for _i, _char in enumerate(_ALPHABET)}
+_RANDOM_BITS = 80
+# 100 ns intervals between the UUID epoch (1582-10-15) and the Unix epoch
+_UUID1_EPOCH_OFFSET = 0x01B21DD213814000
+_lock = threading.Lock()
+_last = (0, 0)
+
+
+def _encode(value: int, length: int) -> str:
+    _chars = []
+    for _ in range(length):
+        value, _digit = divmod(value, 32)
+        _chars.append(_ALPHABET[_digit])
+    return ''.join(reversed(_chars))
+
+
+def new_ulid(timestamp_ms: int = None) -> str:
+    """Returns a new ULID, for the current time by default, greater than the previous ones of the container."""
+    global _last
+    _now = int(time.time() * 1000) if timestamp_ms is None else int(timestamp_ms)
+    with _lock:
+        _last_ms, _last_random = _last
+        if _now <= _last_ms and _last_random + 1 < 1 << _RANDOM_BITS:
+            # Same millisecond, or the clock went back: ordered after the previous one
+            _now, _random = _last_ms, _last_random + 1
+        else:
+            _random = int.from_bytes(os.urandom(_RANDOM_BITS // 8), 'big')
+        _last = (_now, _random)
+    return _encode(_now, 10) + _encode(_random, 16)
+
+
+def ulid_datetime(value: str):
+    """Returns the creation time of a ULID, None when the value is not one (e.g. a UUID)."""
+    if not isinstance(value, str) or len(value) != 26 or any(_char not in _DECODE for _char in value.upper()):
+        return None
+    _ms = 0
+    for _char in value[:10].upper():
+        _ms = _ms * 32 + _DECODE[_char]
+    # 48 bits, the first character is at most 7
+    if _ms >> 48:
+        return None
+    return datetime.fromtimestamp(_ms / 1000, timezone.utc)
+
+
+def creation_key(value: str) -> str:
+    """Returns a key of an ID that sorts in creation order: a ULID as it is, a UUID1 as the ULID of its time.
+
+    The random part of the ULID of a UUID1 is made of the UUID bits, so distinct UUID1s keep distinct keys.
+    Other values are returned as they are.
+    """
+    if ulid_datetime(value) is not None:
+        return value.upper()
+    try:
+        _uuid = uuid.UUID(str(value))
+    except ValueError:
+        return value
+    if _uuid.version != 1:
+        return value
+    _ms = max(0, (_uuid.time - _UUID1_EPOCH_OFFSET) // 10000)
+    return _encode(_ms, 10) + _encode(_uuid.int & ((1 << _RANDOM_BITS) - 1), 16)
@@ -0,0 +1,84 @@
+"""Builds the deployment package of an action group Lambda function.
+
+The zip holds the Lambda source file, the shared modules it imports as
+`utils.<module>` and, when the lab has one, its agent_api_definition.json.
+Sources can also be shipped precompiled: the function code is extracted to a
+read-only folder, so without bytecode in the package every cold start compiles
+every module again. Here is a quick example:
+
+    >>> from utils.lambda_package_helper import build_lambda_package
+    >>> zip_content = build_lambda_package("financial_analytics.py", compile_bytecode=True)
+
+This module only depends on the standard library, so it can be used without
+the notebook dependencies of bedrock_agent_helper.
+"""
+
+import importlib.util
+import os
+import py_compile
+import sys
+import tempfile
+import zipfile
+
+from io import BytesIO
+from typing import List, Tuple
+
+# Modules from this folder that action group Lambda functions import as `utils.<module>`.
+# They are packaged into every Lambda zip built by create_lambda, next to the Lambda source file, so they
+# only import the standard library, boto3 from the runtime, and optional dependencies (NumPy) lazily.
+LAMBDA_SHARED_MODULES = [
+    "dynamodb_helper.py", "response_helper.py", "action_group_helper.py", "client_helper.py", "log_helper.py",
+    "metrics_kernel.py", "visualization_parser.py", "explanation_cache.py", "recommendation_engine.py",
+    "peak_detector.py", "fleet_scan.py", "load_forecast.py", "id_helper.py", "faq_index.py"
+]
+# Packaged at the root of the Lambda zip when found next to the source file: the parameter types of the
+# functions, read by utils.action_group_helper, and the FAQ index built by utils/faq_index_builder.py
+LAMBDA_DATA_FILES = ["agent_api_definition.json", "faq_index.json"]
+
+
+def runtime_cache_tag(runtime: str) -> str:
+    """Returns the bytecode cache tag of a Lambda Python runtime, e.g. python3.12 -> cpython-312."""
+    return "cpython-" + runtime.replace("python", "").replace(".", "")
+
+
+def package_files(source_code_file: str) -> List[Tuple[str, str]]:
+    """Lists the (local path, path in the zip) of every file of a Lambda package."""
+    _utils_dir = os.path.dirname(os.path.abspath(__file__))
+    _files = [(source_code_file, os.path.basename(source_code_file))]
+    _files += [(os.path.join(_utils_dir, _module), f"utils/{_module}") for _module in LAMBDA_SHARED_MODULES]
+    for _data_file in LAMBDA_DATA_FILES:
+        _path = os.path.join(os.path.dirname(source_code_file), _data_file)
+        if os.path.exists(_path):
+            _files.append((_path, _data_file))
+    return _files
+
+
+def build_lambda_package(source_code_file: str, compile_bytecode: bool = False, runtime: str = None) -> bytes:
+    """Zips a Lambda source file with the shared modules it imports.
+
+    Args:
+        source_code_file (str): path of the Lambda source file
+        compile_bytecode (bool, Optional): also package the compiled bytecode of every module. Defaults to False.
+        runtime (str, Optional): Lambda runtime the bytecode is for. Bytecode is only compiled when the local
+        interpreter matches it, otherwise a warning is printed and the sources are packaged alone.
+        Defaults to None (the local interpreter).
+
+    Returns:
+        bytes: zip content
+    """
+    _files = package_files(source_code_file)
+    if compile_bytecode and runtime and runtime_cache_tag(runtime) != sys.implementation.cache_tag:
+        print(f"Bytecode not packaged: local interpreter is {sys.implementation.cache_tag}, "
+              f"Lambda runtime is {runtime}")
+        compile_bytecode = False
+
+    s = BytesIO()
+    with zipfile.ZipFile(s, "w") as z, tempfile.TemporaryDirectory() as _tmp:
+        for _path, _arcname in _files:
+            z.write(_path, arcname=_arcname)
+            if compile_bytecode and _arcname.endswith(".py"):
+                # Unchecked hash based pycs stay valid whatever the file times are after extraction
+                _pyc = py_compile.compile(_path, cfile=os.path.join(_tmp, "module.pyc"), dfile=_arcname,
+                                          doraise=True, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+                z.write(_pyc, arcname=importlib.util.cache_from_source(_arcname))
+    return s.getvalue()
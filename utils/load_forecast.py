@@ -0,0 +1,153 @@
+"""Short-horizon load forecasts of the peak load Lambda devices.
+
+A batch job (utils/load_forecast_batch.py) fits a model to the hourly usage
+history of every device and stores the next FORECAST_HORIZON hours of each
+one in a single forecast item per customer, next to its devices in the peak
+table:
+
+- key: the customer id and FORECAST_SUMMARY_KEY as item_id
+- forecast_start: first hour forecast, ISO 8601 UTC
+- fitted_at: when the batch job ran
+- device#<item_id>: the device's item_desc, essential flag, quota and model,
+  and its forecast packed as float32 values (4 bytes per hour, see
+  pack_forecast)
+
+so the forecast_peak tool answers from one read. The model of a device
+depends on the history it has:
+
+- holt-winters: additive Holt-Winters, level, trend and daily seasonality,
+  from two seasons of history on
+- seasonal-naive: the last season repeated, from one season
+- mean: the mean of the history, flat, below one season
+
+    >>> from utils.load_forecast import fit, pack_forecast, unpack_forecast
+    >>> model, values = fit([10, 20, 30, 20, 10, 20, 30, 20, 12, 22, 32, 22], horizon=4, season=4)
+    >>> model, unpack_forecast(pack_forecast(values))
+    ('holt-winters', [11.862, 21.806, 31.775, 21.761])
+
+Many histories of the same length are fitted together with NumPy, one
+vectorized update per hour across the devices, see fit_batch.
+
+Configured with environment variables (defaults):
+
+- forecast_season (24): hours in a season of usage, a day
+- forecast_horizon (24): hours forecast
+- forecast_alpha (0.3), forecast_beta (0.02), forecast_gamma (0.2): smoothing
+  factors of the level, trend and seasonality of Holt-Winters
+"""
+
+import os
+import sys
+
+from array import array
+from typing import Dict, List, Sequence, Tuple
+
+from utils.metrics_kernel import numpy, vectorized
+
+FORECAST_SEASON = int(os.getenv('forecast_season', 24))
+FORECAST_HORIZON = int(os.getenv('forecast_horizon', 24))
+FORECAST_ALPHA = float(os.getenv('forecast_alpha', 0.3))
+FORECAST_BETA = float(os.getenv('forecast_beta', 0.02))
+FORECAST_GAMMA = float(os.getenv('forecast_gamma', 0.2))
+# item_id of the forecast item of a customer
+FORECAST_SUMMARY_KEY = 'summary#forecast'
+
+
+def pack_forecast(values: Sequence[float]) -> bytes:
+    """Packs forecast values as little-endian float32, stored as a DynamoDB binary attribute."""
+    _values = array('f', values)
+    if sys.byteorder != 'little':
+        _values.byteswap()
+    return _values.tobytes()
+
+
+def unpack_forecast(data) -> List[float]:
+    """Unpacks values packed by pack_forecast, read as bytes or as a boto3 Binary."""
+    _values = array('f')
+    _values.frombytes(bytes(getattr(data, 'value', data)))
+    if sys.byteorder != 'little':
+        _values.byteswap()
+    # float32 holds about 7 significant digits
+    return [round(_value, 3) for _value in _values]
+
+
+def seasonal_naive(history: Sequence[float], horizon: int = FORECAST_HORIZON,
+                   season: int = FORECAST_SEASON) -> List[float]:
+    """The last season of the history, repeated over the horizon."""
+    _last = list(history[-season:])
+    return [_last[_h % season] for _h in range(horizon)]
+
+
+def holt_winters(history: Sequence[float], horizon: int = FORECAST_HORIZON, season: int = FORECAST_SEASON,
+                 alpha: float = FORECAST_ALPHA, beta: float = FORECAST_BETA,
+                 gamma: float = FORECAST_GAMMA) -> List[float]:
+    """Additive Holt-Winters forecast of a history of at least two seasons, negative loads read as 0."""
+    _level = sum(history[:season]) / season
+    _trend = (sum(history[season:2 * season]) / season - _level) / season
+    _seasonal = [_value - _level for _value in history[:season]]
+    for _t in range(season, len(history)):
+        _s = _seasonal[_t % season]
+        _previous = _level
+        _level = alpha * (history[_t] - _s) + (1 - alpha) * (_level + _trend)
+        _trend = beta * (_level - _previous) + (1 - beta) * _trend
+        _seasonal[_t % season] = gamma * (history[_t] - _level) + (1 - gamma) * _s
+    _n = len(history)
+    return [max(0.0, _level + _h * _trend + _seasonal[(_n - 1 + _h) % season]) for _h in range(1, horizon + 1)]
+
+
+def _holt_winters_rows(histories, horizon, season, alpha, beta, gamma):
+    # holt_winters over the rows of a matrix of histories of the same length, one pass per hour
+    np = numpy()
+    _level = histories[:, :season].mean(axis=1)
+    _trend = (histories[:, season:2 * season].mean(axis=1) - _level) / season
+    _seasonal = histories[:, :season] - _level[:, None]
+    for _t in range(season, histories.shape[1]):
+        _s = _seasonal[:, _t % season]
+        _previous = _level
+        _level = alpha * (histories[:, _t] - _s) + (1 - alpha) * (_level + _trend)
+        _trend = beta * (_level - _previous) + (1 - beta) * _trend
+        _seasonal[:, _t % season] = gamma * (histories[:, _t] - _level) + (1 - gamma) * _s
+    _steps = np.arange(1, horizon + 1)
+    _forecast = _level[:, None] + _steps * _trend[:, None] + \
+        _seasonal[:, (histories.shape[1] - 1 + _steps) % season]
+    return np.maximum(_forecast, 0.0)
+
+
+def fit(history: Sequence[float], horizon: int = FORECAST_HORIZON,
+        season: int = FORECAST_SEASON) -> Tuple[str, List[float]]:
+    """Fits the model of a device to its hourly history, see the module docstring.
+
+    Returns:
+        Tuple[str, List[float]]: the model name and the values of the next horizon hours,
+        (None, []) without history
+    """
+    if len(history) >= 2 * season:
+        return 'holt-winters', holt_winters(history, horizon, season)
+    if len(history) >= season:
+        return 'seasonal-naive', seasonal_naive(history, horizon, season)
+    if history:
+        return 'mean', [sum(history) / len(history)] * horizon
+    return None, []
+
+
+def fit_batch(histories: List[Sequence[float]], horizon: int = FORECAST_HORIZON,
+              season: int = FORECAST_SEASON) -> List[Tuple[str, List[float]]]:
+    """fit over many histories, the Holt-Winters ones of the same length computed together with NumPy."""
+    _results = [None] * len(histories)
+    _by_length: Dict[int, List[int]] = {}
+    for _i, _history in enumerate(histories):
+        if len(_history) >= 2 * season:
+            _by_length.setdefault(len(_history), []).append(_i)
+        else:
+            _results[_i] = fit(_history, horizon, season)
+    for _length, _indices in _by_length.items():
+        if not vectorized(len(_indices)):
+            for _i in _indices:
+                _results[_i] = fit(histories[_i], horizon, season)
+            continue
+        np = numpy()
+        _rows = np.array([histories[_i] for _i in _indices], dtype=float)
+        _forecasts = _holt_winters_rows(_rows, horizon, season, FORECAST_ALPHA, FORECAST_BETA, FORECAST_GAMMA)
+        for _i, _values in zip(_indices, _forecasts.tolist()):
+            _results[_i] = ('holt-winters', _values)
+    return _results
@@ -0,0 +1,196 @@
+"""Fits the load forecasts of the peak load Lambda devices, as a batch job.
+
+Reads the usage history of the devices, a JSONL file of meter readings, one
+per line:
+
+    {"customer_id": "1", "item_id": "4", "timestamp": "2026-10-16T18:05:00Z", "value": 182.5}
+
+(timestamp in ISO 8601 or seconds since the epoch), averages it per hour,
+fits a model per device (utils.load_forecast) and writes the forecast item of
+every customer to the peak table, for the forecast_peak tool. The forecasts
+start the hour after the last reading of the file. Hours without readings
+take the value of the same hour a season before, or of the previous hour.
+Readings of devices that are not in the table are counted and skipped.
+Run it from the root of the repository, e.g. every hour:
+
+    python utils/load_forecast_batch.py readings.jsonl --table peak-table
+    python utils/load_forecast_batch.py --synthetic 100000 --days 14
+
+--synthetic fits generated histories for as many devices of a local table
+(utils.local_dynamodb, see utils.fleet_scan_benchmark) instead, and reports
+how long each step takes. --python fits every history in plain Python.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+from collections import Counter
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import metrics_kernel
+from utils.dynamodb_helper import scan_pages
+from utils.load_forecast import FORECAST_HORIZON, FORECAST_SEASON, FORECAST_SUMMARY_KEY, fit_batch, pack_forecast
+
+HOUR = 3600
+
+
+def _epoch(timestamp) -> float:
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    _time = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    if _time.tzinfo is None:
+        _time = _time.replace(tzinfo=timezone.utc)
+    return _time.timestamp()
+
+
+def _iso(hour: int) -> str:
+    return datetime.fromtimestamp(hour * HOUR, timezone.utc).isoformat(timespec='seconds')
+
+
+def read_readings(path):
+    """Reads meter readings into (customer_id, item_id) -> hour -> [sum, count]. Returns (buckets, errors)."""
+    buckets, errors = {}, 0
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                reading = json.loads(line)
+                device = (str(reading['customer_id']), str(reading['item_id']))
+                hour = int(_epoch(reading['timestamp']) // HOUR)
+                value = float(reading['value'])
+                if not math.isfinite(value):
+                    raise ValueError(value)
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError, AttributeError):
+                errors += 1
+                continue
+            bucket = buckets.setdefault(device, {}).setdefault(hour, [0.0, 0])
+            bucket[0] += value
+            bucket[1] += 1
+    return buckets, errors
+
+
+def hourly(buckets, last_hour, max_hours, season=FORECAST_SEASON):
+    """Hourly means of the buckets of a device up to last_hour, at most max_hours of them, gaps filled."""
+    first_hour = max(min(buckets), last_hour - max_hours + 1)
+    series = []
+    for hour in range(first_hour, last_hour + 1):
+        bucket = buckets.get(hour)
+        if bucket is not None:
+            series.append(bucket[0] / bucket[1])
+        elif len(series) >= season:
+            series.append(series[-season])
+        elif series:
+            series.append(series[-1])
+        else:
+            # Only when the window starts in a gap: the first hour read in it
+            series.append(next(_b[0] / _b[1] for _h, _b in sorted(buckets.items()) if _h >= hour))
+    return series
+
+
+def read_devices(table, pk='customer_id', sk='item_id'):
+    """Reads the devices of the peak table, summaries left out, into (customer_id, item_id) -> item."""
+    return {(_item[pk], _item[sk]): _item
+            for _page in scan_pages(table, projection=[pk, sk, 'item_desc', 'quota', 'essential'])
+            for _item in _page if 'quota' in _item}
+
+
+def forecast_items(devices, histories, start_hour, pk='customer_id', sk='item_id'):
+    """Fits the histories, (customer_id, item_id) -> hourly values, into one forecast item per customer.
+
+    Returns:
+        Tuple[List[Dict], Counter]: the forecast items and the number of devices fitted with each model
+    """
+    keys = list(histories)
+    fitted_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    items, models = {}, Counter()
+    for (customer_id, item_id), (model, values) in zip(keys, fit_batch([histories[_key] for _key in keys])):
+        if model is None:
+            continue
+        device = devices[(customer_id, item_id)]
+        item = items.setdefault(customer_id, {pk: customer_id, sk: FORECAST_SUMMARY_KEY,
+                                              'forecast_start': _iso(start_hour), 'fitted_at': fitted_at})
+        item[f"device#{item_id}"] = {'item_desc': device.get('item_desc'), 'essential': device.get('essential'),
+                                     'quota': device.get('quota'), 'model': model,
+                                     'forecast': pack_forecast(values)}
+        models[model] += 1
+    return list(items.values()), models
+
+
+def write_items(table, items):
+    """Writes the forecast items, replacing the previous ones, 25 per request."""
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+
+def synthetic_histories(devices, hours, seed=0):
+    """Hourly histories of the devices: a daily cycle around 90% of the quota, a slow drift and noise."""
+    rng = random.Random(seed)
+    histories = {}
+    for key, device in devices.items():
+        quota = float(device['quota'])
+        phase, drift = rng.uniform(0, 2 * math.pi), rng.uniform(-0.0005, 0.0005)
+        histories[key] = [max(0.0, quota * (0.9 + 0.4 * math.sin(2 * math.pi * _h / 24 + phase) + drift * _h
+                                            + rng.gauss(0, 0.1))) for _h in range(hours)]
+    return histories
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("readings", nargs="?", help="JSONL file of meter readings")
+    parser.add_argument("--table", help="peak table the forecasts are written to")
+    parser.add_argument("--pk", default="customer_id", help="partition key of the table")
+    parser.add_argument("--sk", default="item_id", help="sort key of the table")
+    parser.add_argument("--days", type=int, default=28, help="days of history fitted")
+    parser.add_argument("--synthetic", type=int, default=0, help="fit generated histories of this many devices")
+    parser.add_argument("--python", action="store_true", help="fit in plain Python, without NumPy")
+    args = parser.parse_args()
+    if not args.synthetic and not (args.readings and args.table):
+        parser.error("a readings file and --table, or --synthetic, are required")
+    if args.python:
+        metrics_kernel.VECTORIZE_MIN_POINTS = float('inf')
+
+    start = time.perf_counter()
+    if args.synthetic:
+        from utils.fleet_scan_benchmark import devices as synthetic_devices
+        from utils.local_dynamodb import LocalDynamoDB
+        dynamodb = LocalDynamoDB()
+        dynamodb.create_table(args.table or 'peak-table', args.pk, args.sk)
+        dynamodb.load_items(args.table or 'peak-table', list(synthetic_devices(args.synthetic)))
+        table = dynamodb.Table(args.table or 'peak-table')
+        devices = read_devices(table, args.pk, args.sk)
+        histories = synthetic_histories(devices, args.days * 24)
+        last_hour, unknown, errors = int(time.time() // HOUR), 0, 0
+    else:
+        from utils.client_helper import get_table
+        table = get_table(args.table)
+        buckets, errors = read_readings(args.readings)
+        if not buckets:
+            raise SystemExit(f"Error: no readings in {args.readings} ({errors:,} invalid lines)")
+        devices = read_devices(table, args.pk, args.sk)
+        last_hour = max(max(_hours) for _hours in buckets.values())
+        histories = {_key: hourly(_hours, last_hour, args.days * 24) for _key, _hours in buckets.items()
+                     if _key in devices}
+        unknown = len(buckets) - len(histories)
+    read_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    items, models = forecast_items(devices, histories, last_hour + 1, args.pk, args.sk)
+    fit_s = time.perf_counter() - start
+    start = time.perf_counter()
+    write_items(table, items)
+    write_s = time.perf_counter() - start
+    print(f"Forecast the next {FORECAST_HORIZON} hours of {len(histories):,} devices of {len(items):,} customers "
+          f"from {_iso(last_hour + 1)}: " + ', '.join(f"{_count:,} {_model}" for _model, _count in models.items()))
+    if unknown or errors:
+        print(f"Skipped {unknown:,} devices not in the table and {errors:,} invalid readings")
+    print(f"read {read_s:.2f}s, fit {fit_s:.2f}s ({len(histories) / fit_s if fit_s else 0:,.0f} devices/s), "
+          f"write {write_s:.2f}s")
@@ -0,0 +1,514 @@
+"""In-process stand-in for the DynamoDB tables of the action group Lambda functions.
+
+LocalDynamoDB mimics the parts of the boto3 DynamoDB resource the Lambda
+functions use, so they can be run and load tested without an AWS account:
+
+- Table.query with boto3 Key conditions (eq, begins_with, between, <, <=, >, >=),
+  boto3 Attr filters, projections, Limit/ExclusiveStartKey pagination and
+  secondary indexes declared like in AgentsForAmazonBedrock.create_dynamodb
+- Table.scan, with parallel scan segments
+- Table.get_item, put_item, delete_item (ReturnValues='ALL_OLD') and batch_writer
+- Table.update_item with SET (values, if_not_exists and list_append), ADD and REMOVE clauses and a
+  boto3 Attr ConditionExpression
+- batch_get_item on the resource, and transact_write_items on its client (resource.meta.client,
+  also Table.meta.client) with native values, like boto3 accepts them there. boto3 does not convert
+  Attr conditions within a transaction, so their ConditionExpression is a string comparing
+  attributes to values (=, <>, <, <=, >, >=), attribute_exists and attribute_not_exists, joined by AND
+
+Like DynamoDB, Limit counts the items read before the filter is applied, numbers
+are returned as Decimal and floats are rejected. Each request can be given an
+artificial latency to stand in for the network round trip. Here is a quick
+example of running a Lambda function against it:
+
+    >>> from utils import client_helper
+    >>> from utils.local_dynamodb import LocalDynamoDB
+    >>> dynamodb = LocalDynamoDB(latency_ms=5)
+    >>> dynamodb.create_table('peak-table', 'customer_id', 'item_id')
+    >>> dynamodb.load_json('peak-table', '3-peak-load-manager/3_peak_sample_data.json')
+    >>> client_helper.set_resource('dynamodb', dynamodb)
+"""
+
+import contextlib
+import json
+import re
+import threading
+import time
+import zlib
+
+from decimal import Decimal
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+from utils.dynamodb_helper import add_index_keys, index_key_name
+
+
+def _client_error(code: str, message: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def to_dynamodb(value):
+    """Converts a value to what DynamoDB would store and return: ints become Decimal, floats are rejected."""
+    if isinstance(value, bool) or value is None or isinstance(value, (str, bytes, Decimal)):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")
+    if isinstance(value, dict):
+        return {_key: to_dynamodb(_val) for _key, _val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamodb(_val) for _val in value]
+    if isinstance(value, set):
+        return {to_dynamodb(_val) for _val in value}
+    raise TypeError(f"Unsupported type {type(value)} for value {value}")
+
+
+def evaluate(condition, item: Dict) -> bool:
+    """Evaluates a boto3 Key or Attr condition against an item."""
+    _expr = condition.get_expression()
+    _op, _values = _expr['operator'], _expr['values']
+    if _op == 'AND':
+        return evaluate(_values[0], item) and evaluate(_values[1], item)
+    if _op == 'OR':
+        return evaluate(_values[0], item) or evaluate(_values[1], item)
+    if _op == 'NOT':
+        return not evaluate(_values[0], item)
+
+    _name = _values[0].name
+    if _op == 'attribute_exists':
+        return _name in item
+    if _op == 'attribute_not_exists':
+        return _name not in item
+    if _name not in item:
+        return False
+    _value = item[_name]
+    _args = [to_dynamodb(_arg) for _arg in _values[1:]]
+    try:
+        if _op == '=':
+            return _value == _args[0]
+        if _op == '<>':
+            return _value != _args[0]
+        if _op == '<':
+            return _value < _args[0]
+        if _op == '<=':
+            return _value <= _args[0]
+        if _op == '>':
+            return _value > _args[0]
+        if _op == '>=':
+            return _value >= _args[0]
+        if _op == 'BETWEEN':
+            return _args[0] <= _value <= _args[1]
+        if _op == 'IN':
+            return _value in _args[0]
+        if _op == 'begins_with':
+            return isinstance(_value, str) and _value.startswith(_args[0])
+        if _op == 'contains':
+            return _args[0] in _value
+    except TypeError:
+        # DynamoDB compares values of different types as not matching
+        return False
+    raise NotImplementedError(f"Condition operator not supported: {_op}")
+
+
+def parse_condition(expression: str, names: Dict = None, values: Dict = None):
+    """Converts a ConditionExpression string, see the module docstring, to the equivalent boto3 Attr condition."""
+    names, values = names or {}, values or {}
+    _condition = None
+    for _term in re.split(r'\s+AND\s+', expression.strip(), flags=re.IGNORECASE):
+        _function = re.fullmatch(r'(attribute_exists|attribute_not_exists)\(\s*(\S+?)\s*\)', _term.strip())
+        if _function:
+            _attr = Attr(names.get(_function.group(2), _function.group(2)))
+            _term = _attr.exists() if _function.group(1) == 'attribute_exists' else _attr.not_exists()
+        else:
+            _comparison = re.fullmatch(r'(\S+)\s*(=|<>|<=|>=|<|>)\s*(\S+)', _term.strip())
+            if not _comparison:
+                raise NotImplementedError(f"Condition not supported: {_term}")
+            _attr = Attr(names.get(_comparison.group(1), _comparison.group(1)))
+            _value = values[_comparison.group(3)]
+            _term = {'=': _attr.eq, '<>': _attr.ne, '<': _attr.lt, '<=': _attr.lte, '>': _attr.gt,
+                     '>=': _attr.gte}[_comparison.group(2)](_value)
+        _condition = _term if _condition is None else _condition & _term
+    return _condition
+
+
+def _split_top(expression: str) -> List[str]:
+    # Splits on the commas outside of parentheses, e.g. the actions of a SET clause
+    _parts, _depth, _start = [], 0, 0
+    for _i, _char in enumerate(expression):
+        if _char == '(':
+            _depth += 1
+        elif _char == ')':
+            _depth -= 1
+        elif _char == ',' and _depth == 0:
+            _parts.append(expression[_start:_i])
+            _start = _i + 1
+    _parts.append(expression[_start:])
+    return [_part.strip() for _part in _parts if _part.strip()]
+
+
+def _operand(expression: str, item: Dict, names: Dict, values: Dict):
+    # Value of the right-hand side of a SET action: a value, an attribute, if_not_exists or list_append
+    _function = re.fullmatch(r'(if_not_exists|list_append)\s*\((.*)\)', expression.strip(),
+                             flags=re.IGNORECASE | re.DOTALL)
+    if _function:
+        _first, _second = _split_top(_function.group(2))
+        if _function.group(1).lower() == 'if_not_exists':
+            _attr = names.get(_first, _first)
+            return item[_attr] if _attr in item else _operand(_second, item, names, values)
+        return list(_operand(_first, item, names, values)) + list(_operand(_second, item, names, values))
+    expression = expression.strip()
+    if expression.startswith(':'):
+        return values[expression]
+    return item[names.get(expression, expression)]
+
+
+def _condition_names(condition) -> List[str]:
+    # Attribute names a condition refers to
+    _names = []
+    for _value in condition.get_expression()['values']:
+        if hasattr(_value, 'get_expression'):
+            _names += _condition_names(_value)
+        elif hasattr(_value, 'name'):
+            _names.append(_value.name)
+    return _names
+
+
+def _projection(item: Dict, projection: str, names: Dict) -> Dict:
+    if not projection:
+        return dict(item)
+    _fields = [names.get(_field.strip(), _field.strip()) for _field in projection.split(',')]
+    return {_field: item[_field] for _field in _fields if _field in item}
+
+
+class LocalTable:
+    """In-memory table, see LocalDynamoDB."""
+
+    def __init__(self, name: str, pk: str, sk: str = None, indexes: List[Dict] = None, latency: float = 0.0,
+                 page_items: int = None, client=None):
+        """Constructs an instance.
+
+        Args:
+            name (str): table name
+            pk (str): partition key attribute
+            sk (str, Optional): sort key attribute. Defaults to None.
+            indexes (List[Dict], Optional): secondary indexes, see AgentsForAmazonBedrock.create_dynamodb
+            latency (float, Optional): seconds each request takes. Defaults to 0.
+            page_items (int, Optional): maximum number of items read per query or scan request, standing in
+            for the 1 MB page limit of DynamoDB. Defaults to None (no limit).
+            client (Optional): what meta.client of the table is, the LocalDynamoDB holding it
+        """
+        self.name = name
+        self.table_name = name
+        self._pk, self._sk = pk, sk
+        self._indexes = {_index['name']: (index_key_name(_index['partition_key']),
+                                          index_key_name(_index['sort_key']) if _index.get('sort_key') else None)
+                         for _index in indexes or []}
+        self._index_defs = indexes or []
+        self._latency = latency
+        self._page_items = page_items
+        self._partitions = {}
+        self._lock = threading.RLock()
+        self.meta = SimpleNamespace(client=client)
+
+    def _wait(self):
+        if self._latency:
+            time.sleep(self._latency)
+
+    def _key(self, key: Dict):
+        try:
+            return to_dynamodb(key[self._pk]), to_dynamodb(key[self._sk]) if self._sk else None
+        except KeyError:
+            raise _client_error('ValidationException', 'The provided key element does not match the schema',
+                                'GetItem')
+
+    def _key_of(self, item: Dict, index_name: str = None) -> Dict:
+        _attrs = [self._pk] + ([self._sk] if self._sk else [])
+        if index_name:
+            _attrs += [_attr for _attr in self._indexes[index_name] if _attr]
+        return {_attr: item[_attr] for _attr in dict.fromkeys(_attrs)}
+
+    def _sort_key(self, item: Dict, index_name: str = None):
+        _sk = self._indexes[index_name][1] if index_name else self._sk
+        return (str(type(item.get(_sk))), item.get(_sk)) if _sk else ('', '')
+
+    def item_count(self) -> int:
+        with self._lock:
+            return sum(len(_partition) for _partition in self._partitions.values())
+
+    def get_item(self, Key: Dict, ProjectionExpression: str = None, ExpressionAttributeNames: Dict = None,
+                 **kwargs) -> Dict:
+        self._wait()
+        _item = self._get(Key)
+        if _item is None:
+            return {}
+        return {'Item': _projection(_item, ProjectionExpression, ExpressionAttributeNames or {})}
+
+    def _get(self, Key: Dict):
+        _pk, _sk = self._key(Key)
+        with self._lock:
+            _item = self._partitions.get(_pk, {}).get(_sk)
+            return dict(_item) if _item is not None else None
+
+    def put_item(self, Item: Dict, ReturnValues: str = 'NONE', **kwargs) -> Dict:
+        self._wait()
+        return self._put(Item, ReturnValues)
+
+    def _put(self, Item: Dict, ReturnValues: str = 'NONE') -> Dict:
+        _item = to_dynamodb(Item)
+        _pk, _sk = self._key(_item)
+        with self._lock:
+            _old = self._partitions.setdefault(_pk, {}).get(_sk)
+            self._partitions[_pk][_sk] = _item
+        return {'Attributes': dict(_old)} if _old is not None and ReturnValues == 'ALL_OLD' else {}
+
+    def delete_item(self, Key: Dict, ReturnValues: str = 'NONE', **kwargs) -> Dict:
+        self._wait()
+        return self._delete(Key, ReturnValues)
+
+    def _delete(self, Key: Dict, ReturnValues: str = 'NONE') -> Dict:
+        _pk, _sk = self._key(Key)
+        with self._lock:
+            _old = self._partitions.get(_pk, {}).pop(_sk, None)
+        return {'Attributes': _old} if _old is not None and ReturnValues == 'ALL_OLD' else {}
+
+    def update_item(self, Key: Dict, UpdateExpression: str, ExpressionAttributeNames: Dict = None,
+                    ExpressionAttributeValues: Dict = None, ReturnValues: str = 'NONE', ConditionExpression=None,
+                    **kwargs) -> Dict:
+        self._wait()
+        return self._update(Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues, ReturnValues,
+                            ConditionExpression)
+
+    def _holds(self, Key: Dict, ConditionExpression=None) -> bool:
+        # Whether the condition holds for the item of Key, missing or not
+        if ConditionExpression is None:
+            return True
+        _pk, _sk = self._key(Key)
+        with self._lock:
+            return evaluate(ConditionExpression, self._partitions.get(_pk, {}).get(_sk) or {})
+
+    def _update(self, Key: Dict, UpdateExpression: str, ExpressionAttributeNames: Dict = None,
+                ExpressionAttributeValues: Dict = None, ReturnValues: str = 'NONE', ConditionExpression=None) -> Dict:
+        _names = ExpressionAttributeNames or {}
+        _values = to_dynamodb(ExpressionAttributeValues or {})
+        _pk, _sk = self._key(Key)
+        # Clauses: SET a = :v, b = :w ADD c :x REMOVE d
+        _clauses = re.split(r'\b(SET|ADD|REMOVE)\b', UpdateExpression.strip(), flags=re.IGNORECASE)[1:]
+        with self._lock:
+            _old = self._partitions.setdefault(_pk, {}).get(_sk)
+            if ConditionExpression is not None and not evaluate(ConditionExpression, _old or {}):
+                raise _client_error('ConditionalCheckFailedException', 'The conditional request failed',
+                                    'UpdateItem')
+            _item = dict(_old) if _old else dict(to_dynamodb(Key))
+            for _action, _body in zip(_clauses[::2], _clauses[1::2]):
+                for _part in _split_top(_body):
+                    _action = _action.upper()
+                    if _action == 'SET':
+                        _attr, _value = (_side.strip() for _side in _part.split('=', 1))
+                        _item[_names.get(_attr, _attr)] = _operand(_value, _item, _names, _values)
+                    elif _action == 'ADD':
+                        _attr, _value = _part.split()
+                        _attr = _names.get(_attr, _attr)
+                        _item[_attr] = _item.get(_attr, Decimal(0)) + _values[_value]
+                    else:
+                        _item.pop(_names.get(_part, _part), None)
+            self._partitions[_pk][_sk] = _item
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': dict(_item)}
+        if ReturnValues == 'ALL_OLD' and _old:
+            return {'Attributes': dict(_old)}
+        return {}
+
+    def _page(self, candidates: List[Dict], index_name: str, FilterExpression=None, ProjectionExpression=None,
+              ExpressionAttributeNames=None, Limit=None, ExclusiveStartKey=None, Select=None):
+        # candidates are sorted, pages start after ExclusiveStartKey and hold up to Limit read items
+        if ExclusiveStartKey:
+            _start = next((i + 1 for i, _item in enumerate(candidates)
+                           if self._key_of(_item, index_name) == ExclusiveStartKey), len(candidates))
+            candidates = candidates[_start:]
+        _limit = min(_n for _n in (Limit, self._page_items, len(candidates)) if _n is not None)
+        _read = candidates[:_limit]
+        _items = [_item for _item in _read if FilterExpression is None or evaluate(FilterExpression, _item)]
+        _resp = {'Count': len(_items), 'ScannedCount': len(_read)}
+        if Select != 'COUNT':
+            _resp['Items'] = [_projection(_item, ProjectionExpression, ExpressionAttributeNames or {})
+                              for _item in _items]
+        if _read and len(_read) < len(candidates):
+            _resp['LastEvaluatedKey'] = self._key_of(_read[-1], index_name)
+        return _resp
+
+    def query(self, KeyConditionExpression, IndexName: str = None, ScanIndexForward: bool = True, **kwargs) -> Dict:
+        self._wait()
+        _pk_attr = self._indexes[IndexName][0] if IndexName else self._pk
+        _pk_condition = next(_cond for _cond in self._key_conditions(KeyConditionExpression)
+                             if _condition_names(_cond) == [_pk_attr])
+        _pk_value = to_dynamodb(_pk_condition.get_expression()['values'][1])
+        with self._lock:
+            if IndexName:
+                _index_attrs = [_attr for _attr in self._indexes[IndexName] if _attr]
+                _candidates = [_item for _partition in self._partitions.values() for _item in _partition.values()
+                               if _item.get(_pk_attr) == _pk_value and all(_a in _item for _a in _index_attrs)]
+            else:
+                _candidates = list(self._partitions.get(_pk_value, {}).values())
+        _candidates = [_item for _item in _candidates if evaluate(KeyConditionExpression, _item)]
+        _candidates.sort(key=lambda _item: (self._sort_key(_item, IndexName), self._sort_key(_item)),
+                         reverse=not ScanIndexForward)
+        return self._page(_candidates, IndexName, **kwargs)
+
+    def _key_conditions(self, condition) -> List:
+        _expr = condition.get_expression()
+        if _expr['operator'] == 'AND':
+            return self._key_conditions(_expr['values'][0]) + self._key_conditions(_expr['values'][1])
+        return [condition]
+
+    def scan(self, Segment: int = None, TotalSegments: int = None, IndexName: str = None, **kwargs) -> Dict:
+        self._wait()
+        with self._lock:
+            _candidates = [_item for _pk, _partition in sorted(self._partitions.items(), key=lambda p: str(p[0]))
+                           if TotalSegments is None or zlib.crc32(str(_pk).encode()) % TotalSegments == Segment
+                           for _item in _partition.values()]
+        if IndexName:
+            _candidates = [_item for _item in _candidates
+                           if all(_a in _item for _a in self._indexes[IndexName] if _a)]
+        _candidates.sort(key=lambda _item: (str(_item[self._pk]), self._sort_key(_item)))
+        return self._page(_candidates, IndexName, **kwargs)
+
+    def batch_writer(self, overwrite_by_pkeys: List[str] = None):
+        return _BatchWriter(self)
+
+
+class _BatchWriter:
+    # Like boto3's, sends the writes in BatchWriteItem requests of 25
+    def __init__(self, table: LocalTable):
+        self._table = table
+        self._buffer = []
+
+    def put_item(self, Item: Dict):
+        self._buffer.append((self._table._put, Item))
+        if len(self._buffer) >= 25:
+            self._flush()
+
+    def delete_item(self, Key: Dict):
+        self._buffer.append((self._table._delete, Key))
+        if len(self._buffer) >= 25:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._table._wait()
+            for _write, _arg in self._buffer:
+                _write(_arg)
+            self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._flush()
+        return False
+
+
+class LocalDynamoDB:
+    """In-process stand-in for boto3.resource('dynamodb'), see the module docstring."""
+
+    def __init__(self, latency_ms: float = 0.0, page_items: int = None):
+        """Constructs an instance.
+
+        Args:
+            latency_ms (float, Optional): milliseconds each request takes. Defaults to 0.
+            page_items (int, Optional): maximum number of items per query or scan page. Defaults to None.
+        """
+        self._latency = latency_ms / 1000
+        self._page_items = page_items
+        self._tables = {}
+        # Stands in for the client as well
+        self.meta = SimpleNamespace(client=self)
+
+    def create_table(self, table_name: str, pk: str, sk: str = None, indexes: List[Dict] = None) -> LocalTable:
+        """Creates an empty table, with the arguments of AgentsForAmazonBedrock.create_dynamodb."""
+        self._tables[table_name] = LocalTable(table_name, pk, sk, indexes, self._latency, self._page_items, self)
+        return self._tables[table_name]
+
+    def Table(self, table_name: str) -> LocalTable:
+        if table_name not in self._tables:
+            raise _client_error('ResourceNotFoundException', f'Requested resource not found: {table_name}', 'Query')
+        return self._tables[table_name]
+
+    def batch_get_item(self, RequestItems: Dict, **kwargs) -> Dict:
+        _responses = {}
+        if self._latency:
+            time.sleep(self._latency)
+        for _table_name, _request in RequestItems.items():
+            _table = self.Table(_table_name)
+            _items = [_table._get(_key) for _key in _request['Keys']]
+            _responses[_table_name] = [_item for _item in _items if _item]
+        return {'Responses': _responses, 'UnprocessedKeys': {}}
+
+    def transact_write_items(self, TransactItems: List[Dict], **kwargs) -> Dict:
+        """Applies Put, Update, Delete and ConditionCheck requests all at once, or none if a condition fails."""
+        if not 0 < len(TransactItems) <= 100:
+            raise _client_error('ValidationException', 'Member must have length between 1 and 100',
+                                'TransactWriteItems')
+        _requests = []
+        for _request in TransactItems:
+            (_action, _args), = _request.items()
+            _table = self.Table(_args['TableName'])
+            _requests.append((_action, _table, _args, _args.get('Key') or _table._key_of(to_dynamodb(_args['Item']))))
+        if len({(_table.name,) + _table._key(_key) for _action, _table, _args, _key in _requests}) < len(_requests):
+            raise _client_error('ValidationException',
+                                'Transaction request cannot include multiple operations on one item',
+                                'TransactWriteItems')
+        if self._latency:
+            time.sleep(self._latency)
+        with contextlib.ExitStack() as _stack:
+            # Tables locked in name order, so concurrent transactions cannot deadlock
+            _tables = {_table.name: _table for _action, _table, _args, _key in _requests}
+            for _name in sorted(_tables):
+                _stack.enter_context(_tables[_name]._lock)
+            _reasons = [{'Code': 'None'} if _table._holds(_key, parse_condition(
+                _args['ConditionExpression'], _args.get('ExpressionAttributeNames'),
+                to_dynamodb(_args.get('ExpressionAttributeValues'))) if _args.get('ConditionExpression') else None)
+                        else {'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'}
+                        for _action, _table, _args, _key in _requests]
+            if any(_reason['Code'] != 'None' for _reason in _reasons):
+                raise ClientError({'Error': {'Code': 'TransactionCanceledException',
+                                             'Message': 'Transaction cancelled, please refer cancellation reasons for '
+                                                        'specific reasons [' + ', '.join(_reason['Code'] for _reason in
+                                                                                         _reasons) + ']'},
+                                   'CancellationReasons': _reasons}, 'TransactWriteItems')
+            for _action, _table, _args, _key in _requests:
+                if _action == 'Put':
+                    _table._put(_args['Item'])
+                elif _action == 'Update':
+                    _table._update(_key, _args['UpdateExpression'], _args.get('ExpressionAttributeNames'),
+                                   _args.get('ExpressionAttributeValues'))
+                elif _action == 'Delete':
+                    _table._delete(_key)
+        return {}
+
+    def load_items(self, table_name: str, items: List[Dict], on_write: Callable = None) -> int:
+        """Puts items in a table like AgentsForAmazonBedrock.load_dynamodb: numbers given as strings
+        stay strings, index key attributes are added, and on_write(item, old_item) is called after each put.
+        The items are set up before the requests measured, so their writes take no latency.
+
+        Returns:
+            int: number of items written
+        """
+        _table = self.Table(table_name)
+        for _item in items:
+            _resp = _table._put(add_index_keys(dict(_item), _table._index_defs), ReturnValues='ALL_OLD')
+            if on_write:
+                on_write(_item, _resp.get('Attributes'))
+        return len(items)
+
+    def load_json(self, table_name: str, path: str, on_write: Callable = None) -> int:
+        """Loads the items of a lab sample data file, a JSON array or one JSON object per line. See load_items."""
+        with open(path) as f:
+            _text = f.read()
+        try:
+            _items = json.loads(_text)
+        except json.JSONDecodeError:
+            _items = [json.loads(_line) for _line in _text.splitlines() if _line.strip()]
+        return self.load_items(table_name, _items, on_write)
@@ -0,0 +1,150 @@
+"""Structured, sampled logging shared by the action group Lambda functions.
+
+Every record is one JSON line on stdout, which CloudWatch Logs stores as is:
+
+    {"level": "INFO", "message": "event", "function": "detect_peak", "payload": {...}}
+
+The full event and response of an invocation are only logged for a sample of
+the invocations, and always when the invocation fails. Payloads are cut to a
+maximum size and the values of customer fields are replaced by a short hash,
+which still lets the records of one customer be matched. Each invocation also
+emits one CloudWatch Embedded Metric Format record, which CloudWatch turns
+into per-function Duration, ItemCount, ResponseSize and Errors metrics with no
+extra API call.
+
+Configured with environment variables of the Lambda function (defaults):
+
+- log_level (INFO): DEBUG, INFO, WARNING or ERROR. DEBUG logs every payload.
+- log_sample_rate (0.1): share of the invocations whose event and response are logged
+- log_sample_rates: per function rates overriding it, e.g. "explain_visualization=0.01,update_projections=1"
+- log_max_payload_chars (2000): payloads are cut past this size
+- log_redact_fields (customer_id,customer_ids,description,msg,email): fields whose values are hashed, as dict
+  keys or as action group parameters ({"name": ..., "value": ...}, only the value is hashed)
+- metrics_namespace (MultiAgentFinance): CloudWatch namespace of the metrics
+"""
+
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from typing import Dict, List
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+# Serializes the writes of the threads of an invocation, so each record stays on a line of its own
+_write_lock = threading.Lock()
+
+
+def _parse_rates(rates: str) -> Dict[str, float]:
+    _rates = {}
+    for _pair in (rates or '').split(','):
+        if '=' in _pair:
+            _function, _rate = _pair.split('=', 1)
+            _rates[_function.strip()] = float(_rate)
+    return _rates
+
+
+def item_count(result) -> int:
+    """Number of items in a function result: list length, or total length of the lists of a dict."""
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict):
+        return sum(len(_val) if isinstance(_val, (list, dict)) else 0 for _val in result.values())
+    return 0
+
+
+class StructuredLogger:
+    """JSON line logger with sampling, payload caps, redaction and EMF metrics, see the module docstring."""
+
+    def __init__(
+            self,
+            level: str = None,
+            sample_rate: float = None,
+            sample_rates: Dict[str, float] = None,
+            max_payload_chars: int = None,
+            redact_fields: List[str] = None,
+            namespace: str = None
+    ):
+        """Constructs an instance, each argument defaulting to its environment variable."""
+        self.level = LEVELS.get((level or os.getenv('log_level', 'INFO')).upper(), 20)
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv('log_sample_rate', 0.1))
+        self.sample_rates = sample_rates if sample_rates is not None else _parse_rates(os.getenv('log_sample_rates'))
+        self.max_payload_chars = max_payload_chars or int(os.getenv('log_max_payload_chars', 2000))
+        self.redact_fields = set(redact_fields or os.getenv(
+            'log_redact_fields', 'customer_id,customer_ids,description,msg,email').split(','))
+        self.namespace = namespace or os.getenv('metrics_namespace', 'MultiAgentFinance')
+
+    def _emit(self, record: Dict) -> None:
+        _line = json.dumps(record, default=str, separators=(',', ':')) + '\n'
+        with _write_lock:
+            sys.stdout.write(_line)
+            sys.stdout.flush()
+
+    def log(self, level: str, message: str, **fields) -> None:
+        """Logs a record if level is enabled. Fields are added to the record as they are."""
+        if LEVELS[level] >= self.level:
+            self._emit({'level': level, 'message': message, **fields})
+
+    def debug(self, message: str, **fields) -> None:
+        self.log('DEBUG', message, **fields)
+
+    def info(self, message: str, **fields) -> None:
+        self.log('INFO', message, **fields)
+
+    def warning(self, message: str, **fields) -> None:
+        self.log('WARNING', message, **fields)
+
+    def error(self, message: str, **fields) -> None:
+        self.log('ERROR', message, **fields)
+
+    def sampled(self, function: str) -> bool:
+        """Draws whether the payloads of an invocation of function are logged."""
+        if self.level <= LEVELS['DEBUG']:
+            return True
+        return random.random() < self.sample_rates.get(function, self.sample_rate)
+
+    def _hash(self, value) -> str:
+        return 'redacted:' + hashlib.sha256(str(value).encode()).hexdigest()[:10]
+
+    def redact(self, value):
+        """Hashes the values of customer fields, in dicts and in action group parameter lists."""
+        if isinstance(value, dict):
+            if 'name' in value and 'value' in value:
+                # Parameter entry: the name is kept, the value hashed when the parameter is a redacted field
+                return {**value, 'value': self._hash(value['value']) if value['name'] in self.redact_fields
+                        else self.redact(value['value'])}
+            return {_key: self._hash(_val) if _key in self.redact_fields else self.redact(_val)
+                    for _key, _val in value.items()}
+        if isinstance(value, list):
+            return [self.redact(_val) for _val in value]
+        return value
+
+    def payload(self, value):
+        """Redacts a payload and cuts it to max_payload_chars once serialized."""
+        _redacted = self.redact(value)
+        _text = json.dumps(_redacted, default=str, separators=(',', ':'))
+        if len(_text) <= self.max_payload_chars:
+            return _redacted
+        return f"{_text[:self.max_payload_chars]}... [truncated, {len(_text)} characters in total]"
+
+    def metrics(self, dimensions: Dict[str, str], values: Dict[str, float], units: Dict[str, str]) -> None:
+        """Emits a CloudWatch Embedded Metric Format record, whatever the log level."""
+        self._emit({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': _name, 'Unit': units.get(_name, 'None')} for _name in values]
+                }]
+            },
+            **dimensions,
+            **values
+        })
+
+
+# Shared by the modules of a Lambda function
+logger = StructuredLogger()
@@ -0,0 +1,207 @@
+"""Columnar metrics shared by the explain_* functions of the customer insights Lambda.
+
+The numeric fields of a visualization's data points are read into one column
+per field, once, and every metric the explanations need is computed from the
+columns: totals, means, extremes, standard deviation, least squares trend
+slope, anomalies ranked by z-score, and planned versus actual variances.
+
+    >>> from utils.metrics_kernel import column_metrics, to_columns
+    >>> columns = to_columns(data['data_points'], ['income', 'expenses'])
+    >>> metrics = column_metrics(columns)
+    >>> metrics['income']['total'], metrics['income']['slope']
+
+Long series are computed with NumPy, in vectorized passes over each column
+read in place. Short ones, the common case of a monthly chart, are computed
+in plain Python, which is faster under a few hundred points and keeps NumPy out
+of the cold start of the Lambda. NumPy is imported on first use and, like in
+the data analytics Lambda, comes from a Lambda layer such as the AWS SDK for
+pandas managed layer: without it, every series is computed in plain Python.
+"""
+
+import math
+import os
+
+from operator import itemgetter
+from typing import Dict, List, Sequence
+
+# Series shorter than this are computed in plain Python
+VECTORIZE_MIN_POINTS = int(os.getenv('vectorize_min_points', 256))
+# Longest list of points, anomalies or categories an explanation spells out
+MAX_LISTED_POINTS = int(os.getenv('explain_max_listed', 24))
+# Points further than this ratio from the mean of their series are anomalies
+ANOMALY_DEVIATION = 0.3
+
+_numpy = None
+
+
+def numpy():
+    """Returns the numpy module, or None when it is not installed."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy as np
+            _numpy = np
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def vectorized(length: int) -> bool:
+    """Whether a series of this length is computed with NumPy."""
+    return length >= VECTORIZE_MIN_POINTS and numpy() is not None
+
+
+def to_columns(data_points: List[Dict], fields: List[str]) -> Dict[str, Sequence[float]]:
+    """Reads numeric fields of data points into one column per field.
+
+    Missing and null values read as 0. Columns are NumPy arrays for long series, lists otherwise.
+    Points read by utils.visualization_parser come with their columns already extracted.
+    """
+    if hasattr(data_points, 'columns'):
+        return data_points.columns(fields)
+    if not vectorized(len(data_points)):
+        return {_field: [float(_point.get(_field) or 0) for _point in data_points] for _field in fields}
+    np = numpy()
+    _columns = {}
+    for _field in fields:
+        try:
+            # Fast path, every point has the field
+            _columns[_field] = np.fromiter(map(itemgetter(_field), data_points), float, count=len(data_points))
+        except (KeyError, TypeError):
+            _columns[_field] = np.fromiter((_point.get(_field) or 0 for _point in data_points), float,
+                                           count=len(data_points))
+    return _columns
+
+
+def _furthest(values: List[float], indices: List[int], mean: float, max_listed: int) -> List[int]:
+    # The max_listed indices whose values are furthest from the mean, i.e. with the largest z-scores
+    return sorted(sorted(indices, key=lambda _i: -abs(values[_i] - mean))[:max_listed])
+
+
+def _series_metrics(values: List[float], deviation: float, max_listed: int) -> Dict:
+    _count = len(values)
+    _total = math.fsum(values)
+    _mean = _total / _count
+    _std = math.sqrt(math.fsum((_val - _mean) ** 2 for _val in values) / _count)
+    _center = (_count - 1) / 2
+    _spread = math.fsum((_i - _center) ** 2 for _i in range(_count))
+    _slope = math.fsum((_i - _center) * (_val - _mean) for _i, _val in enumerate(values)) / _spread \
+        if _spread else 0.0
+    _anomalies = [_i for _i, _val in enumerate(values) if abs(_val - _mean) > deviation * abs(_mean)]
+    return {
+        'count': _count, 'total': _total, 'mean': _mean, 'std': _std, 'slope': _slope,
+        'min': min(values), 'max': max(values),
+        'argmin': values.index(min(values)), 'argmax': values.index(max(values)),
+        'first': values[0], 'last': values[-1],
+        'anomaly_count': len(_anomalies),
+        'anomalies': _furthest(values, _anomalies, _mean, max_listed) if len(_anomalies) > max_listed
+        else _anomalies,
+        'values': values
+    }
+
+
+def column_metrics(
+        columns: Dict[str, Sequence[float]],
+        deviation: float = ANOMALY_DEVIATION,
+        max_listed: int = MAX_LISTED_POINTS
+) -> Dict[str, Dict]:
+    """Computes the metrics of every column of a series.
+
+    Args:
+        columns (Dict[str, Sequence[float]]): column name -> values, e.g. from to_columns. Columns of
+        different lengths are cut to the shortest one.
+        deviation (float, Optional): points further than deviation * |mean| from the mean are anomalies
+        max_listed (int, Optional): anomalies returned per column, the ones with the largest z-scores
+
+    Returns:
+        Dict[str, Dict]: column name -> count, total, mean, std, slope (change per point of the least
+        squares trend line), min, max, argmin, argmax, first, last, anomaly_count, anomalies (indices,
+        in series order) and values. Empty if the series has no point.
+    """
+    _count = min((len(_values) for _values in columns.values()), default=0)
+    if not _count:
+        return {}
+    if not vectorized(_count):
+        return {_name: _series_metrics([float(_val) for _val in _values[:_count]], deviation, max_listed)
+                for _name, _values in columns.items()}
+
+    # Each column is read in place, with one temporary array of its size
+    np = numpy()
+    _x = np.arange(_count) - (_count - 1) / 2
+    _spread = float(_x @ _x)
+    _metrics = {}
+    for _name, _values in columns.items():
+        _values = np.asarray(_values, dtype=float)[:_count]
+        _total = float(_values.sum())
+        _mean = _total / _count
+        _centered = _values - _mean
+        _slope = float(_centered @ _x) / _spread if _spread else 0.0
+        _std = math.sqrt(float(_centered @ _centered) / _count)
+        _indices = np.flatnonzero(np.abs(_centered, out=_centered) > deviation * abs(_mean))
+        del _centered
+        if len(_indices) > max_listed:
+            _top = np.argsort(-np.abs(_values[_indices] - _mean), kind='stable')[:max_listed]
+            _listed = np.sort(_indices[_top])
+        else:
+            _listed = _indices
+        _argmin, _argmax = int(_values.argmin()), int(_values.argmax())
+        _metrics[_name] = {
+            'count': _count, 'total': _total, 'mean': _mean, 'std': _std, 'slope': _slope,
+            'min': float(_values[_argmin]), 'max': float(_values[_argmax]),
+            'argmin': _argmin, 'argmax': _argmax,
+            'first': float(_values[0]), 'last': float(_values[-1]),
+            'anomaly_count': len(_indices),
+            'anomalies': _listed.tolist(),
+            'values': _values
+        }
+    return _metrics
+
+
+def variances(planned: Sequence[float], actual: Sequence[float], threshold: float = 10) -> Dict:
+    """Computes the variance of actual versus planned amounts, per category and in total.
+
+    Args:
+        planned (Sequence[float]): planned amount of each category
+        actual (Sequence[float]): actual amount of each category, cut to the length of planned or vice versa
+        threshold (float, Optional): variance percentage past which a category is significant
+
+    Returns:
+        Dict: total_planned, total_actual, variance and variance_pct (per category, the percentage is 0
+        where nothing was planned), significant (indices of the categories more than threshold percent
+        over or under their plan, by decreasing absolute variance percentage), over and under (the
+        significant ones over and under their plan, in the same order). Like the values of the series,
+        the index lists are NumPy arrays for long series.
+    """
+    _count = min(len(planned), len(actual))
+    if vectorized(_count):
+        np = numpy()
+        _planned = np.asarray(planned, dtype=float)[:_count]
+        _actual = np.asarray(actual, dtype=float)[:_count]
+        _variance = _actual - _planned
+        _pct = np.divide(_variance * 100, _planned, out=np.zeros(_count), where=_planned > 0)
+        _significant = np.flatnonzero(np.abs(_pct) > threshold)
+        _significant = _significant[np.argsort(-np.abs(_pct[_significant]), kind='stable')]
+        return {
+            'total_planned': float(_planned.sum()), 'total_actual': float(_actual.sum()),
+            'variance': _variance, 'variance_pct': _pct,
+            'significant': _significant,
+            'over': _significant[_pct[_significant] > 0],
+            'under': _significant[_pct[_significant] < 0]
+        }
+    _planned = [float(_val) for _val in planned[:_count]]
+    _actual = [float(_val) for _val in actual[:_count]]
+    _variance = [_act - _plan for _plan, _act in zip(_planned, _actual)]
+    _pct = [_var / _plan * 100 if _plan > 0 else 0 for _var, _plan in zip(_variance, _planned)]
+    _significant = sorted((_i for _i in range(_count) if abs(_pct[_i]) > threshold), key=lambda _i: -abs(_pct[_i]))
+    return {
+        'total_planned': math.fsum(_planned), 'total_actual': math.fsum(_actual),
+        'variance': _variance, 'variance_pct': _pct,
+        'significant': _significant,
+        'over': [_i for _i in _significant if _pct[_i] > 0],
+        'under': [_i for _i in _significant if _pct[_i] < 0]
+    }
+
+
+def listed(count: int, max_listed: int = MAX_LISTED_POINTS) -> str:
+    """Line closing a list cut to max_listed entries, empty if nothing was left out."""
+    return f"- ... and {count - max_listed:,} more\n" if count > max_listed else ""
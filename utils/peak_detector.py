@@ -0,0 +1,109 @@
+"""Streaming peak detection over the meter readings of the peak load Lambda devices.
+
+Each device keeps a fixed amount of state, whatever the number of readings it
+has seen, stored as attributes of its item in the peak table:
+
+- load_window: the last readings, a ring buffer of PEAK_WINDOW values written
+  at load_position
+- load_ewma: exponentially weighted moving average of the readings, with
+  smoothing factor PEAK_ALPHA
+- load_readings: readings seen, which also versions the state for conditional
+  writes
+
+A device is at a peak when its moving average goes past PEAK_THRESHOLD times
+its quota, and leaves it once the average falls back under PEAK_CLEAR times
+the threshold, so a load hovering around the threshold does not flip the flag
+at every reading:
+
+    >>> from utils.peak_detector import DeviceLoad
+    >>> load = DeviceLoad.from_item({'item_id': '4', 'quota': '100', 'used': '200'})
+    >>> for value in (180, 240, 210):
+    ...     load.add(value)
+    >>> load.is_peak(100, was_peak=False), load.ewma, load.window_max
+    (True, 201.6, 240.0)
+
+Configured with environment variables of the Lambda function (defaults):
+
+- peak_window (12): readings kept in the ring buffer of each device
+- peak_alpha (0.3): weight of the latest reading in the moving average
+- peak_threshold (1.0): ratio of the quota past which a device is at a peak
+- peak_clear (0.9): ratio of the threshold under which a peak ends
+"""
+
+import math
+import os
+
+from decimal import Decimal
+from typing import Dict, List
+
+PEAK_WINDOW = int(os.getenv('peak_window', 12))
+PEAK_ALPHA = float(os.getenv('peak_alpha', 0.3))
+PEAK_THRESHOLD = float(os.getenv('peak_threshold', 1.0))
+PEAK_CLEAR = float(os.getenv('peak_clear', 0.9))
+# Item attributes holding the state of a device
+LOAD_ATTRIBUTES = ('load_window', 'load_position', 'load_ewma', 'load_readings')
+
+
+def _decimal(value: float) -> Decimal:
+    # DynamoDB numbers, rounded so repeated averaging does not grow the stored digits
+    return Decimal(str(round(value, 6)))
+
+
+class DeviceLoad:
+    """Sliding window state of one device, see the module docstring."""
+
+    __slots__ = ('window', 'position', 'ewma', 'readings')
+
+    def __init__(self, window: List[float] = None, position: int = 0, ewma: float = None, readings: int = 0):
+        self.window = window if window is not None else []
+        self.position = position
+        self.ewma = ewma
+        self.readings = readings
+
+    @classmethod
+    def from_item(cls, item: Dict, window_size: int = PEAK_WINDOW) -> 'DeviceLoad':
+        """Reads the state of a device from its item, a fresh state if it has none."""
+        if 'load_readings' not in item:
+            return cls()
+        _window = [float(_value) for _value in item.get('load_window', [])][-window_size:]
+        return cls(_window, int(item.get('load_position', 0)) % window_size,
+                   float(item['load_ewma']) if item.get('load_ewma') is not None else None,
+                   int(item['load_readings']))
+
+    def add(self, value: float, window_size: int = PEAK_WINDOW, alpha: float = PEAK_ALPHA) -> None:
+        """Adds a reading: overwrites the oldest one of a full window and updates the moving average."""
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError(f"Invalid reading: {value}")
+        if len(self.window) < window_size:
+            self.window.append(value)
+        else:
+            self.window[self.position] = value
+        self.position = (self.position + 1) % window_size
+        self.ewma = value if self.ewma is None else alpha * value + (1 - alpha) * self.ewma
+        self.readings += 1
+
+    @property
+    def last(self) -> float:
+        return self.window[self.position - 1] if self.window else None
+
+    @property
+    def window_max(self) -> float:
+        return max(self.window) if self.window else None
+
+    def is_peak(self, quota: float, was_peak: bool, threshold: float = PEAK_THRESHOLD,
+                clear_ratio: float = PEAK_CLEAR) -> bool:
+        """Whether the device is at a peak, given its quota and whether it was at one before the last readings."""
+        if self.ewma is None:
+            return was_peak
+        _limit = threshold * float(quota)
+        return self.ewma > (_limit * clear_ratio if was_peak else _limit)
+
+    def attributes(self) -> Dict:
+        """Item attributes of the state, see LOAD_ATTRIBUTES."""
+        return {
+            'load_window': [_decimal(_value) for _value in self.window],
+            'load_position': self.position,
+            'load_ewma': _decimal(self.ewma) if self.ewma is not None else None,
+            'load_readings': self.readings
+        }
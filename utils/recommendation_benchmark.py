@@ -0,0 +1,94 @@
+"""Measures the product recommendations of the customer insights Lambda in profiles per second.
+
+Synthetic customer profiles are scored by the recommend_financial_products
+tool of 2-customer-insights/lambda_function.py, one call per profile, and by
+the decision table of utils.recommendation_engine: one profile at a time, and
+from profiles already read into columns (as from a Parquet file), computed in
+plain Python and with NumPy. Pass the source file of
+another version of the Lambda with --baseline to measure its tool as well, e.g.
+the version before the decision table. Run it from the root of the repository:
+
+    git show <commit>:2-customer-insights/lambda_function.py > /tmp/lambda_function_baseline.py
+    python utils/recommendation_benchmark.py --baseline /tmp/lambda_function_baseline.py
+    python utils/recommendation_benchmark.py --sizes 1000 100000 --runs 3
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import metrics_kernel
+from utils.recommendation_engine import decision_table
+
+_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+LAMBDA_SOURCE = os.path.join(_root, "2-customer-insights/lambda_function.py")
+
+PRODUCT_TYPES = ['Checking Account', 'Savings Account', 'Credit Card', 'Investment Account', 'Student Loan',
+                 'Mortgage', 'Retirement Account', '401k', 'Life Insurance', 'Auto Loan']
+
+
+def load_module(path, name="lambda_function"):
+    os.environ['LAMBDA_TASK_ROOT'] = os.path.dirname(LAMBDA_SOURCE)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def profiles(count, seed=0):
+    """Synthetic customer profiles, in the format of recommend_financial_products."""
+    rng = random.Random(seed)
+    return [{
+        'customer_id': str(i),
+        'age': rng.randint(18, 80),
+        'income': rng.choice([0, rng.randint(15000, 250000)]),
+        'credit_score': rng.randint(500, 850),
+        'risk_tolerance': rng.choice(['conservative', 'moderate', 'aggressive']),
+        'financial_goals': rng.sample(['education', 'home_ownership', 'retirement', 'travel'], rng.randint(0, 3)),
+        'existing_products': [{'type': _type} for _type in rng.sample(PRODUCT_TYPES, rng.randint(0, 5))],
+        'life_stage': rng.choice(['young adult', 'adult', 'family', 'retired'])
+    } for i in range(count)]
+
+
+def profiles_per_second(func, count, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return count / statistics.median(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="*", type=int, default=[1000, 10000, 100000], help="profiles per batch")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--baseline", default=None, help="lambda_function.py of another version to measure")
+    args = parser.parse_args()
+
+    modules = {"tool": load_module(LAMBDA_SOURCE)}
+    if args.baseline:
+        modules["baseline tool"] = load_module(args.baseline, "lambda_function_baseline")
+    table = decision_table()
+    vectorize_min_points = metrics_kernel.VECTORIZE_MIN_POINTS
+
+    print(f"{'method':<24} {'profiles':>9} {'profiles/s':>12}")
+    for size in args.sizes:
+        data = profiles(size)
+        for name, module in modules.items():
+            rate = profiles_per_second(lambda: [module.recommend_financial_products(_p) for _p in data], size, args.runs)
+            print(f"{name:<24} {size:>9,} {rate:>12,.0f}")
+        rate = profiles_per_second(lambda: table.recommend_batch(data), size, args.runs)
+        print(f"{'table, one by one':<24} {size:>9,} {rate:>12,.0f}")
+        columns = table.to_columns(data)
+        for name, threshold in (("table columns, python", float('inf')), ("table columns, numpy", vectorize_min_points)):
+            metrics_kernel.VECTORIZE_MIN_POINTS = threshold
+            rate = profiles_per_second(lambda: table.recommend_columns(columns), size, args.runs)
+            print(f"{name:<24} {size:>9,} {rate:>12,.0f}")
+        metrics_kernel.VECTORIZE_MIN_POINTS = vectorize_min_points
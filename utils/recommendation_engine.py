@@ -0,0 +1,353 @@
+"""Decision table engine behind the product recommendations of the customer insights Lambda.
+
+The recommendation rules are data, see PRODUCT_RULES. Each rule recommends a
+product type unless the customer already owns it, when its conditions on the
+customer profile hold, under the first of its variants (product name and
+rationale) whose own conditions hold:
+
+    >>> from utils.recommendation_engine import decision_table
+    >>> decision_table().recommend({'age': 42, 'income': 120000, 'existing_products': [{'type': 'Checking Account'}]})
+    [{'product_type': 'Savings Account', 'product_name': 'High-Yield Savings', 'priority': 'High', 'rationale': ...}, ...]
+
+The rules are compiled once per container into a DecisionTable. Every owned
+product a rule or variant checks gets a bit, and the table holds, for each set
+of owned products, the rules and variants left open, already in priority
+order. The conditions of each rule and variant are compiled into a single
+Python expression. A recommendation reads the owned products of the profile
+once, into a bit mask, and only evaluates the rules left for that mask.
+
+recommend_batch scores many profiles at once, e.g. for a campaign, and
+recommend_columns scores profiles already read into columns, e.g. from a
+Parquet file. Long batches of columns are computed with NumPy, like the
+metrics of utils.metrics_kernel: each condition is evaluated over a whole
+column. Without NumPy, or for short batches, profiles are scored one by one.
+
+Recommendations, and the lists of recommendations of recommend_columns, are
+shared between the results, which must not modify them.
+"""
+
+import operator
+
+from typing import Dict, List, Sequence, Tuple
+
+from utils.metrics_kernel import numpy, vectorized
+
+# Values of the profile fields the customer does not provide
+PROFILE_DEFAULTS = {
+    'age': 35,
+    'income': 75000,
+    'credit_score': 700,
+    'risk_tolerance': 'moderate',
+    'financial_goals': [],
+    'life_stage': 'adult'
+}
+PRIORITY_ORDER = {'High': 0, 'Medium': 1, 'Low': 2}
+
+# Conditions are (profile field, operator, value), see OPERATORS. A rule or variant applies when all
+# the conditions of its 'when' hold and, if it has a 'when_any', at least one of those. 'unless_owned'
+# names the existing product type, case insensitive, that rules it out.
+PRODUCT_RULES = [
+    {
+        'product_type': 'Checking Account', 'priority': 'High', 'unless_owned': 'checking account',
+        'variants': [
+            {'product_name': 'Everyday Checking',
+             'rationale': "A checking account is essential for day-to-day transactions and bill payments."}
+        ]
+    },
+    {
+        'product_type': 'Savings Account', 'priority': 'High', 'unless_owned': 'savings account',
+        'when': [('income', '>', 0)],
+        'variants': [
+            {'product_name': 'High-Yield Savings',
+             'rationale': "A high-yield savings account provides a safe place for emergency funds while earning interest."}
+        ]
+    },
+    {
+        'product_type': 'Credit Card', 'priority': 'Medium', 'unless_owned': 'credit card',
+        'when': [('credit_score', '>=', 650)],
+        'variants': [
+            {'when': [('credit_score', '>=', 750)], 'product_name': 'Premium Rewards Card',
+             'rationale': "With an excellent credit score, you qualify for our premium rewards card with enhanced benefits."},
+            {'when': [('credit_score', '>=', 700)], 'product_name': 'Cash Back Card',
+             'rationale': "Your good credit score qualifies you for a competitive cash back credit card."},
+            {'product_name': 'Secured Credit Card',
+             'rationale': "This card can help you continue building your credit history with responsible use."}
+        ]
+    },
+    {
+        'product_type': 'Investment Account', 'priority': 'Medium', 'unless_owned': 'investment account',
+        'variants': [
+            {'when': [('risk_tolerance', '==', 'aggressive'), ('age', '<', 50)], 'product_name': 'Growth Stock Portfolio',
+             'rationale': "Based on your aggressive risk tolerance and age, a growth-focused investment strategy may align with your long-term goals."},
+            {'when_any': [('risk_tolerance', '==', 'conservative'), ('age', '>=', 60)],
+             'product_name': 'Income & Dividend Portfolio',
+             'rationale': "A more conservative investment approach focused on income generation and capital preservation."},
+            {'product_name': 'Balanced Fund Portfolio',
+             'rationale': "A balanced investment approach provides a mix of growth potential and risk management."}
+        ]
+    },
+    {
+        'product_type': 'Student Loan', 'priority': 'Medium', 'unless_owned': 'student loan',
+        'when': [('life_stage', '==', 'young adult'), ('financial_goals', 'contains', 'education')],
+        'variants': [
+            {'product_name': 'Education Financing',
+             'rationale': "Education financing options to help achieve your educational goals with competitive rates."}
+        ]
+    },
+    {
+        'product_type': 'Mortgage', 'priority': 'Medium', 'unless_owned': 'mortgage',
+        'when': [('life_stage', 'in', ('adult', 'family')), ('financial_goals', 'contains', 'home_ownership'),
+                 ('income', '>=', 50000), ('credit_score', '>=', 680)],
+        'variants': [
+            {'product_name': 'Home Buyer Mortgage',
+             'rationale': "Financing options for home purchase with competitive rates based on your solid financial profile."}
+        ]
+    },
+    {
+        'product_type': 'Retirement Account', 'priority': 'High', 'unless_owned': 'retirement account',
+        'when': [('age', '<', 65)],
+        'variants': [
+            {'when': [('income', '>', 100000)], 'unless_owned': '401k', 'product_name': 'Solo 401(k)',
+             'rationale': "A tax-advantaged retirement account with higher contribution limits for high-income individuals."},
+            {'product_name': 'IRA Account',
+             'rationale': "A tax-advantaged retirement account to help secure your financial future."}
+        ]
+    },
+    {
+        'product_type': 'Life Insurance', 'priority': 'Medium', 'unless_owned': 'life insurance',
+        'when': [('life_stage', 'in', ('family', 'adult')), ('income', '>', 40000)],
+        'variants': [
+            {'product_name': 'Term Life Protection',
+             'rationale': "Life insurance provides financial protection for your loved ones and peace of mind for you."}
+        ]
+    }
+]
+
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+    'in': lambda _val, _values: _val in _values,
+    'contains': lambda _values, _val: _val in _values
+}
+# Python expression of each operator, f being the profile field and c the value
+_EXPRESSIONS = {
+    '<': '{f} < {c}',
+    '<=': '{f} <= {c}',
+    '>': '{f} > {c}',
+    '>=': '{f} >= {c}',
+    '==': '{f} == {c}',
+    '!=': '{f} != {c}',
+    'in': '{f} in {c}',
+    'contains': '{c} in {f}'
+}
+# Operators NumPy evaluates over a whole numeric column
+_NUMERIC_OPERATORS = {'<', '<=', '>', '>=', '==', '!='}
+
+_table = None
+
+
+def compile_predicate(when: List[Tuple], when_any: List[Tuple] = None):
+    """Compiles conditions into one function of a profile, None when there is no condition.
+
+    The function is a single Python expression, e.g. lambda p: p.get('income', _d0) > _c0, with the
+    values of the conditions and the defaults of the fields bound as constants.
+    """
+    if not when and not when_any:
+        return None
+    _namespace = {}
+
+    def _term(condition):
+        _field, _op, _val = condition
+        _index = len(_namespace) // 2
+        _namespace[f"_c{_index}"] = _val
+        _namespace[f"_d{_index}"] = PROFILE_DEFAULTS.get(_field)
+        return _EXPRESSIONS[_op].format(f=f"p.get({_field!r}, _d{_index})", c=f"_c{_index}")
+
+    _terms = [_term(_condition) for _condition in when]
+    if when_any:
+        _terms.append('(' + ' or '.join(_term(_condition) for _condition in when_any) + ')')
+    return eval(f"lambda p: {' and '.join(_terms)}", _namespace)
+
+
+class DecisionTable:
+    """Product rules compiled for evaluation, see the module docstring."""
+
+    def __init__(self, rules: List[Dict] = None):
+        """Compiles rules, PRODUCT_RULES by default.
+
+        Raises:
+            KeyError: when a condition uses an unknown operator
+        """
+        rules = PRODUCT_RULES if rules is None else rules
+        _owned = [_owner.lower() for _rule in rules for _owner in
+                  [_rule.get('unless_owned')] + [_variant.get('unless_owned') for _variant in _rule['variants']]
+                  if _owner]
+        self._bits = {_type: 1 << _i for _i, _type in enumerate(dict.fromkeys(_owned))}
+        self._conditions = {}
+
+        # Rules in priority order, the order of the recommendations, then in their own order
+        self._rules = []
+        for _rule in sorted(rules, key=lambda _rule: PRIORITY_ORDER.get(_rule.get('priority', 'Low'), 3)):
+            _variants = [(self._register(_variant), self._owned_bits(_variant), {
+                'product_type': _rule['product_type'],
+                'product_name': _variant['product_name'],
+                'priority': _rule.get('priority', 'Low'),
+                'rationale': _variant.get('rationale', '')
+            }) for _variant in _rule['variants']]
+            self._rules.append((self._register(_rule), self._owned_bits(_rule), _variants))
+
+        # One entry per set of owned products: the rules left, as (predicate, variants left), the
+        # variants as (predicate, recommendation)
+        _predicates = {}
+        for _conditions, _blocked, _variants in self._rules:
+            for _when in [_conditions] + [_variant[0] for _variant in _variants]:
+                if _when not in _predicates:
+                    _predicates[_when] = compile_predicate(*_when)
+        self._table = []
+        for _mask in range(1 << len(self._bits)):
+            _entry = []
+            for _conditions, _blocked, _variants in self._rules:
+                _open = tuple((_predicates[_variant[0]], _variant[2]) for _variant in _variants
+                              if not _variant[1] & _mask)
+                if _open and not _blocked & _mask:
+                    _entry.append((_predicates[_conditions], _open))
+            self._table.append(tuple(_entry))
+
+    def _register(self, rule: Dict) -> Tuple:
+        # (when, when_any) of a rule or variant, as tuples of conditions, each registered for recommend_batch
+        _when = tuple(tuple(_condition) for _condition in rule.get('when', []))
+        _when_any = tuple(tuple(_condition) for _condition in rule.get('when_any', []))
+        for _condition in _when + _when_any:
+            self._conditions[_condition] = None
+        return _when, _when_any
+
+    def _owned_bits(self, rule: Dict) -> int:
+        return self._bits[rule['unless_owned'].lower()] if rule.get('unless_owned') else 0
+
+    @property
+    def entries(self) -> int:
+        return len(self._table)
+
+    def owned_mask(self, existing_products: List) -> int:
+        """Bit mask of the products a rule checks among existing products, dicts with a type or names."""
+        _mask = 0
+        for _product in existing_products:
+            _type = _product.get('type', '') if isinstance(_product, dict) else str(_product)
+            _mask |= self._bits.get(_type.lower(), 0)
+        return _mask
+
+    def recommend(self, profile: Dict) -> List[Dict]:
+        """Returns the recommendations for a customer profile, in priority order.
+
+        Each recommendation is a dict with product_type, product_name, priority and rationale.
+        Missing profile fields take their PROFILE_DEFAULTS value.
+        """
+        return self._recommend_masked(profile, self.owned_mask(profile.get('existing_products', [])))
+
+    def _recommend_masked(self, profile: Dict, mask: int) -> List[Dict]:
+        _recommendations = []
+        for _predicate, _variants in self._table[mask]:
+            if _predicate is None or _predicate(profile):
+                for _variant_predicate, _recommendation in _variants:
+                    if _variant_predicate is None or _variant_predicate(profile):
+                        _recommendations.append(_recommendation)
+                        break
+        return _recommendations
+
+    def recommend_batch(self, profiles: List[Dict]) -> List[List[Dict]]:
+        """Returns the recommendations of each profile, like recommend."""
+        return [self.recommend(_profile) for _profile in profiles]
+
+    def to_columns(self, profiles: List[Dict]) -> Dict[str, List]:
+        """Reads the fields the rules check into one column per field, plus the owned_mask column."""
+        _columns = {_field: [_profile.get(_field, PROFILE_DEFAULTS.get(_field)) for _profile in profiles]
+                    for _field in dict.fromkeys(_field for _field, _op, _val in self._conditions)}
+        _columns['owned_mask'] = [self.owned_mask(_profile.get('existing_products', [])) for _profile in profiles]
+        return _columns
+
+    def _condition_columns(self, columns: Dict[str, Sequence], count: int) -> Dict[Tuple, object]:
+        # Boolean column of every condition
+        np = numpy()
+        _columns = {}
+        for _field, _op, _val in self._conditions:
+            _values = columns.get(_field)
+            if _values is None:
+                _values = [PROFILE_DEFAULTS.get(_field)] * count
+            if _op in _NUMERIC_OPERATORS and isinstance(_val, (int, float)):
+                _array = np.asarray(_values[:count])
+                # Like recommend, strings or nulls in a numeric field are an error rather than converted
+                if _array.dtype.kind not in 'biuf':
+                    raise TypeError(f"{_field} has non-numeric values")
+                _column = OPERATORS[_op](_array, _val)
+            elif _op == 'contains':
+                _column = np.fromiter([_val in _value for _value in _values[:count]], bool, count=count)
+            elif _op == 'in':
+                _column = np.isin(np.asarray(_values[:count], dtype=object), list(_val))
+            else:
+                _column = np.fromiter(map(OPERATORS[_op], _values[:count], [_val] * count), bool, count=count)
+            _columns[(_field, _op, _val)] = _column
+        return _columns
+
+    def recommend_columns(self, columns: Dict[str, Sequence]) -> List[List[Dict]]:
+        """Returns the recommendations of profiles read into columns, computed column by column for long batches.
+
+        Args:
+            columns (Dict[str, Sequence]): profile field -> value of each profile, lists or NumPy arrays, and
+            owned_mask -> owned_mask of the existing products of each profile, e.g. from to_columns or from the
+            columns of a Parquet file. Missing fields take their PROFILE_DEFAULTS value.
+
+        Raises:
+            TypeError, ValueError: when a column has values of the wrong type
+        """
+        _count = len(columns['owned_mask'])
+        if not vectorized(_count):
+            _fields = [_field for _field in columns if _field != 'owned_mask']
+            return [self._recommend_masked(dict(zip(_fields, _row)), _mask) for _mask, *_row in
+                    zip(columns['owned_mask'], *(columns[_field] for _field in _fields))]
+
+        np = numpy()
+        _masks = np.asarray(columns['owned_mask'], dtype=np.int64)[:_count]
+        _columns = self._condition_columns(columns, _count)
+
+        def _holding(when: Tuple, when_any: Tuple, blocked: int):
+            _result = _masks & blocked == 0
+            for _condition in when:
+                _result &= _columns[_condition]
+            if when_any:
+                _result &= np.logical_or.reduce([_columns[_condition] for _condition in when_any])
+            return _result
+
+        # Each profile gets a code, the variant chosen by each rule in base _base digits (0 for none), and the
+        # recommendations of each distinct code are gathered once
+        _base = max(len(_variants) for _rule, _blocked, _variants in self._rules) + 1
+        _codes = np.zeros(_count, np.int64)
+        _digits = []
+        for (_when, _when_any), _blocked, _variants in self._rules:
+            _left = _holding(_when, _when_any, _blocked)
+            _codes *= _base
+            for _digit, ((_variant_when, _variant_when_any), _variant_blocked, _recommendation) in enumerate(_variants, 1):
+                _chosen = _left & _holding(_variant_when, _variant_when_any, _variant_blocked)
+                _left &= ~_chosen
+                _codes[_chosen] += _digit
+            _digits.append([None] + [_variant[2] for _variant in _variants])
+        _unique, _inverse = np.unique(_codes, return_inverse=True)
+        _patterns = []
+        for _code in _unique.tolist():
+            _pattern = []
+            for _options in reversed(_digits):
+                _code, _digit = divmod(_code, _base)
+                if _digit:
+                    _pattern.append(_options[_digit])
+            _patterns.append(_pattern[::-1])
+        return [_patterns[_i] for _i in _inverse.tolist()]
+
+def decision_table() -> DecisionTable:
+    """Returns the DecisionTable of PRODUCT_RULES, compiled on first use."""
+    global _table
+    if _table is None:
+        _table = DecisionTable()
+    return _table
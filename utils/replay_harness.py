@@ -0,0 +1,265 @@
+"""Replays action group events against the Lambda handlers, offline and concurrently.
+
+The handlers run in this process against utils.local_dynamodb tables seeded
+from the lab sample data, so no AWS account is needed. Events are either
+recorded ones, one per line as JSON or as the event records the handlers log
+to CloudWatch (see utils.log_helper, customer fields are hashed in those), or a synthetic mix of every function of the
+handlers. Each event is routed to the handler registering its function, the
+events are fired from a thread pool, and the latency of each invocation is
+reported per function (p50/p95/p99) with the overall throughput. Run it from
+the root of the repository:
+
+    python utils/replay_harness.py --invocations 5000 --concurrency 16 --latency-ms 5
+    python utils/replay_harness.py --events recorded_events.jsonl --concurrency 32
+
+All threads share one instance of each handler module, like concurrent
+requests to a single warm container. Use --cold-cache to turn off the query
+and explanation caches of the handlers.
+"""
+
+import argparse
+import ast
+import contextlib
+import importlib.util
+import json
+import math
+import os
+import random
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import client_helper
+from utils.local_dynamodb import LocalDynamoDB
+
+_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Handler module -> table it uses, as created by the lab notebooks
+HANDLERS = {
+    "financial_analytics": {
+        'source': "1-data-analytics/financial_analytics.py",
+        'table': "analytics-table", 'pk': "customer_id", 'sk': "day",
+        'indexes': [{"name": "customer-type-day-index", "partition_key": "customer_id", "sort_key": ["type", "day"]}],
+        'sample_data': "1-data-analytics/1_user_sample_data.json"
+    },
+    "peak_load": {
+        'source': "3-peak-load-manager/peak_load.py",
+        'table': "peak-table", 'pk': "customer_id", 'sk': "item_id",
+        'indexes': [{"name": "customer-peak-index", "partition_key": "customer_id", "sort_key": "peak"},
+                    {"name": "customer-essential-index", "partition_key": "customer_id", "sort_key": "essential"}],
+        'sample_data': "3-peak-load-manager/3_peak_sample_data.json"
+    },
+    "solar_energy": {
+        'source': "2-solar-panel/solar_energy.py",
+        'table': "solar-table", 'pk': "customer_id", 'sk': "ticket_id",
+        'indexes': [{"name": "customer-status-index", "partition_key": "customer_id",
+                     "sort_key": ["status", "ticket_id"]}]
+    },
+    "customer_insights": {
+        'source': "2-customer-insights/customer_insights.py",
+        'table': "insights-table", 'pk': "customer_id", 'sk': "ticket_id"
+    },
+}
+
+
+def load_handlers(dynamodb, names):
+    """Creates and seeds the table of each handler, then imports the handler modules."""
+    client_helper.set_resource('dynamodb', dynamodb)
+    modules = {}
+    for name in names:
+        config = HANDLERS[name]
+        dynamodb.create_table(config['table'], config['pk'], config['sk'], config.get('indexes'))
+        # The handlers read their configuration at import time
+        os.environ.update({
+            'dynamodb_table': config['table'],
+            'dynamodb_pk': config['pk'],
+            'dynamodb_sk': config['sk'],
+            'dynamodb_indexes': ','.join(index['name'] for index in config.get('indexes', [])),
+            'LAMBDA_TASK_ROOT': os.path.dirname(os.path.join(_root, config['source']))
+        })
+        spec = importlib.util.spec_from_file_location(name, os.path.join(_root, config['source']))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        modules[name] = module
+
+        if config.get('sample_data'):
+            on_write = None
+            if hasattr(module, 'update_monthly_aggregates'):
+                on_write = lambda new_item, old_item, config=config, module=module: module.update_monthly_aggregates(
+                    config['table'], config['pk'], config['sk'], new_item, old_item)
+            dynamodb.load_json(config['table'], os.path.join(_root, config['sample_data']), on_write)
+        if hasattr(module, 'forecast_peak'):
+            # Forecasts of the sample devices from the current hour, as written by the forecast batch job
+            from utils import load_forecast_batch
+            table = dynamodb.Table(config['table'])
+            devices = load_forecast_batch.read_devices(table, config['pk'], config['sk'])
+            items, _ = load_forecast_batch.forecast_items(
+                devices, load_forecast_batch.synthetic_histories(devices, 14 * 24),
+                int(time.time() // load_forecast_batch.HOUR), config['pk'], config['sk'])
+            load_forecast_batch.write_items(table, items)
+    return modules
+
+
+def _event(function, **parameters):
+    return {'messageVersion': '1.0', 'actionGroup': 'replay', 'function': function,
+            'parameters': [{'name': name, 'type': 'string', 'value': str(value)} for name, value in parameters.items()]}
+
+
+def synthetic_events(names):
+    """One event per function of the handlers and customer of the sample data."""
+    next_month = datetime.today().replace(day=28)
+    next_month = (next_month.month % 12 + 1, next_month.year + next_month.month // 12)
+    cash_flow = json.dumps({'months': ['Jan', 'Feb', 'Mar'], 'income': [5000, 5200, 5100],
+                            'expenses': [4200, 4800, 3900], 'time_period': '3_months'})
+    dashboard = json.dumps([{**json.loads(cash_flow), 'visualization_id': 'cash_flow_1', 'visualization_type': 'cash_flow'},
+                            {'visualization_id': 'budget_1', 'visualization_type': 'budget_performance',
+                             'data_points': [{'category': 'Food', 'planned': 500, 'actual': 650},
+                                             {'category': 'Rent', 'planned': 1500, 'actual': 1500}]}])
+    events = []
+    for customer_id in ('1', '2', '3', '4', '5'):
+        if 'financial_analytics' in names:
+            events += [
+                _event('get_projected_transactions', customer_id=customer_id),
+                _event('get_historical_transactions', customer_id=customer_id),
+                _event('get_transaction_statistics', customer_id=customer_id),
+                _event('update_projections', customer_id=customer_id, month=next_month[0], year=next_month[1],
+                       amount='1500.25'),
+                _event('get_transaction_statistics_batch', customer_ids='1,2,3,4,5'),
+                _event('get_projected_cash_flow_batch', customer_ids='1,2,3,4,5'),
+            ]
+        if 'peak_load' in names:
+            events += [
+                _event('detect_peak', customer_id=customer_id),
+                _event('detect_non_essential_processes', customer_id=customer_id),
+                _event('redistribute_allocation', customer_id=customer_id, item_id='1', quota='30'),
+                _event('ingest_readings', customer_id=customer_id,
+                       readings=json.dumps([{'item_id': '1', 'value': 12}, {'item_id': '2', 'value': 28},
+                                            {'item_id': '3', 'value': 41}])),
+                _event('rebalance_quotas', customer_id=customer_id, target_kw='150'),
+                _event('scan_fleet', max_households=5),
+                _event('forecast_peak', customer_id=customer_id),
+            ]
+        if 'solar_energy' in names:
+            events += [
+                _event('open_ticket', customer_id=customer_id, msg='The inverter shows an error light'),
+                _event('get_ticket_status', customer_id=customer_id),
+                _event('get_ticket_status', customer_id=customer_id, status='open', limit=5),
+                _event('open_tickets', tickets=json.dumps([{'customer_id': customer_id, 'msg': 'No production today'},
+                                                           {'customer_id': customer_id, 'msg': 'Meter offline'}])),
+                _event('update_ticket_status', status='closed', assignee='field-team',
+                       tickets=json.dumps([{'customer_id': customer_id, 'ticket_id': 'unknown'}])),
+                _event('lookup_faq', question='How do I clean the Sunpower X panel?'),
+            ]
+        if 'customer_insights' in names:
+            events += [
+                _event('explain_cash_flow', customer_id=customer_id, data=cash_flow),
+                _event('explain_visualization', customer_id=customer_id, data=cash_flow,
+                       visualization_type='cash_flow'),
+                _event('explain_dashboard', customer_id=customer_id, visualizations=dashboard),
+                _event('create_support_ticket', customer_id=customer_id, description='Explain my cash flow chart'),
+                _event('get_support_tickets', customer_id=customer_id),
+            ]
+    return events
+
+
+def read_events(path):
+    """Reads recorded events, one per line as JSON, as a printed Python dict or as a logged event record."""
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                event = ast.literal_eval(line)
+            if isinstance(event, dict) and event.get('message') == 'event' and isinstance(event.get('payload'), dict):
+                event = event['payload']
+            if isinstance(event, dict) and event.get('function'):
+                events.append(event)
+    return events
+
+
+def percentile(sorted_values, p):
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def replay(modules, events, invocations, concurrency, seed=0):
+    """Fires invocations events picked from events at the handlers.
+
+    Returns:
+        Tuple[Dict, float]: function -> list of (latency in seconds, error flag), and the wall time
+    """
+    routes = {}
+    for module in modules.values():
+        for function in module.action_group.functions:
+            routes.setdefault(function, module.lambda_handler)
+    unknown = {event['function'] for event in events} - set(routes)
+    if unknown:
+        print(f"Skipping events of functions no handler registers: {', '.join(sorted(unknown))}")
+    events = [event for event in events if event['function'] in routes]
+
+    rng = random.Random(seed)
+    schedule = [events[i % len(events)] for i in range(invocations)]
+    rng.shuffle(schedule)
+
+    def invoke(event):
+        start = time.perf_counter()
+        try:
+            response = routes[event['function']](event, None)
+            error = response['response']['functionResponse']['responseBody']['TEXT']['body'].startswith('Error')
+        except Exception:
+            error = True
+        return event['function'], time.perf_counter() - start, error
+
+    results = {}
+    # The handlers log their invocations and metrics, keep them out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for function, latency, error in executor.map(invoke, schedule):
+                results.setdefault(function, []).append((latency, error))
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def report(results, elapsed):
+    print(f"{'function':<36} {'calls':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    everything = []
+    for function, samples in sorted(results.items()):
+        latencies = sorted(latency for latency, _ in samples)
+        everything += latencies
+        print(f"{function:<36} {len(samples):>6} {sum(error for _, error in samples):>6} "
+              f"{percentile(latencies, 50) * 1e3:>8.2f} {percentile(latencies, 95) * 1e3:>8.2f} "
+              f"{percentile(latencies, 99) * 1e3:>8.2f}")
+    everything.sort()
+    errors = sum(error for samples in results.values() for _, error in samples)
+    print(f"{'all':<36} {len(everything):>6} {errors:>6} {percentile(everything, 50) * 1e3:>8.2f} "
+          f"{percentile(everything, 95) * 1e3:>8.2f} {percentile(everything, 99) * 1e3:>8.2f}")
+    print(f"Throughput: {len(everything) / elapsed:,.0f} invocations/s over {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", help="recorded events, one per line. Defaults to a synthetic mix")
+    parser.add_argument("--handlers", nargs="*", default=list(HANDLERS), choices=list(HANDLERS))
+    parser.add_argument("--invocations", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated DynamoDB request latency")
+    parser.add_argument("--page-items", type=int, default=None, help="items per query/scan page")
+    parser.add_argument("--cold-cache", action="store_true", help="turn off the query and explanation caches of the handlers")
+    args = parser.parse_args()
+
+    if args.cold_cache:
+        os.environ['query_cache_ttl'] = '0'
+        os.environ['explanation_cache_size'] = '0'
+    dynamodb = LocalDynamoDB(latency_ms=args.latency_ms, page_items=args.page_items)
+    modules = load_handlers(dynamodb, args.handlers)
+    events = read_events(args.events) if args.events else synthetic_events(args.handlers)
+    results, elapsed = replay(modules, events, args.invocations, args.concurrency)
+    report(results, elapsed)
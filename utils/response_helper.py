@@ -0,0 +1,218 @@
+"""Compact serialization of action group responses shared by the Lambda functions.
+
+The response body of a function is read by the agent's model on every
+orchestration step, so it is kept as small as possible: DynamoDB Decimals
+become plain JSON numbers, lists of items are written in columnar form (keys
+once, one array per row) and the whole body is held to a character budget.
+Past the budget, lists are cut short and described by a summary (item count,
+sum/min/max of the numeric fields, value counts of the categorical ones) and
+the body says it was truncated:
+
+    >>> from utils.response_helper import compact_response
+    >>> compact_response([{'day': '2025/03/01', 'transactionAmount': Decimal('1460.75')},
+    ...                   {'day': '2025/04/01', 'transactionAmount': Decimal('-320')}])
+    '{"columns":["day","transactionAmount"],"rows":[["2025/03/01",1460.75],["2025/04/01",-320]]}'
+"""
+
+import json
+import os
+
+from decimal import Decimal
+from typing import Dict, List, Tuple
+
+# Default character budget of a response body, overridable per Lambda function
+DEFAULT_MAX_CHARS = int(os.getenv('response_max_chars', 6000))
+# Categorical fields with more distinct values than this are not counted in summaries
+MAX_SUMMARY_VALUES = 10
+# Texts are not shortened below this many characters by fit_texts, the last ones are dropped instead
+MIN_TEXT_CHARS = int(os.getenv('response_min_text_chars', 300))
+# Appended to a text shortened by fit_texts
+SHORTENED_MARKER = ' [...]'
+
+
+def to_native(value):
+    """Converts DynamoDB values (Decimal, set) to plain JSON serializable types, recursively."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {_key: to_native(_val) for _key, _val in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [to_native(_val) for _val in value]
+    return value
+
+
+def _is_table(value) -> bool:
+    return isinstance(value, list) and len(value) > 1 and all(isinstance(_row, dict) for _row in value)
+
+
+def _columns(rows: List[Dict]) -> List[str]:
+    # Union of the keys, in order of first appearance
+    return list(dict.fromkeys(_key for _row in rows for _key in _row))
+
+
+def summarize(rows: List) -> Dict:
+    """Describes a list in a few numbers.
+
+    Args:
+        rows (List): items (dicts) or scalar values
+
+    Returns:
+        Dict: count, and for each field the sum/min/max of its numeric values or
+        the counts of its values when there are at most MAX_SUMMARY_VALUES of them
+    """
+    _summary = {'count': len(rows)}
+    if rows and all(isinstance(_row, dict) for _row in rows):
+        _fields = {_col: [_row.get(_col) for _row in rows] for _col in _columns(rows)}
+    else:
+        _fields = {'values': rows}
+
+    for _field, _values in _fields.items():
+        _numbers = [_val for _val in _values if isinstance(_val, (int, float)) and not isinstance(_val, bool)]
+        if _numbers:
+            _summary[_field] = {'sum': round(sum(_numbers), 2), 'min': min(_numbers), 'max': max(_numbers)}
+            continue
+        _counts = {}
+        for _val in _values:
+            if isinstance(_val, (str, bool)):
+                _counts[_val] = _counts.get(_val, 0) + 1
+        if _counts and len(_counts) <= MAX_SUMMARY_VALUES:
+            _summary[_field] = _counts
+    return _summary
+
+
+def shape(value, columnar: bool = True, max_rows: int = None):
+    """Rewrites lists of items in columnar form and cuts lists longer than max_rows.
+
+    A list cut short is replaced by a dict holding its summary, the number of
+    items kept ('shown') and the items kept.
+
+    Args:
+        value: JSON serializable value, see to_native
+        columnar (bool, Optional): write lists of items as columns + rows. Defaults to True.
+        max_rows (int, Optional): maximum number of items kept per list. Defaults to None (no limit).
+    """
+    if isinstance(value, dict):
+        return {_key: shape(_val, columnar, max_rows) for _key, _val in value.items()}
+    if not isinstance(value, list):
+        return value
+
+    _truncated = max_rows is not None and len(value) > max_rows
+    _kept = [shape(_val, columnar, max_rows) for _val in (value[:max_rows] if _truncated else value)]
+    if columnar and _is_table(value):
+        _cols = _columns(value)
+        _body = {'columns': _cols, 'rows': [[_row.get(_col) for _col in _cols] for _row in _kept]}
+    else:
+        _body = {'items': _kept} if _truncated else _kept
+    if not _truncated:
+        return _body
+    return {'truncated': True, 'shown': len(_kept), 'summary': summarize(value), **_body}
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str)
+
+
+def _longest_list(value) -> int:
+    if isinstance(value, dict):
+        return max((_longest_list(_val) for _val in value.values()), default=0)
+    if isinstance(value, list):
+        return max([len(value)] + [_longest_list(_val) for _val in value])
+    return 0
+
+
+def _fair_shares(lengths: List[int], budget: int) -> List[int]:
+    # Largest equal cap on the lengths whose total fits the budget: texts shorter than the cap are kept whole
+    _shares, _left = list(lengths), budget
+    _order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    for _rank, _i in enumerate(_order):
+        _cap = _left // (len(lengths) - _rank)
+        if lengths[_i] > _cap:
+            for _j in _order[_rank:]:
+                _shares[_j] = _cap
+            break
+        _left -= lengths[_i]
+    return _shares
+
+
+def _shorten(text: str, max_chars: int) -> str:
+    # Cut on a word boundary, so that the JSON string of the text takes at most max_chars
+    if len(_dumps(text)) - 2 <= max_chars:
+        return text
+    _keep = max(max_chars - len(SHORTENED_MARKER), 0)
+    _cut = text[:_keep]
+    while _cut and len(_dumps(_cut)) - 2 > _keep:
+        _cut = _cut[:-max(1, (len(_dumps(_cut)) - 2 - _keep) // 2)]
+    if ' ' in _cut[len(_cut) // 2:]:
+        _cut = _cut[:_cut.rindex(' ')]
+    return _cut.rstrip() + SHORTENED_MARKER
+
+
+def fit_texts(texts: Dict[str, str], max_chars: int = None) -> Tuple[Dict[str, str], List[str]]:
+    """Fits a dict of long texts (e.g. explanations by visualization_id) into a character budget of JSON.
+
+    compact_response can cut lists short, but not the values of a dict: a dict of texts past the budget
+    would be cut in the middle of its JSON. Every text instead gets an equal share of the budget, texts
+    shorter than their share giving the rest to the others, and longer ones are shortened on a word
+    boundary, ending with SHORTENED_MARKER. When a share would fall under MIN_TEXT_CHARS, the last texts
+    are dropped rather than shortened further.
+
+    Args:
+        texts (Dict[str, str]): texts by key, in order
+        max_chars (int, Optional): budget of the JSON of the dict. Defaults to DEFAULT_MAX_CHARS.
+
+    Returns:
+        Tuple[Dict[str, str], List[str]]: the texts kept, some shortened, and the keys of the texts dropped
+    """
+    max_chars = max_chars or DEFAULT_MAX_CHARS
+    _keys = list(texts)
+    for _count in range(len(_keys), 0, -1):
+        _kept = _keys[:_count]
+        _lengths = [len(_dumps(texts[_key])) - 2 for _key in _kept]
+        _budget = max_chars - len(_dumps({_key: '' for _key in _kept}))
+        _shares = _fair_shares(_lengths, _budget) if _budget > 0 else [0] * _count
+        if any(_share < min(_length, MIN_TEXT_CHARS) for _share, _length in zip(_shares, _lengths)) and _count > 1:
+            continue
+        _fitted = {_key: _shorten(texts[_key], _share) for _key, _share in zip(_kept, _shares)}
+        if len(_dumps(_fitted)) <= max_chars or _count == 1:
+            return _fitted, _keys[_count:]
+    return {}, _keys
+
+
+def compact_response(response_body, max_chars: int = None, columnar: bool = True) -> str:
+    """Serializes a function result into a compact response body.
+
+    Strings are returned as they are. Anything else is written as compact JSON,
+    see shape. When the JSON is longer than max_chars, every list is cut to the
+    largest number of items that fits, and summarized. A body that still does not
+    fit is cut at max_chars with a note giving its full length.
+
+    Args:
+        response_body: function result
+        max_chars (int, Optional): character budget. Defaults to DEFAULT_MAX_CHARS.
+        columnar (bool, Optional): write lists of items as columns + rows. Defaults to True.
+
+    Returns:
+        str: response body
+    """
+    max_chars = max_chars or DEFAULT_MAX_CHARS
+    if isinstance(response_body, str):
+        _text = response_body
+    else:
+        _value = to_native(response_body)
+        _text = _dumps(shape(_value, columnar))
+        if len(_text) > max_chars:
+            # Binary search the largest number of items per list that fits the budget
+            _low, _high = 0, _longest_list(_value)
+            _fitted = _dumps(shape(_value, columnar, 0))
+            while _low < _high:
+                _mid = (_low + _high + 1) // 2
+                _candidate = _dumps(shape(_value, columnar, _mid))
+                if len(_candidate) <= max_chars:
+                    _low, _fitted = _mid, _candidate
+                else:
+                    _high = _mid - 1
+            _text = _fitted
+
+    if len(_text) <= max_chars:
+        return _text
+    return f"{_text[:max_chars]}... [truncated, {len(_text)} characters in total]"
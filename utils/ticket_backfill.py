@@ -0,0 +1,82 @@
+"""Adds the tickets opened before ULID ticket IDs to the status index of the solar energy Lambda.
+
+Tickets opened before the IDs were ULIDs (utils.id_helper) have UUID1 IDs
+and no status_ticket_id attribute, so the customer-status-index of the tickets
+table leaves them out and get_ticket_status lists none of them by status.
+This scans the tickets table and sets the status_ticket_id of every ticket
+whose value is missing or stale to status#<creation_key of its ID>, which
+sorts the UUID1 tickets among the ULID ones by creation time. Each write
+checks the status of the ticket did not change since it was read: a ticket
+updated meanwhile by update_ticket_status already has its key. Run it once
+after deploying the status index, from the root of the repository:
+
+    python utils/ticket_backfill.py --table solar-table --dry-run
+    python utils/ticket_backfill.py --table solar-table
+
+It can run again safely: tickets already indexed are skipped.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+from utils.dynamodb_helper import scan_pages
+from utils.id_helper import creation_key
+
+
+def status_sort_value(status, ticket_id):
+    # Same as solar_energy.status_sort_value
+    return f"{status}#{creation_key(ticket_id)}"
+
+
+def backfill(table, pk='customer_id', sk='ticket_id', index_key='status_ticket_id', dry_run=False):
+    """Sets the status index key of the tickets missing it, or with a stale one. Returns the counts per outcome."""
+    counts = Counter()
+    for page in scan_pages(table, projection=[pk, sk, 'status', index_key]):
+        for item in page:
+            if 'status' not in item:
+                counts['without status'] += 1
+                continue
+            value = status_sort_value(item['status'], item[sk])
+            if item.get(index_key) == value:
+                counts['indexed'] += 1
+                continue
+            if dry_run:
+                counts['to backfill'] += 1
+                continue
+            try:
+                table.update_item(Key={pk: item[pk], sk: item[sk]},
+                                  UpdateExpression='SET #key = :key',
+                                  ConditionExpression=Attr('status').eq(item['status']),
+                                  ExpressionAttributeNames={'#key': index_key},
+                                  ExpressionAttributeValues={':key': value})
+                counts['backfilled'] += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                counts['changed meanwhile'] += 1
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--table", required=True, help="tickets table of the solar energy Lambda")
+    parser.add_argument("--pk", default="customer_id", help="partition key of the table")
+    parser.add_argument("--sk", default="ticket_id", help="sort key of the table")
+    parser.add_argument("--index-key", default="status_ticket_id", help="sort key attribute of the status index")
+    parser.add_argument("--dry-run", action="store_true", help="count the tickets to backfill, write nothing")
+    args = parser.parse_args()
+
+    from utils.client_helper import get_table
+    start = time.perf_counter()
+    counts = backfill(get_table(args.table), args.pk, args.sk, args.index_key, args.dry_run)
+    print(', '.join(f"{_count:,} {_outcome}" for _outcome, _count in counts.items()) or "No tickets",
+          f"in {time.perf_counter() - start:.1f}s")
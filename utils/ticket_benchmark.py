@@ -0,0 +1,84 @@
+"""Measures the bulk ticket operations of the solar energy Lambda, offline.
+
+A utils.local_dynamodb table stands in for the tickets table. A batch of
+tickets is opened and then closed and reassigned two ways:
+
+- one open_ticket call, and one update_ticket_status call, per ticket, timed
+  on a sample of the tickets and extrapolated to all of them
+- one open_tickets call (BatchWriteItem requests of 25 tickets) and one
+  update_ticket_status call (transactions of 100 tickets) for the batch
+
+and a ticket is read back with its event log. Run it from the root of the
+repository:
+
+    python utils/ticket_benchmark.py --tickets 10000 --latency-ms 5
+    python utils/ticket_benchmark.py --tickets 10000 --threads 1 8 16
+
+The table runs in this process, so without --latency-ms the threads share one
+CPU and only the request latency they overlap is saved.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.local_dynamodb import LocalDynamoDB
+from utils.log_helper import LEVELS, logger
+from utils.replay_harness import load_handlers
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickets", type=int, default=10000, help="tickets per batch")
+    parser.add_argument("--threads", nargs="*", type=int, default=[8], help="threads writing a batch")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency of each request to the table")
+    parser.add_argument("--sample", type=int, default=500, help="tickets written one call at a time")
+    parser.add_argument("--customers", type=int, default=1000, help="customers the tickets are spread over")
+    args = parser.parse_args()
+
+    dynamodb = LocalDynamoDB(latency_ms=args.latency_ms)
+    module = load_handlers(dynamodb, ['solar_energy'])['solar_energy']
+    # Keep the logs of the invocations out of the report
+    logger.level = LEVELS['WARNING']
+    requests = [{'customer_id': str(_i % args.customers), 'msg': f"Inverter error light, report {_i}"}
+                for _i in range(args.tickets)]
+    sample = requests[:min(args.sample, args.tickets)]
+    print(f"{'method':<40} {'seconds':>9} {'tickets/s':>12}")
+
+    def report(name, elapsed):
+        print(f"{name:<40} {elapsed:>9.2f} {args.tickets / elapsed:>12,.0f}")
+
+    replies, elapsed = timed(lambda: [module.open_ticket(_r['customer_id'], _r['msg']) for _r in sample])
+    report("open_ticket per ticket (est.)", elapsed * args.tickets / len(sample))
+    tickets = [{'customer_id': _r['customer_id'], 'ticket_id': _reply.rsplit(' ', 1)[-1]}
+               for _r, _reply in zip(sample, replies)]
+    _, elapsed = timed(lambda: [module.update_ticket_status(json.dumps([_t]), 'closed', 'field-team')
+                                for _t in tickets])
+    report("update_ticket_status per ticket (est.)", elapsed * args.tickets / len(sample))
+
+    for threads in args.threads:
+        module.ticket_write_threads = threads
+        opened, elapsed = timed(lambda: module.open_tickets(json.dumps(requests)))
+        report(f"open_tickets, {threads} threads", elapsed)
+        batch = json.dumps(opened['tickets'])
+        updated, elapsed = timed(lambda: module.update_ticket_status(batch, 'in_progress', 'field-team'))
+        report(f"update_ticket_status, {threads} threads", elapsed)
+        if updated['updated'] != args.tickets:
+            raise SystemExit(f"Error: {updated['updated']:,} of {args.tickets:,} tickets updated")
+        _, elapsed = timed(lambda: module.update_ticket_status(batch, 'closed'))
+        report(f"update_ticket_status again, {threads} threads", elapsed)
+
+    ticket = opened['tickets'][0]
+    (read,), elapsed = timed(lambda: module.get_ticket_status(ticket['customer_id'], ticket['ticket_id']))
+    print(f"Ticket {read['ticket_id']} read with its {len(read['history'])} events in {elapsed * 1000:.1f} ms: "
+          f"{' > '.join(_event.get('status', '') for _event in read['history'])}")
@@ -0,0 +1,240 @@
+"""Incremental parsing of the visualization data sent to the explain_* functions.
+
+The data parameter of a long series, e.g. years of daily points, is a large
+JSON string. json.loads would turn every point into a dict, and keep all of
+them in memory while the explanation only needs a few numeric columns and a
+handful of labels. parse_visualization reads the top level object in place
+instead:
+
+- arrays of numbers become float arrays, parsed chunk by chunk into a
+  preallocated array.array
+- arrays of flat objects under a points key (data_points by default) become
+  StreamedPoints: a sequence that extracts a numeric field of every point into
+  a preallocated column when it is first asked for (see metrics_kernel.to_columns),
+  and only decodes the points that are read one by one, e.g. to label an anomaly
+- every other value (visualization_type, customer_id, categories...) is decoded
+  with json as usual
+
+    >>> from utils.visualization_parser import parse_visualization
+    >>> data = parse_visualization(event_data)
+    >>> data['visualization_type'], len(data['data_points'])
+
+Data shorter than STREAM_MIN_CHARS, the usual monthly chart, is parsed with
+json.loads, which is faster at that size. So is data the scanner cannot
+handle, such as points with nested objects or braces within strings: the
+result is the same, only the memory saving is lost. Points are only decoded
+when read, so a malformed point, or a string mimicking a point separator such
+as "},{", is reported by the explanation reading it rather than by the parser.
+"""
+
+import json
+import os
+import re
+
+from array import array
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Sequence
+
+from utils.metrics_kernel import numpy
+
+# Data shorter than this is parsed with json.loads
+STREAM_MIN_CHARS = int(os.getenv('stream_min_chars', 1 << 16))
+# Characters of an array parsed at once, bounding the temporary strings of a chunk
+CHUNK_CHARS = 1 << 18
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# End of an array of objects
+_POINTS_END = re.compile(r'\}[ \t\n\r]*\]')
+# Start of an object
+_BRACE = re.compile(r'\{')
+# Separator of two objects, counted to check that a chunk only holds whole, flat points
+_POINT_SEPARATOR = re.compile(r'\}[ \t\n\r]*,[ \t\n\r]*\{')
+# Characters left before the first object of a chunk
+_SEPARATORS = ' \t\n\r,'
+
+
+def _floats(values: Iterable) -> array:
+    # Numbers as text or as values, null and missing values read as 0
+    try:
+        return array('d', map(float, values))
+    except (TypeError, ValueError):
+        return array('d', (0.0 if _val is None or str(_val).strip() in ('null', '') else float(_val)
+                            for _val in values))
+
+
+def _new_column(length: int):
+    np = numpy()
+    return np.empty(length) if np else array('d', bytes(8 * length))
+
+
+class StreamedPoints:
+    """Sequence of the flat JSON objects of an array, read in place.
+
+    Numeric fields are extracted with a regular expression per field, chunk by chunk, into
+    a preallocated column, see columns. Indexing decodes the one point read, found from the
+    positions of the points of its chunk, while slicing and iterating decode whole chunks.
+    """
+
+    def __init__(self, source: str, start: int, end: int):
+        """Constructs an instance over the array spanning source[start:end], brackets included.
+
+        Raises:
+            ValueError: when a point holds a nested object, or a brace within a string
+        """
+        self._source = source
+        self._chunks = []
+        self._offsets = [0]
+        self._columns = {}
+        self._starts = {}
+
+        _pos, _last = start + 1, end - 1
+        while _pos < _last:
+            _cut = source.find('}', min(_pos + CHUNK_CHARS, _last), _last)
+            _cut = _last if _cut < 0 else _cut + 1
+            _count = source.count('{', _pos, _cut)
+            if source.count('}', _pos, _cut) != _count \
+                    or len(_POINT_SEPARATOR.findall(source, _pos, _cut)) != max(_count - 1, 0):
+                raise ValueError("Points are not flat objects")
+            if _count:
+                self._chunks.append((_pos, _cut))
+                self._offsets.append(self._offsets[-1] + _count)
+            _pos = _cut
+
+    def __len__(self) -> int:
+        return self._offsets[-1]
+
+    def _decode(self, chunk: int) -> List[Dict]:
+        _start, _end = self._chunks[chunk]
+        _points = json.loads(f"[{self._source[_start:_end].lstrip(_SEPARATORS)}]")
+        if len(_points) != self._offsets[chunk + 1] - self._offsets[chunk]:
+            # Braces within strings mimicking whole points
+            raise ValueError("Points are not flat objects")
+        return _points
+
+    def _point_starts(self, chunk: int) -> array:
+        if chunk not in self._starts:
+            _start, _end = self._chunks[chunk]
+            _matches = _BRACE.finditer(self._source, _start, _end)
+            self._starts[chunk] = array('q', (_match.start() for _match in _matches))
+        return self._starts[chunk]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            _start, _stop, _step = index.indices(len(self))
+            if _step != 1 or _start >= _stop:
+                return [self[_i] for _i in range(_start, _stop, _step)]
+            _first = bisect_right(self._offsets, _start) - 1
+            _last = bisect_right(self._offsets, _stop - 1) - 1
+            _points = [_point for _chunk in range(_first, _last + 1) for _point in self._decode(_chunk)]
+            return _points[_start - self._offsets[_first]:_stop - self._offsets[_first]]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("point index out of range")
+        _chunk = bisect_right(self._offsets, index) - 1
+        return _decoder.raw_decode(self._source, self._point_starts(_chunk)[index - self._offsets[_chunk]])[0]
+
+    def __iter__(self):
+        for _chunk in range(len(self._chunks)):
+            yield from self._decode(_chunk)
+
+    def columns(self, fields: List[str]) -> Dict[str, Sequence[float]]:
+        """Returns a column of floats per field, NumPy arrays when NumPy is available.
+
+        Missing and null values read as 0. Chunks where the field is missing from some points,
+        is not a number, or is not written "field": value, are decoded to read it.
+        """
+        for _field in fields:
+            if _field in self._columns:
+                continue
+            # The value as written, up to the next separator, checked by float
+            _pattern = re.compile(r'"%s":[ \t\n\r]*([^,}]*)' % re.escape(_field))
+            _column = _new_column(len(self))
+            for _chunk, (_start, _end) in enumerate(self._chunks):
+                _first, _next = self._offsets[_chunk], self._offsets[_chunk + 1]
+                _values = _pattern.findall(self._source, _start, _end)
+                try:
+                    if len(_values) != _next - _first:
+                        raise ValueError
+                    _values = _floats(_values)
+                except ValueError:
+                    _values = _floats([_point.get(_field) for _point in self._decode(_chunk)])
+                _column[_first:_next] = _values
+            self._columns[_field] = _column
+        return {_field: self._columns[_field] for _field in fields}
+
+
+def _number_array(source: str, start: int, end: int) -> array:
+    # Parses an array of numbers spanning source[start:end] into a preallocated array
+    _values = array('d', bytes(8 * (source.count(',', start, end) + 1)))
+    _filled = 0
+    _pos, _last = start + 1, end - 1
+    while _pos < _last:
+        _cut = source.find(',', min(_pos + CHUNK_CHARS, _last), _last)
+        _cut = _last if _cut < 0 else _cut
+        _chunk = _floats(source[_pos:_cut].split(','))
+        _values[_filled:_filled + len(_chunk)] = _chunk
+        _filled += len(_chunk)
+        _pos = _cut + 1
+    return _values if _filled == len(_values) else _values[:_filled]
+
+
+def _parse_value(source: str, pos: int, points: bool):
+    if source[pos] == '[':
+        _first = _WHITESPACE.match(source, pos + 1).end()
+        if points and source[_first] == '{':
+            # The array ends at the first }] out of a string, which the chunks of StreamedPoints check
+            _match = _POINTS_END.search(source, _first)
+            if _match:
+                return StreamedPoints(source, pos, _match.end()), _match.end()
+        elif source[_first] in '-0123456789':
+            _end = source.find(']', _first) + 1
+            if _end and source.find('"', pos, _end) < 0 and source.find('{', pos, _end) < 0 \
+                    and source.find('[', _first, _end) < 0:
+                return _number_array(source, pos, _end), _end
+    return _decoder.raw_decode(source, pos)
+
+
+def _parse_object(source: str, points_keys) -> Dict:
+    _result = {}
+    _pos = _WHITESPACE.match(source, 0).end()
+    if source[_pos] != '{':
+        raise ValueError("Data is not a JSON object")
+    _pos = _WHITESPACE.match(source, _pos + 1).end()
+    while source[_pos] != '}':
+        _key, _pos = _decoder.raw_decode(source, _pos)
+        _pos = _WHITESPACE.match(source, _pos).end()
+        if not isinstance(_key, str) or source[_pos] != ':':
+            raise ValueError(f"Expected a key at character {_pos}")
+        _pos = _WHITESPACE.match(source, _pos + 1).end()
+        _result[_key], _pos = _parse_value(source, _pos, _key in points_keys)
+        _pos = _WHITESPACE.match(source, _pos).end()
+        if source[_pos] == ',':
+            _pos = _WHITESPACE.match(source, _pos + 1).end()
+        elif source[_pos] != '}':
+            raise ValueError(f"Expected ',' or '}}' at character {_pos}")
+    if _WHITESPACE.match(source, _pos + 1).end() != len(source):
+        raise ValueError("Extra data after the JSON object")
+    return _result
+
+
+def parse_visualization(data: str, points_keys=('data_points',)) -> Dict:
+    """Parses the JSON data of a visualization, streaming its large arrays, see the module docstring.
+
+    Args:
+        data (str): JSON object
+        points_keys (tuple, Optional): top level keys whose arrays of objects are read as StreamedPoints
+
+    Returns:
+        Dict: the top level object
+
+    Raises:
+        json.JSONDecodeError: when data is not valid JSON, like json.loads
+    """
+    if len(data) >= STREAM_MIN_CHARS:
+        try:
+            return _parse_object(data, points_keys)
+        except (ValueError, IndexError):
+            pass
+    return json.loads(data)